@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Micro-benchmark of V2 JSON vs V2 proto3 span encoding.
+
+For each encoding, reports the CPU time to encode a span, and the wire size
+per span of a whole flush, both raw and gzip-compressed.  proto3 needs the
+protobuf package.
+
+Usage: python bench/bench_encoding.py [--traces N] [--spans-per-trace N]
+"""
+import argparse
+import itertools
+import timeit
+
+from py_zipkin.encoding import Encoding, protobuf
+
+from swift_zipkin import transport
+
+from bench_transport import make_spans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--traces', type=int, default=2000)
+    parser.add_argument('--spans-per-trace', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    spans = list(itertools.chain.from_iterable(
+        make_spans(args.traces, args.spans_per_trace)))
+    encodings = [Encoding.V2_JSON]
+    if protobuf.installed():
+        encodings.append(Encoding.V2_PROTO3)
+    else:
+        print('protobuf not installed; skipping proto3')
+    gzip = transport.get_compressor(transport.COMPRESSION_GZIP)
+
+    print('%d spans' % len(spans))
+    print('%-10s %12s %12s %12s' % (
+        'encoding', 'ns/span', 'bytes/span', 'gzip b/span'))
+    for encoding in encodings:
+        encoder = transport.get_fragment_encoder(encoding)
+        best = min(timeit.repeat(
+            lambda: [encoder.encode_span(span) for span in spans],
+            number=1, repeat=args.repeat))
+        payload = transport.join_fragments(
+            [encoder.encode_span(span) for span in spans], encoding)
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        assert transport.count_spans(
+            payload if encoding == Encoding.V2_PROTO3
+            else payload.decode('utf-8'), encoding) == len(spans)
+        print('%-10s %12.1f %12.1f %12.1f' % (
+            encoding.name, best * 1e9 / len(spans),
+            float(len(payload)) / len(spans),
+            float(len(gzip(payload))) / len(spans)))
+
+
+if __name__ == '__main__':
+    main()
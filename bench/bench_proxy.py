@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+End-to-end benchmark of per-request tracing overhead in a proxy-like server.
+
+Everything runs in this one process, over loopback, with no network access
+needed:
+
+* a fake memcached server that answers every get with the same JSON value;
+* a fake object server that answers every request with a small body;
+* a stand-in Zipkin collector that accepts span POSTs and counts them;
+* an eventlet.wsgi server whose app does a few memcached gets through swift's
+  MemcacheRing and a few backend GETs through swift's bufferedhttp, like a
+  proxy handling an object GET;
+* client greenthreads driving that server over keep-alive connections.
+
+It first measures the server unpatched, then applies
+patch_eventlet_and_swift() (pointed at the stand-in collector) and measures
+it again at 0%, 1% and 100% sampling.  For each it reports requests/sec,
+p50/p99 latency, CPU per request (for the whole process, so compare against
+the unpatched baseline) and, from a shorter run under tracemalloc, the peak
+and retained memory per request.
+
+Usage: python bench/bench_proxy.py [--requests N] [--concurrency N]
+                                   [--backend-calls N] [--memcache-gets N]
+"""
+import argparse
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+
+import eventlet
+from eventlet import wsgi as eventlet_wsgi
+from eventlet.green import httplib
+
+from swift.common import bufferedhttp
+from swift.common.memcached import JSON_FLAG, MemcacheRing
+
+from swift_zipkin import api, transport
+from swift_zipkin.patcher import patch_eventlet_and_swift
+
+
+OBJECT_BODY = b'x' * 1024
+CACHED_VALUE = b'{"status": 200, "meta": {}}'
+
+
+def serve_http(sock, respond):
+    """
+    Speak just enough HTTP/1.1 on an accepted socket to answer requests
+    (with bodies sized by Content-Length) until the client hangs up.
+
+    :param respond: called with (request line, request body); returns the
+                    (status line, response body) to send
+    """
+    fp = sock.makefile('rb')
+    try:
+        while True:
+            request_line = fp.readline()
+            if not request_line:
+                return
+            content_length = 0
+            while True:
+                line = fp.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    content_length = int(value)
+            body = fp.read(content_length) if content_length else b''
+            status, resp_body = respond(request_line, body)
+            sock.sendall(b'HTTP/1.1 %s\r\nContent-Length: %d\r\n\r\n%s' % (
+                status, len(resp_body), resp_body))
+    except (IOError, OSError):
+        pass
+    finally:
+        fp.close()
+        sock.close()
+
+
+def serve_memcached(sock):
+    fp = sock.makefile('rb')
+    try:
+        while True:
+            line = fp.readline()
+            if not line:
+                return
+            parts = line.split()
+            if parts[0] == b'get':
+                sock.sendall(b''.join(
+                    b'VALUE %s %d %d\r\n%s\r\n' % (
+                        key, JSON_FLAG, len(CACHED_VALUE), CACHED_VALUE)
+                    for key in parts[1:]) + b'END\r\n')
+            elif parts[0] == b'set':
+                fp.read(int(parts[4]) + 2)
+                sock.sendall(b'STORED\r\n')
+            else:
+                sock.sendall(b'ERROR\r\n')
+    except (IOError, OSError):
+        pass
+    finally:
+        fp.close()
+        sock.close()
+
+
+def start_server(handler):
+    """
+    :returns: the port of a new loopback listener whose connections are
+              each handled by `handler` in their own greenthread.
+    """
+    listener = eventlet.listen(('127.0.0.1', 0))
+
+    def accept():
+        while True:
+            sock, _ = listener.accept()
+            eventlet.spawn_n(handler, sock)
+    eventlet.spawn_n(accept)
+    return listener.getsockname()[1]
+
+
+class Collector(object):
+
+    def __init__(self):
+        self.posts = self.bytes = 0
+        self.port = start_server(
+            lambda sock: serve_http(sock, self.respond))
+
+    def respond(self, request_line, body):
+        self.posts += 1
+        self.bytes += len(body)
+        return b'202 Accepted', b''
+
+
+def make_app(memcache, object_port, backend_calls, memcache_gets):
+    def app(env, start_response):
+        for i in range(memcache_gets):
+            memcache.get('AUTH_test/c%d' % i)
+        for i in range(backend_calls):
+            conn = bufferedhttp.http_connect(
+                '127.0.0.1', object_port, 'sda%d' % i, '123', 'GET',
+                '/AUTH_test/c/o')
+            resp = conn.getresponse()
+            resp.read()
+            resp.close()
+            conn.close()
+        start_response('200 OK', [('Content-Length', str(len(OBJECT_BODY)))])
+        return [OBJECT_BODY]
+    return app
+
+
+def run_clients(port, num_requests, concurrency):
+    """
+    :returns: (wall seconds, CPU seconds, sorted list of latencies)
+    """
+    latencies = []
+    per_client = num_requests // concurrency
+
+    def client():
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        for _ in range(per_client):
+            start = time.time()
+            conn.request('GET', '/v1/AUTH_test/c/o')
+            resp = conn.getresponse()
+            resp.read()
+            latencies.append(time.time() - start)
+        conn.close()
+
+    pool = eventlet.GreenPool(concurrency)
+    wall_start, cpu_start = time.time(), time.process_time()
+    for _ in range(concurrency):
+        pool.spawn_n(client)
+    pool.waitall()
+    return (time.time() - wall_start, time.process_time() - cpu_start,
+            sorted(latencies))
+
+
+def measure_memory(port, num_requests, concurrency):
+    """
+    :returns: (peak, retained) KiB per request, under tracemalloc
+    """
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    run_clients(port, num_requests, concurrency)
+    gc.collect()
+    end, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ((peak - start) / 1024.0 / num_requests,
+            (end - start) / 1024.0 / num_requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--backend-calls', type=int, default=3)
+    parser.add_argument('--memcache-gets', type=int, default=2)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    collector = Collector()
+    memcached_port = start_server(serve_memcached)
+    object_port = start_server(
+        lambda sock: serve_http(sock, lambda *a: (b'200 OK', OBJECT_BODY)))
+    memcache = MemcacheRing(['127.0.0.1:%d' % memcached_port])
+    app = make_app(memcache, object_port, args.backend_calls,
+                   args.memcache_gets)
+    listener = eventlet.listen(('127.0.0.1', 0))
+    eventlet.spawn_n(eventlet_wsgi.server, listener, app, log_output=False)
+    proxy_port = listener.getsockname()[1]
+
+    print('%d requests, %d at a time, %d backend calls + %d memcache gets '
+          'each' % (args.requests, args.concurrency, args.backend_calls,
+                    args.memcache_gets))
+    print('%-10s %10s %9s %9s %10s %10s %10s' % (
+        'case', 'req/s', 'p50 ms', 'p99 ms', 'CPU us/req', 'peak KiB/r',
+        'kept KiB/r'))
+    for name, rate in (('unpatched', None), ('0%', 0.0), ('1%', 0.01),
+                       ('100%', 1.0)):
+        if rate is not None:
+            if transport.global_transport is None:
+                patch_eventlet_and_swift(
+                    logging.getLogger('bench'), '127.0.0.1', collector.port,
+                    sample_rate=rate, flush_sec=0.5)
+            api.sample_rate_pct = rate * 100.0
+        # warm up: connections, caches, the transport's flushers
+        run_clients(proxy_port, args.concurrency * 10, args.concurrency)
+        wall, cpu, latencies = run_clients(proxy_port, args.requests,
+                                           args.concurrency)
+        peak, kept = measure_memory(proxy_port, args.requests // 10,
+                                    args.concurrency)
+        n = len(latencies)
+        print('%-10s %10.0f %9.2f %9.2f %10.1f %10.2f %10.2f' % (
+            name, n / wall, latencies[n // 2] * 1000,
+            latencies[min(n - 1, int(n * 0.99))] * 1000,
+            cpu / n * 1e6, peak, kept))
+        sys.stdout.flush()
+
+    eventlet.sleep(1)  # let the last flush land
+    print('collector: %d POSTs, %d bytes' % (
+        collector.posts, collector.bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Micro-benchmark of the tracer storage backends.
+
+Inside a sampled server span, for each of api.STORAGE_BACKENDS (that this
+Python has), reports ns per:
+
+* "lookup": api.is_sampled(), as every patched call does;
+* "leaf span": starting and stopping a LeafClientSpan (a memcached op or
+  backend request);
+* "child span": entering and exiting an ezipkin_client_span, which pushes
+  onto and pops off the tracer's context stacks;
+* "spawn": spawning a greenthread that starts a leaf span of its own, and
+  waiting for it; "spawn (bare)" is the same with eventlet unpatched, for
+  contrast.
+
+Usage: python bench/bench_storage.py [--number N] [--repeat N]
+"""
+import argparse
+import timeit
+
+import eventlet
+from eventlet import greenthread as eventlet_greenthread
+import py_zipkin.storage
+import py_zipkin.zipkin
+
+from swift_zipkin import api, greenthread
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+def leaf_span():
+    api.LeafClientSpan('proxy-server', span_name='get').start().stop()
+
+
+def child_span():
+    with api.ezipkin_client_span('proxy-server', span_name='GET'):
+        pass
+
+
+def spawn():
+    eventlet.spawn(leaf_span).wait()
+
+
+def use_storage(backend):
+    """
+    What patch_eventlet_and_swift would do, for just the one backend.
+    """
+    api.set_storage(backend)
+    py_zipkin.storage.get_default_tracer = api.get_default_tracer
+    py_zipkin.zipkin.get_default_tracer = api.get_default_tracer
+    eventlet_greenthread.GreenThread.__init__ = greenthread.__original_init__
+    eventlet_greenthread.GreenThread.main = greenthread.__original_main__
+    greenthread.patch()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+    py_zipkin.zipkin.create_endpoint = api.get_endpoint
+    py_zipkin.zipkin.generate_random_64bit_string = \
+        api.generate_random_64bit_string
+
+    backends = [backend for backend in api.STORAGE_BACKENDS
+                if backend != api.STORAGE_CONTEXTVARS or api.contextvars]
+    print('%-13s' % 'ns per' + ''.join('%14s' % b for b in backends))
+    results = dict((backend, {}) for backend in backends)
+    cases = (('lookup', api.is_sampled), ('leaf span', leaf_span),
+             ('child span', child_span), ('spawn', spawn))
+    for backend in backends:
+        use_storage(backend)
+        with api.ezipkin_server_span(
+                'proxy-server', span_name='GET', sample_rate=100,
+                transport_handler=noop):
+            spans = api.get_default_tracer().get_spans()
+            for name, fn in cases:
+                times = []
+                for _ in range(args.repeat):
+                    times.append(timeit.timeit(fn, number=args.number))
+                    spans.clear()
+                results[backend][name] = min(times) * 1e9 / args.number
+            eventlet_greenthread.GreenThread.__init__ = \
+                greenthread.__original_init__
+            eventlet_greenthread.GreenThread.main = \
+                greenthread.__original_main__
+            results[backend]['spawn (bare)'] = min(timeit.repeat(
+                spawn, number=args.number, repeat=args.repeat)
+            ) * 1e9 / args.number
+            spans.clear()
+    for name in [name for name, _ in cases] + ['spawn (bare)']:
+        print('%-13s' % name + ''.join(
+            '%14.1f' % results[backend][name] for backend in backends))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Micro-benchmark of the transport's buffer-and-flush path.
+
+Compares, per span, the CPU time and peak allocations of buffering a
+realistic mix of traces and writing out one flush:
+
+* "legacy": py_zipkin encodes each trace to a JSON list string, the transport
+  buffers the strings, then slices the brackets off every one of them and
+  joins the slices (what GreenHttpTransport used to do);
+* "fragments": the transport is handed the individually-encoded spans and
+  joins them all once at flush time.
+
+Span encoding itself is the same for both and isn't measured.
+
+Usage: python bench/bench_transport.py [--traces N] [--spans-per-trace N]
+"""
+import argparse
+import logging
+import timeit
+import tracemalloc
+
+from py_zipkin import Kind
+from py_zipkin.encoding import Encoding
+from py_zipkin.encoding._encoders import get_encoder
+from py_zipkin.encoding._helpers import Endpoint, Span
+
+from swift_zipkin import transport
+
+
+class NullSession(object):
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        return self
+
+    def raise_for_status(self):
+        pass
+
+
+def make_spans(num_traces, spans_per_trace):
+    """
+    Build lists of py_zipkin Spans that look like a proxy GET fanning out to
+    object servers, one list per trace.
+    """
+    local = Endpoint('proxy-server', '10.0.0.1', None, 8080)
+    traces = []
+    for t in range(num_traces):
+        trace_id = '%032x' % (t + 1)
+        spans = []
+        for s in range(spans_per_trace):
+            spans.append(Span(
+                trace_id=trace_id,
+                name='GET' if s == 0 else 'get',
+                parent_id=None if s == 0 else '%016x' % 1,
+                span_id='%016x' % (s + 1),
+                kind=Kind.SERVER if s == 0 else Kind.CLIENT,
+                timestamp=1600000000.0 + s,
+                duration=0.0123,
+                local_endpoint=local,
+                remote_endpoint=Endpoint(
+                    'swift-object-server', '10.0.0.%d' % (s % 250 + 2),
+                    None, 6200),
+                tags={'http.uri': '/sda1/123/AUTH_test/c/o%d' % s,
+                      'http.status_code': '200'},
+                annotations={'Response headers received': 1600000000.01},
+            ))
+        traces.append(spans)
+    return traces
+
+
+def make_traces(num_traces, spans_per_trace):
+    encoder = get_encoder(Encoding.V2_JSON)
+    traces = [[encoder.encode_span(span) for span in spans]
+              for spans in make_spans(num_traces, spans_per_trace)]
+    return encoder, traces
+
+
+def legacy_path(encoder, traces):
+    # py_zipkin's encode_queue, then the old _gt_flush concatenation
+    payload_buffer = [encoder.encode_queue(spans) for spans in traces]
+    return '[' + ','.join(
+        p[p.index('[') + 1:p.rindex(']')]
+        for p in payload_buffer
+    ) + ']'
+
+
+def fragments_path(encoder, traces):
+    t = transport.GreenHttpTransport(logging.getLogger('bench'),
+                                     '127.0.0.1', 9411,
+                                     flush_threshold_size=2**40,
+                                     max_buffer_size=2**40,
+                                     max_buffer_spans=2**40)
+    t._flushers_started = True  # don't spawn greenthreads
+    t.endpoints[0].session = NullSession()
+    for spans in traces:
+        # FragmentEncoder.encode_queue hands over a fresh list per batch
+        t.send(list(spans))
+    t._gt_flush(t.span_queue.drain())
+
+
+def measure(fn, encoder, traces, num_spans, repeat):
+    best = min(timeit.repeat(lambda: fn(encoder, traces),
+                             number=1, repeat=repeat))
+    tracemalloc.start()
+    fn(encoder, traces)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best * 1e9 / num_spans, float(peak) / num_spans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--traces', type=int, default=2000)
+    parser.add_argument('--spans-per-trace', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    encoder, traces = make_traces(args.traces, args.spans_per_trace)
+    num_spans = args.traces * args.spans_per_trace
+    # Make sure the two paths agree before timing them
+    assert len(legacy_path(encoder, traces)) == sum(
+        len(s) + 1 for spans in traces for s in spans) + 1
+
+    print('%d traces x %d spans' % (args.traces, args.spans_per_trace))
+    print('%-10s %12s %16s' % ('path', 'ns/span', 'peak bytes/span'))
+    for name, fn in (('legacy', legacy_path),
+                     ('fragments', fragments_path)):
+        ns, peak = measure(fn, encoder, traces, num_spans, args.repeat)
+        print('%-10s %12.1f %16.1f' % (name, ns, peak))
+
+
+if __name__ == '__main__':
+    main()
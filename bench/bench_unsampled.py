@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Micro-benchmark of the per-request cost of our patches.
+
+Drives one request through the patched eventlet.wsgi handle_one_response,
+making a few backend HTTP connections and memcached gets from inside it,
+with the real (I/O) work stubbed out.  Reports ns/request for:
+
+* "unpatched": the stubs alone;
+* "0%": the patches, with nothing sampled;
+* "100%": the patches, with everything sampled, to a transport that throws
+  spans away (for contrast).
+
+Since the stubs do no I/O at all, the gap between "0%" and "unpatched" is the
+entire cost of not tracing a request: a couple of microseconds, against the
+milliseconds a real proxy request takes.
+
+Usage: python bench/bench_unsampled.py [--backend-calls N] [--memcache-gets N]
+"""
+import argparse
+import io
+import logging
+import timeit
+from email.message import Message
+
+import py_zipkin.zipkin
+from swift.common import memcached as swift_memcached
+
+from swift_zipkin import api, http, memcached, transport, wsgi
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+class NullSession(object):
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        return self
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSocket(object):
+
+    def fileno(self):
+        return 42
+
+    def getsockname(self):
+        return ('10.0.0.1', 8080)
+
+    def getpeername(self):
+        return ('10.0.0.9', 54321)
+
+    def sendall(self, data):
+        pass
+
+
+class FakeFile(object):
+
+    def readline(self):
+        return b'END\r\n'
+
+
+class FakeConnection(object):
+    _method = 'GET'
+    path = '/sda1/123/AUTH_test/c/o'
+    host = '10.0.0.2'
+    port = 6200
+
+    def __init__(self):
+        self.sock = FakeSocket()
+
+    def putheader(self, header, value):
+        pass
+
+
+class FakeRing(object):
+    _io_timeout = None
+    _allow_pickle = _allow_unpickle = False
+
+    def _get_conns(self, key):
+        yield '10.0.0.3:11211', FakeFile(), FakeSocket()
+
+    def _return_conn(self, server, fp, sock):
+        pass
+
+
+class FakeProtocol(object):
+    command = 'GET'
+    path = '/v1/AUTH_test/c/o'
+
+    def __init__(self, handler):
+        self.headers = Message()
+        self.headers['User-Agent'] = 'curl/7.68.0'
+        self.request = FakeSocket()
+        self.wfile = io.BytesIO()
+        self.environ = {}
+        self.application = None
+        self.handler = handler
+
+
+def make_handler(backend_calls, memcache_gets, endheaders, conn_close,
+                 get):
+    ring = FakeRing()
+
+    def handle_one_response(protocol):
+        for i in range(memcache_gets):
+            get(ring, 'key%d' % i)
+        for _ in range(backend_calls):
+            conn = FakeConnection()
+            endheaders(conn)
+            conn_close(conn)
+    return handle_one_response
+
+
+def unpatched(backend_calls, memcache_gets):
+    handler = make_handler(backend_calls, memcache_gets, noop, noop, noop)
+    protocol = FakeProtocol(handler)
+    return lambda: handler(protocol)
+
+
+def patched(backend_calls, memcache_gets):
+    handler = make_handler(backend_calls, memcache_gets,
+                           http._patched_endheaders, http._patched_conn_close,
+                           memcached._get)
+    wsgi.__original_handle_one_response__ = handler
+    protocol = FakeProtocol(handler)
+
+    return lambda: wsgi._patched_handle_one_response(protocol)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--backend-calls', type=int, default=3)
+    parser.add_argument('--memcache-gets', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    # What patch_eventlet_and_swift would do
+    py_zipkin.zipkin.get_default_tracer = api.get_default_tracer
+    py_zipkin.zipkin.create_endpoint = api.get_endpoint
+    py_zipkin.zipkin.generate_random_64bit_string = \
+        api.generate_random_64bit_string
+    # Stub out everything below our patches
+    http.__org_endheaders__ = noop
+    http.__org_conn_close__ = noop
+    memcached.__org_get__ = noop
+    swift_memcached.md5hash = lambda key: key.encode('ascii')
+    t = transport.GreenHttpTransport(
+        logging.getLogger('bench'), '127.0.0.1', 9411,
+        flush_threshold_size=2**40, max_buffer_size=2**40,
+        max_buffer_spans=2**40)
+    t._flushers_started = True  # don't spawn greenthreads
+    t.endpoints[0].session = NullSession()
+    transport.global_transport = t
+
+    print('%d backend calls + %d memcache gets per request' % (
+        args.backend_calls, args.memcache_gets))
+    print('%-10s %12s' % ('case', 'ns/request'))
+    for name, rate, make in (('unpatched', 0, unpatched),
+                             ('0%', 0, patched),
+                             ('100%', 100, patched)):
+        api.sample_rate_pct = rate
+        fn = make(args.backend_calls, args.memcache_gets)
+        best = min(timeit.repeat(fn, number=args.requests,
+                                 repeat=args.repeat))
+        t.span_queue.drain()
+        print('%-10s %12.1f' % (name, best * 1e9 / args.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -53,12 +53,21 @@ setuptools.setup(
     install_requires=[
         'py_zipkin>0.19.0',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'protobuf': ['py_zipkin[protobuf]'],
+    },
     classifiers=['Development Status :: 4 - Beta',
                  'Operating System :: POSIX :: Linux',
                  'Programming Language :: Python :: 2.7',
                  'Programming Language :: Python :: 3.7',
                  'Environment :: No Input/Output (Daemon)'],
-    entry_points={'paste.filter_factory': [
-        'zipkin = swift_zipkin.zipkin:filter_factory',
-    ]},
+    entry_points={
+        'paste.filter_factory': [
+            'zipkin = swift_zipkin.zipkin:filter_factory',
+        ],
+        'console_scripts': [
+            'swift-zipkin-aggregator = swift_zipkin.aggregator:main',
+        ],
+    },
 )
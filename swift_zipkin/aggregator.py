@@ -0,0 +1,141 @@
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Contains concepts originally found in Eventlet, covered by the MIT software
+# license.  The Eventlet license:
+#  Copyright (c) 2005-2006, Bob Ippolito
+#  Copyright (c) 2007-2010, Linden Research, Inc.
+#  Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+"""
+swift-zipkin-aggregator receives the spans that every Swift worker process
+on a node forwards to it (see zipkin_forward_address in the [filter:zipkin]
+section) and POSTs them to Zipkin in big batches, so that the Zipkin server
+sees a few large POSTs per node instead of many small ones per worker.
+
+It's configured from a [zipkin-aggregator] section; see
+etc/zipkin-aggregator.conf-sample.
+"""
+
+import errno
+import os
+
+from eventlet.green import socket
+from py_zipkin.encoding import Encoding
+
+from swift.common.daemon import Daemon, run_daemon
+from swift.common.utils import (
+    get_logger, parse_options, config_positive_int_value)
+
+from swift_zipkin.transport import (
+    GreenHttpTransport, parse_forward_address)
+from swift_zipkin.zipkin import get_transport_options
+
+
+DEFAULT_LISTEN_ADDRESS = 'unix:///var/run/swift/zipkin-aggregator.sock'
+# Big enough for any UDP datagram, and for anything GreenSocketTransport sends
+# by default.
+RECV_SIZE = 2**16
+
+
+class ZipkinAggregator(Daemon):
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.logger = get_logger(conf, log_route='zipkin-aggregator')
+        self.listen_address = conf.get('listen_address',
+                                       DEFAULT_LISTEN_ADDRESS)
+        self.family, self.sockaddr = parse_forward_address(
+            self.listen_address)
+        raw_rcvbuf = conf.get('receive_buffer_size')
+        self.receive_buffer_size = config_positive_int_value(
+            raw_rcvbuf) if raw_rcvbuf else None
+        self.transport = GreenHttpTransport(
+            self.logger,
+            conf.get('zipkin_v2_host') or '127.0.0.1',
+            config_positive_int_value(conf.get('zipkin_v2_port') or 9411),
+            **get_transport_options(conf))
+        self.stats = {'received': 0, 'malformed': 0}
+        self.sock = None
+
+    def bind(self):
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        if self.receive_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            self.receive_buffer_size)
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.sockaddr)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        sock.bind(self.sockaddr)
+        self.sock = sock
+        self.logger.info('Listening for forwarded spans on %s',
+                         self.listen_address)
+
+    def handle_datagram(self, datagram):
+        """
+        Hand one forwarded (encoded list) payload to the transport, which
+        merges it into its buffer for the next flush.
+        """
+        self.stats['received'] += 1
+        try:
+            if self.transport.encoding != Encoding.V2_PROTO3:
+                datagram = datagram.decode('utf-8')
+            self.transport.send(datagram)
+        except (ValueError, TypeError):
+            # Not something a GreenSocketTransport sent us
+            self.stats['malformed'] += 1
+            self.logger.debug('Ignoring malformed %d byte datagram',
+                              len(datagram))
+
+    def run_forever(self, *args, **kwargs):
+        if self.sock is None:
+            self.bind()
+        while True:
+            self.handle_datagram(self.sock.recv(RECV_SIZE))
+
+    # There's no natural unit of work to do just "once"; an aggregator only
+    # makes sense running.
+    run_once = run_forever
+
+
+def main():
+    conf_file, options = parse_options()
+    run_daemon(ZipkinAggregator, conf_file, section_name='zipkin-aggregator',
+               **options)
+
+
+if __name__ == '__main__':
+    main()
@@ -37,20 +37,31 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #  THE SOFTWARE.
 import os
+import random
 import sys
+import time
 import weakref
 
 import eventlet
+import greenlet
 requests = eventlet.import_patched('requests.__init__')
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
 
 from eventlet.green import threading
 
+from py_zipkin import Kind
 from py_zipkin.storage import Tracer, Stack
 from py_zipkin.encoding import Encoding
+from py_zipkin.logging_helper import ZipkinBatchSender
 from py_zipkin.zipkin import (
-    zipkin_span, zipkin_client_span, zipkin_server_span, create_endpoint)
+    ERROR_KEY, zipkin_span, zipkin_client_span, zipkin_server_span,
+    create_endpoint)
 
 from swift_zipkin import transport
+from swift_zipkin.sampling import TailSampledTrace
 
 # Convenience imports so other places don't have to import py_zipkin stuff
 from py_zipkin.zipkin import (
@@ -65,7 +76,61 @@ extract_zipkin_attrs_from_headers = extract_zipkin_attrs_from_headers
 
 
 sample_rate_pct = 100
+encoding = Encoding.V2_JSON
+# A sampling.TailSampler, in tail-sampling mode
+tail_sampler = None
+# Something with a sample(method, path, headers) method (e.g. a
+# sampling.RateLimitingSampler) that replaces sample_rate_pct, if set
+head_sampler = None
+# Seconds between progress annotations on streamed responses; 0 for none
+throughput_interval = 0
+# How we propagate trace context to backends: the X-B3-* headers, or the
+# single b3 header
+B3_MULTI = 'multi'
+B3_SINGLE = 'single'
+B3_FORMATS = (B3_MULTI, B3_SINGLE)
+b3_format = B3_MULTI
+# Seconds after which a backend request's span that nobody closed is closed
+# for them; 0 for never (but see http.MAX_OPEN_SPANS)
+client_span_max_age = 300.0
+# A rings.RingResolver that names the backend servers we make requests to,
+# if set; otherwise we guess from their ports
+ring_resolver = None
+# Where each greenthread's SpanSavingTracer is kept: in (green) thread local
+# storage, or in a ContextVar, which is much cheaper to get at
+STORAGE_THREAD_LOCAL = 'thread_local'
+STORAGE_CONTEXTVARS = 'contextvars'
+STORAGE_BACKENDS = (STORAGE_THREAD_LOCAL, STORAGE_CONTEXTVARS)
+storage = STORAGE_THREAD_LOCAL
 _tls = threading.local()  # thread local storage for a SpanSavingTracer
+_tracer_var = contextvars.ContextVar('swift_zipkin.tracer') \
+    if contextvars else None
+# Things that don't change for the life of a process (until it forks)
+_process_cache = {}
+# Beyond this many cached Endpoints, get_endpoint() just makes new ones
+MAX_CACHED_ENDPOINTS = 1024
+
+
+class LocalTrace(object):
+    """
+    The trace a local root span is sending, as seen by every copy of its
+    tracer (i.e. every greenthread working on it).  Leaf spans that only
+    stop once the root's been sent (or thrown away) are too late to go with
+    it; a LocalTrace that's `finished` sends them on their own instead, as
+    the root would have, unless the trace was tail-sampled.
+    """
+    __slots__ = ('transport_handler', 'encoder', 'tail_trace', 'finished')
+
+    def __init__(self, transport_handler, encoder, tail_trace=None):
+        self.transport_handler = transport_handler
+        self.encoder = encoder
+        self.tail_trace = tail_trace
+        self.finished = False
+
+    def send(self, span):
+        with ZipkinBatchSender(self.transport_handler, None,
+                               self.encoder) as sender:
+            sender.add_span(span)
 
 
 # TODO: see if we can get this into the upstream Tracer, including the weakref
@@ -74,28 +139,70 @@ class SpanSavingTracer(Tracer):
     """
     Like py-zipkin's Tracer, but supports accessing the "current" zipkin span
     context object.
-    None (the referent has been garbage-collected), it is discareded, and
-    another value popped.
+
+    Its two context stacks (of ZipkinAttrs and of span contexts) are linked
+    lists of (item, rest) tuples that are never changed once made, so a copy
+    handed to a new greenthread simply shares them: copying is O(1), and the
+    copy allocates nothing more until it pushes something of its own, without
+    either tracer's pushes and pops ever being seen by the other.
     """
     def __init__(self):
+        self._attrs_top = self._span_ctx_top = None
         super(SpanSavingTracer, self).__init__()
-        self._span_ctx_stack = Stack()
+        # The LocalTrace in progress, and its sampling.TailSampledTrace if
+        # it's being tail-sampled
+        self.local_trace = self.tail_trace = None
+
+    def get_zipkin_attrs(self):
+        top = self._attrs_top
+        return None if top is None else top[0]
+
+    def push_zipkin_attrs(self, ctx):
+        self._attrs_top = (ctx, self._attrs_top)
+
+    def pop_zipkin_attrs(self):
+        top = self._attrs_top
+        if top is None:
+            return None
+        self._attrs_top = top[1]
+        return top[0]
 
     def get_span_ctx(self):
-        return self._span_ctx_stack.get()
+        top = self._span_ctx_top
+        return None if top is None else top[0]
 
     def push_span_ctx(self, ctx):
-        self._span_ctx_stack.push(ctx)
+        self._span_ctx_top = (ctx, self._span_ctx_top)
 
     def pop_span_ctx(self):
-        return self._span_ctx_stack.pop()
+        top = self._span_ctx_top
+        if top is None:
+            return None
+        self._span_ctx_top = top[1]
+        return top[0]
+
+    # py_zipkin's deprecated thread_local helpers read Tracer._context_stack,
+    # so it's still there, but only as a snapshot
+    @property
+    def _context_stack(self):
+        items = []
+        top = self._attrs_top
+        while top is not None:
+            items.append(top[0])
+            top = top[1]
+        return Stack(items[::-1])
+
+    @_context_stack.setter
+    def _context_stack(self, stack):
+        self._attrs_top = None
+        for ctx in stack._storage:
+            self.push_zipkin_attrs(ctx)
 
-    # The copy handed to a new (green)thread context should have only a copy of
-    # our _span_ctx_stack as well; that way when it creates more span contexts,
-    # we don't get shared-stack-corruption.
     def copy(self):
-        the_copy = super(SpanSavingTracer, self).copy()
-        the_copy._span_ctx_stack = self._span_ctx_stack.copy()
+        # The span storage, local_trace and tail_trace are shared too, as
+        # they should be
+        the_copy = self.__class__.__new__(self.__class__)
+        the_copy.__dict__.update(self.__dict__)
         return the_copy
 
 
@@ -114,8 +221,8 @@ def has_default_tracer():
 def get_default_tracer():
     """Return the current default Tracer.
 
-    For now it'll get it from thread-local in Python 2.7 to 3.6 and from
-    contextvars since Python 3.7.
+    It's kept in green thread-local storage, or in a ContextVar once
+    set_storage(STORAGE_CONTEXTVARS) has been called.
 
     :returns: current default tracer.
     :rtype: Tracer
@@ -128,33 +235,119 @@ def get_default_tracer():
 def set_default_tracer(tracer):
     """Sets the current default Tracer.
 
-    For now it'll get it from thread-local in Python 2.7 to 3.6 and from
-    contextvars since Python 3.7.
+    It's kept in green thread-local storage, or in a ContextVar once
+    set_storage(STORAGE_CONTEXTVARS) has been called.
 
-    :returns: current default tracer.
-    :rtype: Tracer
+    :param tracer: the new default tracer
     """
     _tls.tracer = tracer
 
 
+def current_tracer():
+    """
+    :returns: the current default Tracer, or None if there isn't one yet.
+    """
+    return getattr(_tls, 'tracer', None)
+
+
+def _contextvar_has_default_tracer():
+    return _tracer_var.get(None) is not None
+
+
+def _contextvar_get_default_tracer():
+    tracer = _tracer_var.get(None)
+    if tracer is None:
+        tracer = SpanSavingTracer()
+        _tracer_var.set(tracer)
+    return tracer
+
+
+def _contextvar_set_default_tracer(tracer):
+    _tracer_var.set(tracer)
+
+
+def _contextvar_current_tracer():
+    return _tracer_var.get(None)
+
+
+_STORAGE_FUNCTIONS = {
+    STORAGE_THREAD_LOCAL: (has_default_tracer, get_default_tracer,
+                           set_default_tracer, current_tracer),
+    STORAGE_CONTEXTVARS: (_contextvar_has_default_tracer,
+                          _contextvar_get_default_tracer,
+                          _contextvar_set_default_tracer,
+                          _contextvar_current_tracer),
+}
+
+
+def set_storage(backend=None):
+    """
+    Pick where tracers are kept from now on, by rebinding
+    {has,get,set}_default_tracer and current_tracer; so do it before
+    anything hands those functions out (e.g. to py_zipkin), and before
+    anything's traced, since tracers already stored aren't moved.
+
+    Eventlet doesn't hand a greenthread's contextvars on to the greenthreads
+    it spawns, so greenthread.patch() still has to, but it's a lot less work
+    (see there).
+
+    :param backend: one of STORAGE_BACKENDS; None for STORAGE_CONTEXTVARS if
+                    this Python has them, or STORAGE_THREAD_LOCAL otherwise
+    :raises ValueError: for unknown or unavailable backends
+    """
+    global storage, has_default_tracer, get_default_tracer, \
+        set_default_tracer, current_tracer
+    if backend is None:
+        backend = STORAGE_CONTEXTVARS if contextvars else STORAGE_THREAD_LOCAL
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError('storage must be one of %s, not %r' % (
+            ', '.join(STORAGE_BACKENDS), backend))
+    if backend == STORAGE_CONTEXTVARS and not contextvars:
+        raise ValueError('contextvars storage requires Python 3.7 or later')
+    storage = backend
+    has_default_tracer, get_default_tracer, set_default_tracer, \
+        current_tracer = _STORAGE_FUNCTIONS[backend]
+
+
 class ezipkin_span(zipkin_span):
     """
     Subclass of zipkin_span that defaults some parameters and also allows
-    access to the "current" span context object via a Stack on the
+    access to the "current" span context object via a stack on the
     SpanSavingTracer instance.
 
-    It also allows adding a remote_endpoint for SERVER kinds.
+    It also allows adding a remote_endpoint for SERVER kinds, and counts
+    recorded spans per `instrumentation` (e.g. "wsgi" or "memcached") in the
+    transport's `span_counts`, if it has them.
+
+    A local root span given a `tail_sampler` records its trace provisionally;
+    when it stops, the sampling.TailSampler decides whether the trace is sent.
     """
     def __init__(self, *args, **kwargs):
-        kwargs.setdefault('transport_handler', transport.global_green_http_transport)
+        self.instrumentation = kwargs.pop('instrumentation', None)
+        self._tail_sampler = kwargs.pop('tail_sampler', None)
+        kwargs.setdefault('transport_handler', transport.global_transport)
         kwargs.setdefault('use_128bit_trace_id', True)
-        kwargs.setdefault('encoding', Encoding.V2_JSON)
+        kwargs.setdefault('encoding', encoding)
         super(ezipkin_span, self).__init__(*args, **kwargs)
         self._tracer_weak = None
 
     def start(self):
         # retval will be same as "self" but this feels a little cleaner
         retval = super(ezipkin_span, self).start()
+        # Our transports buffer individually-encoded spans and serialize them
+        # all at once when sending; give them those instead of encoded lists.
+        if (retval.logging_context and not retval.firehose_handler and
+                isinstance(retval.logging_context.transport_handler,
+                           transport.FragmentTransportHandler)):
+            retval.logging_context.encoder = transport.get_fragment_encoder(
+                retval.encoding)
+        if retval.logging_context:
+            tracer = self.get_tracer()
+            if self._tail_sampler:
+                tracer.tail_trace = TailSampledTrace(self._tail_sampler)
+            tracer.local_trace = LocalTrace(
+                retval.logging_context.transport_handler,
+                retval.logging_context.encoder, tracer.tail_trace)
         if retval.do_pop_attrs:
             self.get_tracer().push_span_ctx(retval)
             # Now that we've got a reference to this span context ("retval"),
@@ -186,11 +379,36 @@ class ezipkin_span(zipkin_span):
     def stop(self, _exc_type=None, _exc_value=None, _exc_traceback=None):
         if self.do_pop_attrs:
             self.get_tracer().pop_span_ctx()
+        if self.instrumentation and self.zipkin_attrs and \
+                self.zipkin_attrs.is_sampled:
+            span_counts = getattr(self.transport_handler, 'span_counts', None)
+            if span_counts is not None:
+                span_counts[self.instrumentation] += 1
+        if self.logging_context:
+            tracer = self.get_tracer()
+            if tracer.local_trace is not None:
+                tracer.local_trace.finished = True
+                tracer.local_trace = None
+        if self.do_pop_attrs and self.get_tracer().tail_trace:
+            if self.logging_context:
+                self._finish_tail_sampled_trace(_exc_type is not None)
+            else:
+                self.get_tracer().tail_trace.span_recorded()
 
         return super(ezipkin_span, self).stop(_exc_type=_exc_type,
                                               _exc_value=_exc_value,
                                               _exc_traceback=_exc_traceback)
 
+    def _finish_tail_sampled_trace(self, error):
+        tracer = self.get_tracer()
+        tail_trace, tracer.tail_trace = tracer.tail_trace, None
+        if not tail_trace.finish(
+                time.time() - self.start_timestamp, self.logging_context.tags,
+                tracer.get_spans(), error=error):
+            # The logging context will just throw everything away
+            self.logging_context.zipkin_attrs = \
+                self.logging_context.zipkin_attrs._replace(is_sampled=False)
+
     # TODO: see if we can get this method upstream; it'd need to be sane for V1
     # somehow.
     #
@@ -203,11 +421,17 @@ class ezipkin_span(zipkin_span):
         service_name='unknown',
         host='127.0.0.1',
     ):
-        remote_endpoint = create_endpoint(
+        self.set_remote_endpoint(create_endpoint(
             port=int(port),
             service_name=service_name,
             host=host,
-        )
+        ))
+
+    def set_remote_endpoint(self, remote_endpoint):
+        """
+        Like add_remote_endpoint(), but with an Endpoint that's already been
+        made (e.g. by get_endpoint()).
+        """
         if not self.logging_context:
             if self.remote_endpoint is not None:
                 raise ValueError('remote_endpoint already set!')
@@ -231,19 +455,70 @@ class ezipkin_span(zipkin_span):
         empty dict is returned.
 
         :returns: dict containing (X-B3-TraceId, X-B3-SpanId, X-B3-ParentSpanId,
-                    X-B3-Flags and X-B3-Sampled) or an empty dict.
+                    X-B3-Flags and X-B3-Sampled), or just b3 if b3_format is
+                    B3_SINGLE, or an empty dict.
         """
-        zipkin_attrs = self.zipkin_attrs
-        if not zipkin_attrs:
-            return {}
+        headers = {}
+        self.put_http_headers(headers.__setitem__)
+        return headers
 
-        return {
-            'X-B3-TraceId': zipkin_attrs.trace_id,
-            'X-B3-SpanId': zipkin_attrs.span_id,
-            'X-B3-ParentSpanId': zipkin_attrs.parent_span_id,
-            'X-B3-Flags': zipkin_attrs.flags,
-            'X-B3-Sampled': '1' if zipkin_attrs.is_sampled else '0',
-        }
+    def put_http_headers(self, putheader):
+        """
+        Like create_http_headers_for_my_span(), but hands the headers
+        straight to `putheader` (e.g. an HTTPConnection's) as it goes.
+        """
+        if self.zipkin_attrs:
+            # We haven't made our minds up about a tail-sampled trace, so
+            # defer the decision to the other host as well.
+            put_b3_headers(self.zipkin_attrs,
+                           self.get_tracer().tail_trace is not None,
+                           putheader)
+
+
+def put_b3_headers(zipkin_attrs, deferred, putheader):
+    """
+    Hand the B3 headers for zipkin_attrs, in b3_format, to `putheader`.
+
+    :param deferred: if True, leave the sampling decision to the receiver
+    """
+    if b3_format == B3_SINGLE:
+        putheader('b3', b3_header_value(zipkin_attrs, deferred))
+        return
+    putheader('X-B3-TraceId', zipkin_attrs.trace_id)
+    putheader('X-B3-SpanId', zipkin_attrs.span_id)
+    if zipkin_attrs.parent_span_id:
+        putheader('X-B3-ParentSpanId', zipkin_attrs.parent_span_id)
+    putheader('X-B3-Flags', zipkin_attrs.flags)
+    if not deferred:
+        putheader('X-B3-Sampled', '1' if zipkin_attrs.is_sampled else '0')
+
+
+def b3_header_value(zipkin_attrs, deferred=False):
+    """
+    :returns: the single b3 header's value for zipkin_attrs, as
+              {TraceId}-{SpanId}-{SamplingState}-{ParentSpanId}, or just
+              {TraceId}-{SpanId} if the sampling decision is deferred.
+    """
+    if deferred:
+        return '%s-%s' % (zipkin_attrs.trace_id, zipkin_attrs.span_id)
+    if zipkin_attrs.flags == '1':
+        sampled = 'd'
+    else:
+        sampled = '1' if zipkin_attrs.is_sampled else '0'
+    if zipkin_attrs.parent_span_id:
+        return '%s-%s-%s-%s' % (zipkin_attrs.trace_id, zipkin_attrs.span_id,
+                                sampled, zipkin_attrs.parent_span_id)
+    return '%s-%s-%s' % (zipkin_attrs.trace_id, zipkin_attrs.span_id,
+                         sampled)
+
+
+def unsampled_header():
+    """
+    :returns: a (name, value) header telling a backend not to sample.
+    """
+    if b3_format == B3_SINGLE:
+        return 'b3', '0'
+    return 'X-B3-Sampled', '0'
 
 
 class ezipkin_client_span(ezipkin_span, zipkin_client_span):
@@ -254,6 +529,119 @@ class ezipkin_server_span(ezipkin_span, zipkin_server_span):
     pass
 
 
+# Shared by every LeafClientSpan with no annotations or tags; never mutated
+_EMPTY = {}
+
+
+class LeafClientSpan(object):
+    """
+    A much cheaper stand-in for ezipkin_client_span, for client spans that
+    never have child spans of their own (a memcached op, a backend request).
+
+    It doesn't go on the tracer's context stacks and holds no py_zipkin
+    machinery; it's just a record with the same attributes as py_zipkin's
+    own Span, so when it stops it goes into the trace's span storage as it
+    is, and is only encoded when the local root span is sent.  Annotation
+    and tag dicts are only allocated if something's put in them.
+
+    Subclasses that time the same few moments of every span list their
+    annotations in MARKS; each span then gets a fixed list of `marks`, one
+    timestamp (or None) per name, which only become annotations when the
+    span stops.
+
+    If there's no sampled span in progress when it starts, it does nothing.
+    """
+    __slots__ = ('tracer', 'trace_id', 'name', 'parent_id', 'span_id',
+                 'timestamp', 'duration', 'local_endpoint', 'remote_endpoint',
+                 'annotations', 'tags', 'instrumentation', 'zipkin_attrs',
+                 'marks', 'trace')
+    kind = Kind.CLIENT
+    debug = False
+    shared = False
+    MARKS = ()
+
+    def __init__(self, service_name, span_name='span',
+                 binary_annotations=None, instrumentation=None):
+        self.tracer = self.trace = self.zipkin_attrs = None
+        self.remote_endpoint = None
+        self.local_endpoint = get_endpoint(0, service_name, None)
+        self.name = span_name
+        self.annotations = _EMPTY
+        self.tags = binary_annotations or _EMPTY
+        self.instrumentation = instrumentation
+        self.timestamp = self.duration = None
+        self.marks = [None] * len(self.MARKS) if self.MARKS else ()
+
+    def start(self):
+        tracer = get_default_tracer()
+        parent_attrs = tracer.get_zipkin_attrs()
+        if not parent_attrs or not parent_attrs.is_sampled:
+            return self
+        self.tracer = tracer
+        self.trace = tracer.local_trace
+        self.trace_id = parent_attrs.trace_id
+        self.parent_id = parent_attrs.span_id
+        self.span_id = generate_random_64bit_string()
+        self.zipkin_attrs = ZipkinAttrs(self.trace_id, self.span_id,
+                                        self.parent_id, parent_attrs.flags,
+                                        True)
+        self.timestamp = time.time()
+        return self
+
+    def stop(self, _exc_type=None, _exc_value=None, _exc_traceback=None):
+        tracer, self.tracer = self.tracer, None
+        if tracer is None:
+            return
+        trace, self.trace = self.trace, None
+        orphaned = trace is not None and trace.finished
+        if not orphaned and not tracer.is_transport_configured():
+            return
+        self.duration = time.time() - self.timestamp
+        for name, timestamp in zip(self.MARKS, self.marks):
+            if timestamp is not None:
+                self.add_annotation(name, timestamp)
+        if _exc_type is not None:
+            self.update_binary_annotations({
+                ERROR_KEY: '%s: %s' % (_exc_type.__name__, _exc_value)})
+        tail_trace = tracer.tail_trace if trace is None else trace.tail_trace
+        if tail_trace:
+            if tail_trace.finished:
+                return  # decided (and sent or not) without us
+            tail_trace.span_recorded()
+        if orphaned:
+            trace.send(self)
+        else:
+            tracer.add_span(self)
+        if self.instrumentation:
+            span_counts = getattr(transport.global_transport, 'span_counts',
+                                  None)
+            if span_counts is not None:
+                span_counts[self.instrumentation] += 1
+
+    __enter__ = start
+
+    def __exit__(self, _exc_type, _exc_value, _exc_traceback):
+        self.stop(_exc_type, _exc_value, _exc_traceback)
+
+    def update_binary_annotations(self, extra_annotations):
+        if self.tags is _EMPTY:
+            self.tags = {}
+        self.tags.update(extra_annotations)
+
+    def add_annotation(self, value, timestamp=None):
+        if self.annotations is _EMPTY:
+            self.annotations = {}
+        self.annotations[value] = timestamp or time.time()
+
+    def set_remote_endpoint(self, remote_endpoint):
+        self.remote_endpoint = remote_endpoint
+
+    def put_http_headers(self, putheader):
+        if self.zipkin_attrs:
+            put_b3_headers(self.zipkin_attrs,
+                           self.tracer.tail_trace is not None, putheader)
+
+
 # Convenience function to find the current span context instance and call this
 # method on it.
 def update_binary_annotations(extra_annotations):
@@ -274,5 +662,184 @@ def add_remote_endpoint(port=0, service_name='unknown', host='127.0.0.1'):
                                             host=host)
 
 
+# Any of these in a request means it's carrying a B3 sampling decision (and
+# maybe a trace context)
+B3_HEADERS = frozenset(('x-b3-traceid', 'x-b3-sampled', 'x-b3-flags', 'b3'))
+
+# should_sample decisions
+UNSAMPLED = 0
+SAMPLED = 1
+TAIL_SAMPLED = 2
+
+
+def should_sample(headers, method=None, path=None):
+    """
+    Make the sampling decision for an incoming request, before anything else
+    is done for it, so that unsampled requests cost next to nothing.
+
+    Requests that come without an upstream decision are sampled at
+    sample_rate_pct, or by the head_sampler if there is one.  In
+    tail-sampling mode, requests without an upstream sampling decision
+    are all (provisionally) TAIL_SAMPLED, room permitting.
+
+    :param headers: the request's headers
+    :param method: the request's method
+    :param path: the request's path
+    :returns: a tuple of (decision, zipkin_attrs), where decision is one of
+              UNSAMPLED, SAMPLED or TAIL_SAMPLED, and zipkin_attrs come from
+              the request's B3 headers if it had any (or else None).
+    """
+    # One pass over the names; `in` on a mimetools/email Message is a scan
+    for header in headers.keys():
+        if header.lower() in B3_HEADERS:
+            zipkin_attrs = extract_zipkin_attrs_from_headers(
+                headers, sample_rate=sample_rate_pct,
+                use_128bit_trace_id=True)
+            if zipkin_attrs is None:
+                break
+            if tail_sampler is not None and _is_deferred(headers):
+                return _tail_sample(zipkin_attrs._replace(is_sampled=True))
+            if head_sampler is not None and _is_deferred(headers):
+                is_sampled = head_sampler.sample(method, path, headers)
+                zipkin_attrs = zipkin_attrs._replace(is_sampled=is_sampled)
+            return (SAMPLED if zipkin_attrs.is_sampled else UNSAMPLED,
+                    zipkin_attrs)
+    if tail_sampler is not None:
+        return _tail_sample(None)
+    if head_sampler is not None:
+        return SAMPLED if head_sampler.sample(method, path, headers) \
+            else UNSAMPLED, None
+    if sample_rate_pct > 0 and random.random() * 100 < sample_rate_pct:
+        return SAMPLED, None
+    return UNSAMPLED, None
+
+
+def _is_deferred(headers):
+    """
+    :returns: True if the B3 headers carry a trace context but leave the
+              sampling decision to us.
+    """
+    b3 = headers.get('b3')
+    if b3 is not None:
+        return b3.count('-') == 1
+    return headers.get('X-B3-Sampled') is None and \
+        headers.get('X-B3-Flags') != '1'
+
+
+def _tail_sample(zipkin_attrs):
+    if tail_sampler.has_room():
+        return TAIL_SAMPLED, zipkin_attrs
+    tail_sampler.stats['skipped'] += 1
+    return UNSAMPLED, zipkin_attrs
+
+
+def is_sampled():
+    """
+    :returns: True if this greenthread is in the middle of a sampled span.
+    """
+    if is_unsampled():
+        return False
+    tracer = current_tracer()
+    if tracer is None:
+        return False
+    span_ctx = tracer.get_span_ctx()
+    if span_ctx is None or not span_ctx.zipkin_attrs or \
+            not span_ctx.zipkin_attrs.is_sampled:
+        return False
+    # A tail-sampled trace stops growing once its TailSampler's full
+    return tracer.tail_trace is None or tracer.tail_trace.has_room()
+
+
+def is_unsampled():
+    """
+    :returns: True if this greenthread is handling a request that we decided
+              not to trace; all that's left to do for it is to propagate the
+              decision downstream.
+    """
+    # This is checked on every patched call, so it's an attribute of the
+    # greenlet itself rather than in _tls, which is several times slower.
+    return getattr(greenlet.getcurrent(), 'zipkin_unsampled', False)
+
+
+def set_unsampled(unsampled):
+    greenlet.getcurrent().zipkin_unsampled = unsampled
+
+
+def _reset_process_cache():
+    _process_cache.clear()
+    _process_cache['pid'] = os.getpid()
+    _process_cache['endpoints'] = {}
+    # Seeded from os.urandom(), so forked workers don't share a sequence
+    _process_cache['getrandbits'] = random.Random().getrandbits
+
+
+_reset_process_cache()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_process_cache)
+
+    def _get_process_cache():
+        return _process_cache
+else:
+    def _get_process_cache():
+        if _process_cache['pid'] != os.getpid():
+            _reset_process_cache()
+        return _process_cache
+
+
 def default_service_name():
-    return os.path.basename(sys.argv[0])
+    cache = _get_process_cache()
+    try:
+        return cache['service_name']
+    except KeyError:
+        name = cache['service_name'] = os.path.basename(sys.argv[0])
+        return name
+
+
+def worker_pid():
+    """
+    :returns: this process's PID, as a string (ready to be a span tag).
+    """
+    cache = _get_process_cache()
+    try:
+        return cache['pid_str']
+    except KeyError:
+        pid = cache['pid_str'] = str(cache['pid'])
+        return pid
+
+
+def get_endpoint(port=None, service_name=None, host=None, use_defaults=True):
+    """
+    A caching py_zipkin create_endpoint(), for endpoints that come up again
+    and again: our own, and the memcached servers and backend nodes we talk
+    to.  Endpoints are namedtuples, so they're safe to share between spans.
+
+    Without a host, py_zipkin looks up this host's address -- once per span,
+    which is why patch_eventlet_and_swift() has py_zipkin use this instead.
+    """
+    key = (port, service_name, host, use_defaults)
+    endpoints = _get_process_cache()['endpoints']
+    try:
+        return endpoints[key]
+    except KeyError:
+        endpoint = create_endpoint(port, service_name, host, use_defaults)
+        if len(endpoints) < MAX_CACHED_ENDPOINTS:
+            endpoints[key] = endpoint
+        return endpoint
+
+
+def generate_random_64bit_string():
+    """
+    A faster py_zipkin generate_random_64bit_string(), from this process's
+    own PRNG.
+    """
+    return '%016x' % _get_process_cache()['getrandbits'](64)
+
+
+def generate_random_128bit_string():
+    """
+    A faster py_zipkin generate_random_128bit_string(), from this process's
+    own PRNG.  Like py_zipkin's, the upper 32 bits are the current time in
+    epoch seconds, for AWS X-Ray interop.
+    """
+    return '%08x%024x' % (int(time.time()),
+                          _get_process_cache()['getrandbits'](96))
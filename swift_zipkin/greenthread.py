@@ -39,6 +39,7 @@
 from eventlet import greenthread
 
 from swift_zipkin import api
+from swift_zipkin.api import contextvars
 
 
 __original_init__ = greenthread.GreenThread.__init__
@@ -46,13 +47,32 @@ __original_main__ = greenthread.GreenThread.main
 
 
 def _patched__init(self, parent):
-    # parent thread saves current TraceData from tls to self
-    if api.has_default_tracer():
+    # parent thread saves current TraceData from tls to self; a greenthread
+    # spawned outside of any sampled span has nothing worth copying, other
+    # than (maybe) the decision not to sample, which api.is_unsampled() looks
+    # for on the greenthread itself.  The copy shares the parent's context
+    # stacks rather than copying them (see api.SpanSavingTracer).
+    if api.is_unsampled():
+        self.zipkin_unsampled = True
+    elif api.is_sampled():
         self.zipkin_tracer = api.get_default_tracer().copy()
 
     __original_init__(self, parent)
 
 
+def _patched__init_contextvars(self, parent):
+    # With contextvars storage, the child just starts out in a Context of its
+    # own holding a copy of the tracer, so main() needn't be patched at all.
+    __original_init__(self, parent)
+
+    if api.is_unsampled():
+        self.zipkin_unsampled = True
+    elif api.is_sampled():
+        context = contextvars.Context()
+        context.run(api.set_default_tracer, api.get_default_tracer().copy())
+        self.gr_context = context
+
+
 def _patched_main(self, function, args, kwargs):
     # child thread inherits TraceData
     if hasattr(self, 'zipkin_tracer'):
@@ -66,5 +86,8 @@ def _patched_main(self, function, args, kwargs):
 
 
 def patch():
-    greenthread.GreenThread.__init__ = _patched__init
-    greenthread.GreenThread.main = _patched_main
+    if api.storage == api.STORAGE_CONTEXTVARS:
+        greenthread.GreenThread.__init__ = _patched__init_contextvars
+    else:
+        greenthread.GreenThread.__init__ = _patched__init
+        greenthread.GreenThread.main = _patched_main
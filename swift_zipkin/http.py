@@ -36,75 +36,253 @@
 #  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #  THE SOFTWARE.
+import collections
+import sys
+import time
+import weakref
+
+import eventlet
 from eventlet.green import httplib
 
-from swift_zipkin import api
+from swift_zipkin import api, transport
 
 
 __org_endheaders__ = httplib.HTTPConnection.endheaders
+__org_connect__ = httplib.HTTPConnection.connect
+__org_send__ = httplib.HTTPConnection.send
 __org_conn_close__ = httplib.HTTPConnection.close
-__org_begin__ = httplib.HTTPResponse.begin
+__org_getresponse__ = httplib.HTTPConnection.getresponse
+__org_read_status__ = httplib.HTTPResponse._read_status
 __org_resp_close__ = httplib.HTTPResponse.close
+HTTPSConnection = getattr(httplib, 'HTTPSConnection', None)  # if we have ssl
+if HTTPSConnection:
+    __org_tls_connect__ = HTTPSConnection.connect
 
 
-# tracks fd => [span_ctx, should-stop-in-HTTPConnection.close]
-_span_contexts_by_fd = {}
+class HttpClientSpan(api.LeafClientSpan):
+    """
+    A backend request's span, which times the steps of the request.
+    """
+    __slots__ = ('__weakref__',)
+    MARKS = ('Connect start', 'Connected', 'TLS handshake done',
+             'Headers sent', 'Body sent', 'First response byte',
+             'Response headers received')
 
 
-def _patched_endheaders(self):
-    # self is a HTTPConnection
-    if api.has_default_tracer():
-        span_ctx = api.ezipkin_client_span(
-            api.default_service_name(), span_name=self._method,
-            binary_annotations={'http.uri': self.path},
-        )
-        span_ctx.start()
-
-        remote_service_name = 'unknown'
-        try:
-            path_bits = self.path.split('/', 5)[1:]
-            if path_bits[0].startswith('d') and path_bits[0][1:].isdigit():
-                if self.port in (6002, 6005):
-                    remote_service_name = 'swift-account-server'
-                elif self.port in (6001, 6004):
-                    remote_service_name = 'swift-container-server'
-                else:
-                    remote_service_name = 'swift-object-server'
-        except Exception:
-            pass
-        span_ctx.add_remote_endpoint(host=self.host, port=self.port,
-                                     service_name=remote_service_name)
-        b3_headers = span_ctx.create_http_headers_for_my_span()
-        for h, v in b3_headers.items():
-            self.putheader(h, v)
-
-    __org_endheaders__(self)
-
-    if api.has_default_tracer():
-        span_ctx._fd_key = self.sock.fileno()
-        _span_contexts_by_fd[span_ctx._fd_key] = [span_ctx, True]
-
-
-def _patched_begin(self):
-    # self is a HTTPResponse
-    __org_begin__(self)
-
-    if api.has_default_tracer():
-        span_data = _span_contexts_by_fd[self.fp.fileno()]
-        self._zipkin_span = span_ctx = span_data[0]
-        span_ctx.update_binary_annotations({"http.status_code": self.status})
-        span_ctx.add_annotation('Response headers received')
-
-        # If we were a HEAD, go ahead and do the close here; should be safe if
-        # the client does it too since it's idempotent, I think.  There were
-        # definitely some cases where _no one_ called our self.close() and the
-        # span was left dangling.
-        if self._method == "HEAD":
-            self.close()
+# Indexes into HttpClientSpan.marks
+CONNECT_START, CONNECTED, TLS_DONE, HEADERS_SENT, BODY_SENT, FIRST_BYTE, \
+    HEADERS_RECEIVED = range(len(HttpClientSpan.MARKS))
+
+# Each span lives on its HTTPConnection as _zipkin_span until getresponse()
+# hands it to the HTTPResponse, and is stopped by HTTPResponse.close() or, if
+# no response ever began, HTTPConnection.close().  A span whose connection or
+# response is thrown away unclosed goes with it (an HTTPResponse closes itself
+# as it goes), but one that's abandoned yet kept would stay open forever, so
+# every open span is also registered here, weakly and oldest first, and
+# force-closed once it's older than api.client_span_max_age (if that's set)
+# or there are more than MAX_OPEN_SPANS of them.  That's checked as each span
+# opens and, so a worker that's gone quiet doesn't keep them forever, every
+# REAP_INTERVAL seconds by a greenthread that runs while any are open.
+MAX_OPEN_SPANS = 10000
+REAP_INTERVAL = 10.0
+_open_spans = collections.OrderedDict()  # weakref to span => None
+_reaper = None
+
+
+def _forget(span_ref):
+    _open_spans.pop(span_ref, None)
+
+
+def _is_open(span_ctx):
+    return weakref.ref(span_ctx) in _open_spans
+
+
+def _finish(span_ctx, *exc_info):
+    span_ref = weakref.ref(span_ctx)
+    if span_ref not in _open_spans:
+        return  # already stopped (or reaped)
+    del _open_spans[span_ref]
+    span_ctx.stop(*exc_info)
+
+
+def _force_close(span_ctx, reason):
+    if not _is_open(span_ctx):
+        return
+    span_ctx.add_annotation('Force-closed: %s' % reason)
+    _finish(span_ctx)
+    stats = getattr(transport.global_transport, 'stats', None)
+    if stats is not None:
+        stats['reaped'] = stats.get('reaped', 0) + 1
+
+
+def _reap(now):
+    """
+    Force-close the oldest open spans while they're too old or too many.
+    """
+    while _open_spans:
+        span_ref = next(iter(_open_spans))
+        span_ctx = span_ref()
+        if span_ctx is None:
+            _forget(span_ref)
+        elif len(_open_spans) >= MAX_OPEN_SPANS:
+            _force_close(span_ctx, 'too many open spans')
+        elif api.client_span_max_age and \
+                now - span_ctx.timestamp > api.client_span_max_age:
+            _force_close(span_ctx, 'older than %gs' % api.client_span_max_age)
         else:
-            # We're not timing out, so make sure the call to
-            # HTTPConnection.close() doesn't close the span.
-            span_data[1] = False
+            return
+
+
+def _gt_reaper():
+    global _reaper
+    try:
+        while _open_spans:
+            eventlet.sleep(REAP_INTERVAL)
+            _reap(time.time())
+    finally:
+        _reaper = None
+
+
+def _remote_service(host, port, path):
+    """
+    :returns: the name of the service at host:port that path's going to, and
+              any tags about it to put on the span (or None)
+    """
+    path_bits = path.split('/', 2)
+    device = path_bits[1] if len(path_bits) > 1 else ''
+    if api.ring_resolver is not None:
+        service = api.ring_resolver.get(host, port, device)
+        if service:
+            return service
+    # Otherwise guess, from swift's default ports
+    if device.startswith('d') and device[1:].isdigit():
+        if port in (6002, 6005):
+            return 'swift-account-server', None
+        elif port in (6001, 6004):
+            return 'swift-container-server', None
+        return 'swift-object-server', None
+    return 'unknown', None
+
+
+def _patched_endheaders(self, *args, **kwargs):
+    # self is a HTTPConnection
+    global _reaper
+    if api.is_unsampled():
+        self.putheader(*api.unsampled_header())
+        return __org_endheaders__(self, *args, **kwargs)
+    if not api.is_sampled():
+        return __org_endheaders__(self, *args, **kwargs)
+
+    span_ctx = HttpClientSpan(
+        api.default_service_name(), span_name=self._method,
+        binary_annotations={'http.uri': self.path},
+        instrumentation='http',
+    ).start()
+    if span_ctx.zipkin_attrs is None:
+        return __org_endheaders__(self, *args, **kwargs)
+
+    try:
+        remote_service_name, tags = _remote_service(
+            self.host, self.port, self.path)
+    except Exception:
+        remote_service_name, tags = 'unknown', None
+    if tags:
+        span_ctx.update_binary_annotations(tags)
+    span_ctx.set_remote_endpoint(api.get_endpoint(
+        int(self.port), remote_service_name, self.host))
+    span_ctx.put_http_headers(self.putheader)
+
+    stale = getattr(self, '_zipkin_span', None)
+    if stale is not None:
+        # A request whose response we never asked for
+        _force_close(stale, 'connection reused')
+    # Set first, since this is usually what connects
+    self._zipkin_span = span_ctx
+    try:
+        __org_endheaders__(self, *args, **kwargs)
+    except Exception:
+        del self._zipkin_span
+        span_ctx.stop(*sys.exc_info())
+        raise
+
+    _reap(span_ctx.timestamp)
+    _open_spans[weakref.ref(span_ctx, _forget)] = None
+    if _reaper is None:
+        # spawn_n, so it doesn't take our tracer with it
+        _reaper = eventlet.spawn_n(_gt_reaper)
+
+
+def _open_span(conn):
+    # The span of the request conn is sending, if it's sampled
+    span_ctx = getattr(conn, '_zipkin_span', None)
+    if span_ctx is not None and span_ctx.tracer is not None:
+        return span_ctx
+
+
+def _patched_connect(self):
+    # self is a HTTPConnection
+    span_ctx = _open_span(self)
+    if span_ctx is None:
+        return __org_connect__(self)
+    span_ctx.marks[CONNECT_START] = time.time()
+    __org_connect__(self)
+    span_ctx.marks[CONNECTED] = time.time()
+
+
+def _patched_tls_connect(self):
+    # self is a HTTPSConnection; it calls HTTPConnection.connect itself
+    __org_tls_connect__(self)
+    span_ctx = _open_span(self)
+    if span_ctx is not None:
+        span_ctx.marks[TLS_DONE] = time.time()
+
+
+def _patched_send(self, data):
+    # self is a HTTPConnection; the first send is the headers
+    __org_send__(self, data)
+    span_ctx = _open_span(self)
+    if span_ctx is not None:
+        marks = span_ctx.marks
+        marks[BODY_SENT if marks[HEADERS_SENT] else HEADERS_SENT] = \
+            time.time()
+
+
+def _patched_read_status(self):
+    # self is a HTTPResponse; called as the status line comes in, before
+    # getresponse() can tell it whose response it is
+    status = __org_read_status__(self)
+    if _open_spans:
+        self._zipkin_first_byte = time.time()
+    return status
+
+
+def _patched_getresponse(self):
+    # self is a HTTPConnection
+    span_ctx = getattr(self, '_zipkin_span', None)
+    if span_ctx is None:
+        return __org_getresponse__(self)
+    # Take it off first: a failed getresponse() closes the connection, and
+    # we'd rather the span record why
+    del self._zipkin_span
+    try:
+        response = __org_getresponse__(self)
+    except Exception:
+        _finish(span_ctx, *sys.exc_info())
+        raise
+
+    # From here on it's the response's to close, not the connection's
+    response._zipkin_span = span_ctx
+    span_ctx.update_binary_annotations({"http.status_code": response.status})
+    span_ctx.marks[FIRST_BYTE] = getattr(response, '_zipkin_first_byte', None)
+    span_ctx.marks[HEADERS_RECEIVED] = time.time()
+
+    # If we were a HEAD, go ahead and do the close here; should be safe if
+    # the client does it too since it's idempotent, I think.  There were
+    # definitely some cases where _no one_ called our self.close() and the
+    # span was left dangling.
+    if response._method == "HEAD":
+        response.close()
+    return response
 
 
 def _patched_resp_close(self):
@@ -113,27 +291,28 @@ def _patched_resp_close(self):
 
     span_ctx = getattr(self, '_zipkin_span', None)
     if span_ctx:
-        span_ctx.stop()
         del self._zipkin_span
-        del _span_contexts_by_fd[span_ctx._fd_key]
+        _finish(span_ctx)
 
 
 def _patched_conn_close(self):
     # self is a HTTPConnection
-    sock = self.sock
-    span_ctx = None
-    if sock and api.has_default_tracer() and sock.fileno() in _span_contexts_by_fd:
-        span_ctx, should_stop_in_conn_close = _span_contexts_by_fd[sock.fileno()]
-
     __org_conn_close__(self)
 
-    if span_ctx and should_stop_in_conn_close:
-        span_ctx.stop()
-        del _span_contexts_by_fd[span_ctx._fd_key]
+    span_ctx = getattr(self, '_zipkin_span', None)
+    if span_ctx:
+        # No response was asked for
+        del self._zipkin_span
+        _finish(span_ctx)
 
 
 def patch():
     httplib.HTTPConnection.endheaders = _patched_endheaders
+    httplib.HTTPConnection.connect = _patched_connect
+    httplib.HTTPConnection.send = _patched_send
     httplib.HTTPConnection.close = _patched_conn_close
-    httplib.HTTPResponse.begin = _patched_begin
+    httplib.HTTPConnection.getresponse = _patched_getresponse
+    httplib.HTTPResponse._read_status = _patched_read_status
     httplib.HTTPResponse.close = _patched_resp_close
+    if HTTPSConnection:
+        HTTPSConnection.connect = _patched_tls_connect
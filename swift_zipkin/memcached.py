@@ -57,9 +57,8 @@ __org_get_multi__ = memcached.MemcacheRing.get_multi
 def add_remote_endpoint(zipkin_span, server):
     server_host, server_port = memcached.utils.parse_socket_string(
         server, memcached.DEFAULT_MEMCACHED_PORT)
-    zipkin_span.add_remote_endpoint(port=int(server_port),
-                                    host=server_host,
-                                    service_name='memcached')
+    zipkin_span.set_remote_endpoint(api.get_endpoint(
+        int(server_port), 'memcached', server_host))
 
 
 # Okay, so fine.  This is pretty gross, inlining basically all of the memcached
@@ -90,6 +89,10 @@ def _set(self, key, value, serialize=True, time=0,
                                 python-memcached interface. This
                                 implementation ignores it.
     """
+    if not api.is_sampled():
+        return __org_set__(self, key, value, serialize=serialize, time=time,
+                           min_compress_len=min_compress_len)
+
     orig_key = key
     key = memcached.md5hash(key)
     timeout = memcached.sanitize_timeout(time)
@@ -106,12 +109,13 @@ def _set(self, key, value, serialize=True, time=0,
         value = str(value).encode('utf-8')
 
     for (server, fp, sock) in self._get_conns(key):
-        with api.ezipkin_client_span(
+        with api.LeafClientSpan(
             api.default_service_name(),
             span_name='set',
             binary_annotations={
                 "memcached.key": orig_key,
             },
+            instrumentation='memcached',
         ) as zipkin_span:
             add_remote_endpoint(zipkin_span, server)
             try:
@@ -134,16 +138,20 @@ def _get(self, key):
     :param key: key
     :returns: value of the key in memcache
     """
+    if not api.is_sampled():
+        return __org_get__(self, key)
+
     orig_key = key
     key = memcached.md5hash(key)
     value = None
     for (server, fp, sock) in self._get_conns(key):
-        with api.ezipkin_client_span(
+        with api.LeafClientSpan(
             api.default_service_name(),
             span_name='get',
             binary_annotations={
                 "memcached.key": orig_key,
             },
+            instrumentation='memcached',
         ) as zipkin_span:
             add_remote_endpoint(zipkin_span, server)
             try:
@@ -191,6 +199,9 @@ def _incr(self, key, delta=1, time=0):
     :returns: result of incrementing
     :raises MemcacheConnectionError:
     """
+    if not api.is_sampled():
+        return __org_incr__(self, key, delta=delta, time=time)
+
     orig_key = key
     key = memcached.md5hash(key)
     command = b'incr'
@@ -203,12 +214,13 @@ def _incr(self, key, delta=1, time=0):
     else:
         span_name = 'decr'
     for (server, fp, sock) in self._get_conns(key):
-        with api.ezipkin_client_span(
+        with api.LeafClientSpan(
             api.default_service_name(),
             span_name=span_name,
             binary_annotations={
                 "memcached.key": orig_key,
             },
+            instrumentation='memcached',
         ) as zipkin_span:
             add_remote_endpoint(zipkin_span, server)
             try:
@@ -266,15 +278,19 @@ def _delete(self, key):
 
     :param key: key to be deleted
     """
+    if not api.is_sampled():
+        return __org_delete__(self, key)
+
     orig_key = key
     key = memcached.md5hash(key)
     for (server, fp, sock) in self._get_conns(key):
-        with api.ezipkin_client_span(
+        with api.LeafClientSpan(
             api.default_service_name(),
             span_name='delete',
             binary_annotations={
                 "memcached.key": orig_key,
             },
+            instrumentation='memcached',
         ) as zipkin_span:
             add_remote_endpoint(zipkin_span, server)
             try:
@@ -305,6 +321,11 @@ def _set_multi(self, mapping, server_key, serialize=True, time=0,
                         python-memcached interface. This implementation
                         ignores it
     """
+    if not api.is_sampled():
+        return __org_set_multi__(self, mapping, server_key,
+                                 serialize=serialize, time=time,
+                                 min_compress_len=min_compress_len)
+
     orig_key = server_key
     server_key = memcached.md5hash(server_key)
     timeout = memcached.sanitize_timeout(time)
@@ -322,13 +343,14 @@ def _set_multi(self, mapping, server_key, serialize=True, time=0,
             flags |= memcached.JSON_FLAG
         msg.append(memcached.set_msg(key, flags, timeout, value))
     for (server, fp, sock) in self._get_conns(server_key):
-        with api.ezipkin_client_span(
+        with api.LeafClientSpan(
             api.default_service_name(),
             span_name='set_multi',
             binary_annotations={
                 "memcached.key": orig_key,
                 "memcached.keys": ",".join(mapping),
             },
+            instrumentation='memcached',
         ) as zipkin_span:
             add_remote_endpoint(zipkin_span, server)
             try:
@@ -352,18 +374,22 @@ def _get_multi(self, keys, server_key):
                         is used
     :returns: list of values
     """
+    if not api.is_sampled():
+        return __org_get_multi__(self, keys, server_key)
+
     orig_key = server_key
     orig_keys = keys
     server_key = memcached.md5hash(server_key)
     keys = [memcached.md5hash(key) for key in keys]
     for (server, fp, sock) in self._get_conns(server_key):
-        with api.ezipkin_client_span(
+        with api.LeafClientSpan(
             api.default_service_name(),
             span_name='get_multi',
             binary_annotations={
                 "memcached.key": orig_key,
                 "memcached.keys": ",".join(orig_keys),
             },
+            instrumentation='memcached',
         ) as zipkin_span:
             add_remote_endpoint(zipkin_span, server)
             try:
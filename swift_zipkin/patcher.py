@@ -37,19 +37,29 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #  THE SOFTWARE.
 import py_zipkin.instrumentations.python_threads
+import py_zipkin.request_helpers
 import py_zipkin.storage
 import py_zipkin.thread_local
+import py_zipkin.util
+import py_zipkin.zipkin
+from py_zipkin.encoding import Encoding
 
 from swift_zipkin import api, wsgi, http, greenthread, memcached, transport
 
 
 def patch_eventlet_and_swift(logger, zipkin_host='127.0.0.1', zipkin_port=9411,
-                             sample_rate=1.0, flush_size=2**20, flush_sec=2.0):
+                             sample_rate=1.0, flush_size=2**20, flush_sec=2.0,
+                             forward_address=None, tail_sampler=None,
+                             head_sampler=None, throughput_interval=0,
+                             b3_format=api.B3_MULTI,
+                             client_span_max_age=300.0,
+                             ring_resolver=None, storage=None,
+                             **transport_options):
     """
     Monkey patch eventlet and swift for Zipkin distributed tracing.
 
-    The "Zipkin server" can be anything that accepts Zipkin V2 JSON protocol
-    HTTP POSTs to /api/v2/spans
+    The "Zipkin server" can be anything that accepts Zipkin V2 JSON (or proto3)
+    protocol HTTP POSTs to /api/v2/spans
 
     :param logger: logger for logging things; passed to the transport
     :param host: Zipkin server IP address (default: '127.0.0.1')
@@ -60,10 +70,35 @@ def patch_eventlet_and_swift(logger, zipkin_host='127.0.0.1', zipkin_port=9411,
         If you specify 0.1, each root trace (client WSGI request) has only a
         10% chance of actually getting traced. (default: 1.0)
     :param flush_size: flush when buffer is greater than this number of bytes
-    :param flush_sec: flush every X seconds, regardless of buffer size
+    :param flush_sec: flush every X seconds, regardless of buffer size (when
+        forwarding, this is just how often metrics are reported)
+    :param forward_address: if set, spans are not POSTed to the Zipkin server
+        but forwarded to a swift-zipkin-aggregator listening on this
+        "unix:///path" or "udp://host:port" address
+    :param tail_sampler: if set, a sampling.TailSampler that picks which
+        locally-rooted traces to send once they're finished, instead of
+        sample_rate picking them up front
+    :param head_sampler: if set, an object whose sample(method, path,
+        headers) method replaces sample_rate (e.g. a
+        sampling.RateLimitingSampler)
+    :param throughput_interval: if set, annotate server spans with progress
+        every this many seconds while their responses stream out
+    :param b3_format: 'multi' to propagate trace context to backends in the
+        X-B3-* headers, or 'single' for the one b3 header
+    :param client_span_max_age: backend request spans that are still open
+        after this many seconds (because their connection or response was
+        never closed) are closed for them
+    :param ring_resolver: if set, a rings.RingResolver to name the backend
+        servers requests go to (instead of guessing from their ports) and tag
+        their spans with the device, region and zone; it's started here
+    :param storage: where each greenthread's tracer is kept: 'contextvars'
+        or 'thread_local' (default: contextvars if this Python has them)
+    :param transport_options: any other GreenHttpTransport options, such as
+        max_buffer_size, drop_policy, compression or encoding
     """
     # Overwrite py_zipkin.storage get/set_default_tracer functions with our
-    # greenthread-aware functions.
+    # greenthread-aware functions (for the storage we pick first).
+    api.set_storage(storage)
     py_zipkin.storage.set_default_tracer = api.set_default_tracer
     py_zipkin.storage.get_default_tracer = api.get_default_tracer
     py_zipkin.storage.has_default_tracer = api.has_default_tracer
@@ -71,11 +106,38 @@ def patch_eventlet_and_swift(logger, zipkin_host='127.0.0.1', zipkin_port=9411,
     py_zipkin.thread_local.get_default_tracer = api.get_default_tracer
     py_zipkin.instrumentations.python_threads.get_default_tracer = api.get_default_tracer
     py_zipkin.get_default_tracer = api.get_default_tracer
+    # Spans' local endpoints don't change, so stop building them every time
+    py_zipkin.zipkin.create_endpoint = api.get_endpoint
+    # ...and generate IDs faster, from a PRNG that's reseeded after forking
+    for module in (py_zipkin.util, py_zipkin.zipkin,
+                   py_zipkin.request_helpers):
+        module.generate_random_64bit_string = \
+            api.generate_random_64bit_string
+    py_zipkin.util.generate_random_128bit_string = \
+        api.generate_random_128bit_string
 
     # py_zipkin uses 0-100% for sample-rate, so convert here
     api.sample_rate_pct = sample_rate * 100.0
-    transport.GreenHttpTransport.init_singleton(
-        logger, zipkin_host, zipkin_port, flush_size, flush_sec)
+    api.tail_sampler = tail_sampler
+    api.head_sampler = head_sampler
+    api.throughput_interval = throughput_interval
+    api.b3_format = b3_format
+    api.client_span_max_age = client_span_max_age
+    api.ring_resolver = ring_resolver
+    if ring_resolver is not None:
+        ring_resolver.start()
+    transport_options.setdefault('flush_threshold_size', flush_size)
+    transport_options.setdefault('flush_threshold_sec', flush_sec)
+    encoding = transport_options.get('encoding', Encoding.V2_JSON)
+    api.encoding = transport_options['encoding'] = transport.ENCODINGS.get(
+        encoding, encoding)
+    if forward_address:
+        transport.GreenSocketTransport.init_singleton(
+            logger, forward_address, encoding=api.encoding,
+            report_interval=flush_sec)
+    else:
+        transport.GreenHttpTransport.init_singleton(
+            logger, zipkin_host, zipkin_port, **transport_options)
 
     wsgi.patch()
     http.patch()
@@ -0,0 +1,175 @@
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Contains concepts originally found in Eventlet, covered by the MIT software
+# license.  The Eventlet license:
+#  Copyright (c) 2005-2006, Bob Ippolito
+#  Copyright (c) 2007-2010, Linden Research, Inc.
+#  Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+"""
+Naming the backend servers that requests go to, from Swift's rings.
+"""
+import glob
+import os
+import re
+import sys
+
+import eventlet
+from eventlet import tpool
+from swift.common.ring import RingData
+
+
+RING_SERVICES = {
+    'account': 'swift-account-server',
+    'container': 'swift-container-server',
+    'object': 'swift-object-server',
+}
+_ring_name = re.compile(r'^(account|container|object)(?:-(\d+))?\.ring\.gz$')
+
+
+class RingResolver(object):
+    """
+    Finds out which server a backend request is going to by looking up its
+    (ip, port, device) in an index built from every ring in `swift_dir`.
+
+    Each entry is the service's name and the tags (device, region and zone,
+    and storage policy for object servers) to put on the request's span, so
+    naming a span is a single dict lookup.  Devices are indexed under their
+    replication ip and port as well.  `start` loads the rings; after that, a
+    greenthread of ours checks every `check_interval` seconds whether any
+    ring file's mtime has changed, and if so reloads the rings (in eventlet's
+    tpool, off the hub) and swaps in a new index.
+    """
+    def __init__(self, swift_dir='/etc/swift', check_interval=15.0,
+                 logger=None):
+        self.swift_dir = swift_dir
+        self.check_interval = check_interval
+        self.logger = logger
+        self._mtimes = {}
+        self._index = {}
+        self._reloader = None
+
+    def start(self):
+        """
+        Load the rings now, and keep them up to date from here on.  Call it
+        in the process that'll use it (i.e. after forking).
+        """
+        self.reload()
+        if self._reloader is None and self.check_interval:
+            self._reloader = eventlet.spawn_n(self._gt_reloader)
+
+    def stop(self):
+        reloader, self._reloader = self._reloader, None
+        if reloader is not None:
+            eventlet.kill(reloader)
+
+    def get(self, ip, port, device):
+        """
+        :returns: a (service name, tags) tuple for requests to `device` at
+                  `ip`:`port`, or None if it's in no ring.
+        """
+        return self._index.get((ip, port, device))
+
+    def reload(self):
+        """
+        Rebuild the index if any ring file has come, gone or changed since
+        we last looked.
+        """
+        self._apply(self._scan())
+
+    def _gt_reloader(self):
+        while True:
+            eventlet.sleep(self.check_interval)
+            try:
+                self._apply(tpool.execute(self._scan))
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Error checking rings in %s',
+                                          self.swift_dir)
+
+    def _apply(self, scanned):
+        mtimes, index, errors = scanned
+        if self.logger:
+            for path, exc_info in errors:
+                self.logger.error('Error loading ring %s', path,
+                                  exc_info=exc_info)
+        if index is not None:
+            self._index = index
+            self._mtimes = mtimes
+
+    def _scan(self):
+        """
+        May run in a tpool thread, so it leaves everything but reading
+        self._mtimes to _apply.
+
+        :returns: a tuple of the rings' mtimes, the new index (or None if
+                  nothing's changed) and a list of (path, exc_info) for the
+                  rings that wouldn't load.
+        """
+        mtimes = {}
+        for path in glob.glob(os.path.join(self.swift_dir, '*.ring.gz')):
+            if _ring_name.match(os.path.basename(path)):
+                try:
+                    mtimes[path] = os.path.getmtime(path)
+                except OSError:
+                    pass  # deleted as we looked
+        if mtimes == self._mtimes:
+            return mtimes, None, []
+        index = {}
+        errors = []
+        for path in sorted(mtimes):
+            try:
+                devs = RingData.load(path, metadata_only=True).devs
+            except Exception:
+                errors.append((path, sys.exc_info()))
+                # Try again next time
+                mtimes[path] = None
+                continue
+            ring_type, policy = _ring_name.match(
+                os.path.basename(path)).groups()
+            service_name = RING_SERVICES[ring_type]
+            for dev in devs:
+                if not dev:
+                    continue
+                tags = {'swift.device': dev['device'],
+                        'swift.region': str(dev.get('region', 1)),
+                        'swift.zone': str(dev['zone'])}
+                if ring_type == 'object':
+                    tags['swift.storage_policy'] = policy or '0'
+                entry = (service_name, tags)
+                index[(dev['ip'], dev['port'], dev['device'])] = entry
+                index.setdefault((
+                    dev.get('replication_ip', dev['ip']),
+                    dev.get('replication_port', dev['port']),
+                    dev['device']), entry)
+        return mtimes, index, errors
@@ -0,0 +1,335 @@
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Contains concepts originally found in Eventlet, covered by the MIT software
+# license.  The Eventlet license:
+#  Copyright (c) 2005-2006, Bob Ippolito
+#  Copyright (c) 2007-2010, Linden Research, Inc.
+#  Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+"""
+Sampling policies beyond api.sample_rate_pct's plain head sampling.
+"""
+import random
+import re
+import time
+
+
+SAMPLING_HEAD = 'head'
+SAMPLING_TAIL = 'tail'
+SAMPLING_ADAPTIVE = 'adaptive'
+SAMPLING_MODES = (SAMPLING_HEAD, SAMPLING_TAIL, SAMPLING_ADAPTIVE)
+
+ERROR_KEY = 'error'
+STATUS_CODE_KEY = 'http.status_code'
+
+DEPTH_ACCOUNT = 'account'
+DEPTH_CONTAINER = 'container'
+DEPTH_OBJECT = 'object'
+DEPTHS = (DEPTH_ACCOUNT, DEPTH_CONTAINER, DEPTH_OBJECT)
+SAMPLING_RULE_PREFIX = 'zipkin_sampling_rule_'
+_is_api_version = re.compile(r'v\d').match
+
+
+class TailSampler(object):
+    """
+    Decides whether to send a trace after it's finished, rather than before
+    it's started.
+
+    In tail-sampling mode, every locally-rooted trace is recorded
+    provisionally: its spans wait in the trace's span storage (as they always
+    do until the root span stops) and, once the root stops, `should_keep`
+    decides whether they're sent or thrown away.  Traces are kept if:
+
+    * the root took at least `latency_threshold` seconds (0 to not care);
+    * the root's http.status_code is a 5xx;
+    * any span has an "error" tag (including the root raising); or
+    * they're in the random `baseline_rate` fraction of everything else.
+
+    No more than `max_pending_spans` spans are held, across all the traces in
+    progress in this worker; past that, new requests aren't traced at all and
+    traces in progress stop recording new spans.
+    """
+    def __init__(self, latency_threshold=1.0, baseline_rate=0.01,
+                 max_pending_spans=10000):
+        self.latency_threshold = latency_threshold
+        self.baseline_rate = baseline_rate
+        self.max_pending_spans = max_pending_spans
+        self.pending_spans = 0
+        self.stats = {'kept': 0, 'discarded': 0, 'skipped': 0}
+
+    def has_room(self):
+        return self.pending_spans < self.max_pending_spans
+
+    def span_recorded(self):
+        self.pending_spans += 1
+
+    def should_keep(self, duration, tags, spans, error=False):
+        """
+        :param duration: how long the root span took, in seconds
+        :param tags: the root span's tags
+        :param spans: the trace's other (py_zipkin) Spans
+        :param error: True if the root span raised
+        """
+        if error or ERROR_KEY in tags:
+            return True
+        try:
+            if int(tags.get(STATUS_CODE_KEY, 0)) >= 500:
+                return True
+        except ValueError:
+            pass
+        if self.latency_threshold and duration >= self.latency_threshold:
+            return True
+        for span in spans:
+            if span.tags and ERROR_KEY in span.tags:
+                return True
+        return random.random() < self.baseline_rate
+
+    def finish_trace(self, duration, tags, spans, error=False):
+        """
+        Account for a finished trace and decide its fate.
+
+        :returns: True if the trace should be sent.
+        """
+        self.pending_spans = max(self.pending_spans - len(spans), 0)
+        keep = self.should_keep(duration, tags, spans, error)
+        self.stats['kept' if keep else 'discarded'] += 1
+        return keep
+
+
+class TailSampledTrace(object):
+    """
+    A trace in progress that `sampler` will decide the fate of.  Every copy of
+    the trace's tracer (i.e. every greenthread working on it) shares this, so
+    once the root span finishes the trace, spans that stop late aren't counted
+    against the sampler: there'd be nothing to ever take them off again.
+    """
+    __slots__ = ('sampler',)
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    @property
+    def finished(self):
+        return self.sampler is None
+
+    def has_room(self):
+        return self.sampler is not None and self.sampler.has_room()
+
+    def span_recorded(self):
+        if self.sampler is not None:
+            self.sampler.span_recorded()
+
+    def finish(self, duration, tags, spans, error=False):
+        """
+        See TailSampler.finish_trace; the trace stops counting spans after.
+        """
+        sampler, self.sampler = self.sampler, None
+        return sampler.finish_trace(duration, tags, spans, error)
+
+
+class RateLimitingSampler(object):
+    """
+    A head sampler that aims for `target` traces per second (in this worker)
+    however much traffic there is.
+
+    Once a second or so, it updates an exponentially-weighted moving average
+    of the request rate, and samples each request with probability
+    target / average rate.  On top of that a token bucket (refilled at
+    `target` per second, holding up to `burst` tokens) makes sure a sudden
+    spike can't get more than `burst` traces past the average.
+    """
+    # Weight of the latest second in the request-rate average
+    alpha = 0.3
+    interval = 1.0
+
+    def __init__(self, target, burst=None):
+        self.target = float(target)
+        self.burst = max(float(burst or target), 1.0)
+        self.probability = 1.0
+        self.request_rate = None
+        self.tokens = self.burst
+        self._requests = 0
+        self._window_start = self._last_refill = time.time()
+
+    def sample(self, method=None, path=None, headers=None):
+        """
+        :returns: True if a request should be traced.
+        """
+        now = time.time()
+        self._requests += 1
+        if now - self._window_start >= self.interval:
+            self._adjust(now)
+        if self.probability < 1.0 and random.random() >= self.probability:
+            return False
+        self.tokens = min(self.burst, self.tokens + (
+            now - self._last_refill) * self.target)
+        self._last_refill = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+    def _adjust(self, now):
+        rate = self._requests / (now - self._window_start)
+        if self.request_rate is None:
+            self.request_rate = rate
+        else:
+            self.request_rate += self.alpha * (rate - self.request_rate)
+        self.probability = min(1.0, self.target / self.request_rate) \
+            if self.request_rate else 1.0
+        self._requests = 0
+        self._window_start = now
+
+
+def _path_depth(path):
+    """
+    :returns: 'account', 'container' or 'object' for a swift API
+              (/v1/a/c/o) or backend (/dev/part/a/c/o) path, or else None.
+    """
+    parts = path.split('?', 1)[0].split('/', 5)
+    # ['', 'v1', 'a', 'c', 'o'] or ['', 'sda1', '1', 'a', 'c', 'o']
+    start = 2 if len(parts) > 1 and _is_api_version(parts[1]) else 3
+    depth = len(parts) - start
+    if depth < 1 or not parts[start]:
+        return None
+    return DEPTHS[min(depth, 3) - 1]
+
+
+class SamplingRule(object):
+    """
+    One row of a RuleSampler's table: requests matching every criterion
+    given are sampled at `rate`.
+
+    :param rate: the sample rate, 0.0 to 1.0
+    :param methods: if set, an iterable of (upper-case) methods to match
+    :param depth: if set, 'account', 'container' or 'object'
+    :param path: if set, a regex that must match the start of the path
+    :param user_agent: if set, a regex searched for in the User-Agent
+    :param header: if set, a header the request must have
+    """
+    def __init__(self, rate, methods=None, depth=None, path=None,
+                 user_agent=None, header=None):
+        if depth is not None and depth not in DEPTHS:
+            raise ValueError('Sampling rule depth must be one of %s' % (
+                ', '.join(DEPTHS),))
+        self.rate = rate
+        self.methods = frozenset(methods) if methods else None
+        self.depth = depth
+        self.path = re.compile(path).match if path else None
+        self.user_agent = re.compile(user_agent).search \
+            if user_agent else None
+        self.header = header
+
+    def matches(self, method, path, headers):
+        # Cheapest checks first
+        if self.methods is not None and method not in self.methods:
+            return False
+        if self.depth is not None and _path_depth(path) != self.depth:
+            return False
+        if self.path is not None and not self.path(path):
+            return False
+        if self.header is not None and headers.get(self.header) is None:
+            return False
+        if self.user_agent is not None and not self.user_agent(
+                headers.get('User-Agent') or ''):
+            return False
+        return True
+
+
+def parse_sampling_rule(value):
+    """
+    Parse a rule like "method=GET,HEAD depth=container rate=0.5".
+
+    The keys are rate (required), method, depth, path, user_agent and
+    header; see SamplingRule.
+
+    :raises ValueError: if the rule is malformed
+    """
+    kwargs = {}
+    for item in value.split():
+        key, sep, val = item.partition('=')
+        if not sep or not val:
+            raise ValueError('Malformed sampling rule item %r' % item)
+        key = key.lower()
+        if key == 'rate':
+            kwargs['rate'] = float(val)
+            if not 0.0 <= kwargs['rate'] <= 1.0:
+                raise ValueError('Sampling rule rate must be 0.0 to 1.0')
+        elif key == 'method':
+            kwargs['methods'] = val.upper().split(',')
+        elif key == 'depth':
+            kwargs['depth'] = val.lower()
+        elif key in ('path', 'user_agent', 'header'):
+            kwargs[key] = val
+        else:
+            raise ValueError('Unknown sampling rule key %r' % key)
+    if 'rate' not in kwargs:
+        raise ValueError('Sampling rule %r has no rate' % value)
+    return SamplingRule(**kwargs)
+
+
+def get_sampling_rules(conf):
+    """
+    :returns: a list of SamplingRules from every zipkin_sampling_rule_<name>
+              option in conf, in order of name.
+    """
+    return [parse_sampling_rule(conf[key]) for key in sorted(conf)
+            if key.startswith(SAMPLING_RULE_PREFIX)]
+
+
+class RuleSampler(object):
+    """
+    A head sampler that samples each request at the rate of the first
+    SamplingRule it matches.
+
+    Requests that match no rule are left to the `fallback` sampler if
+    there is one, or else sampled at `default_rate`.
+    """
+    def __init__(self, rules, default_rate=1.0, fallback=None):
+        self.rules = tuple(rules)
+        self.default_rate = default_rate
+        self.fallback = fallback
+
+    def sample(self, method=None, path=None, headers=None):
+        """
+        :returns: True if a request should be traced.
+        """
+        if headers is None:
+            headers = {}
+        path = path or '/'
+        for rule in self.rules:
+            if rule.matches(method, path, headers):
+                return random.random() < rule.rate
+        if self.fallback is not None:
+            return self.fallback.sample(method, path, headers)
+        return random.random() < self.default_rate
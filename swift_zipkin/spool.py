@@ -0,0 +1,357 @@
+# Copyright (c) 2020 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Contains concepts originally found in Eventlet, covered by the MIT software
+# license.  The Eventlet license:
+#  Copyright (c) 2005-2006, Bob Ippolito
+#  Copyright (c) 2007-2010, Linden Research, Inc.
+#  Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+import errno
+import os
+import struct
+import time
+
+import eventlet
+from eventlet import queue, tpool
+from py_zipkin.encoding import Encoding
+
+
+# body length, span count, encoding
+RECORD_HEADER = struct.Struct('>IIB')
+ENCODING_CODES = {Encoding.V2_JSON: 0, Encoding.V2_PROTO3: 1}
+CODE_ENCODINGS = dict((v, k) for k, v in ENCODING_CODES.items())
+
+ACTIVE_SUFFIX = '.active'
+SEALED_SUFFIX = '.spool'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def read_records(path):
+    """
+    Read a spool segment, returning a list of (body, num_spans, encoding)
+    records.  A truncated record at the end (from a crash mid-write) is
+    ignored.
+    """
+    records = []
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, num_spans, code = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data) or code not in CODE_ENCODINGS:
+            break
+        records.append((data[offset:offset + length], num_spans,
+                        CODE_ENCODINGS[code]))
+        offset += length
+    return records
+
+
+class SpanSpool(object):
+    """
+    An on-disk overflow area for spans that couldn't be POSTed (or didn't fit
+    in the in-memory buffer), shared by every worker process pointed at the
+    same directory.
+
+    Each process appends length-prefixed records to its own active segment,
+    "<pid>.active".  Once that reaches `segment_size` bytes (or the replayer
+    wants it) it's sealed by renaming it "<timestamp>-<pid>-<spans>.spool".
+    Any process may replay a sealed segment; it claims one by renaming it to
+    "<name>.spool.<pid>" first, so no two processes replay the same spans.
+    Segments left behind by dead processes are sealed (or released) again on
+    start-up.  Whenever a segment is sealed, the oldest sealed segments are
+    deleted until the directory is back under `max_size` bytes.
+
+    Replays POST one record at a time through `send(body, num_spans,
+    encoding)`, which returns None on success or the error.  After an error
+    that `is_retryable(err)`, the replayer backs off exponentially and tries
+    the record again; after any other, the record's spans are dropped and
+    replay moves on.
+
+    All file I/O happens in eventlet's tpool from the spool's own
+    greenthreads.  `put` just queues the spans in memory (or drops them, if
+    `max_pending` bytes are already waiting), so a slow disk never stalls a
+    request greenthread.
+    """
+    replay_interval = 1.0
+    max_replay_backoff = 300.0
+
+    def __init__(self, logger, directory, send, stats,
+                 encoding=Encoding.V2_JSON, max_size=2**30,
+                 segment_size=4 * 2**20, max_pending=8 * 2**20,
+                 is_retryable=lambda err: True):
+        self.logger = logger
+        self.directory = directory
+        self.send = send
+        self.is_retryable = is_retryable
+        self.stats = stats
+        self.stats.setdefault('spooled', 0)
+        self.stats.setdefault('replayed', 0)
+        self.stats.setdefault('dropped', 0)
+        self.encoding = encoding
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.max_pending = max_pending
+        self.pid = os.getpid()
+        self.active_path = os.path.join(directory,
+                                        '%d%s' % (self.pid, ACTIVE_SUFFIX))
+        # (body, num_spans) waiting to be written; None asks the writer
+        # to seal the active segment.
+        self._pending = queue.LightQueue()
+        self._pending_bytes = 0
+        self._active = None
+        self._active_spans = 0
+        # The segment we've claimed for replay and how many of its records
+        # have been sent already
+        self._replaying = None
+        self._replayed_records = 0
+        self._backoff = self.replay_interval
+        self._greenthreads = []
+
+    def start(self):
+        if not self._greenthreads:
+            self._greenthreads = [eventlet.spawn_n(self._gt_writer),
+                                  eventlet.spawn_n(self._gt_replayer)]
+
+    def stop(self):
+        """
+        Kill the writer and replayer.  Spans still queued to be written are
+        lost.
+        """
+        greenthreads, self._greenthreads = self._greenthreads, []
+        for gt in greenthreads:
+            eventlet.kill(gt)
+
+    def put(self, body, num_spans):
+        """
+        Queue an encoded list of spans to be written to the spool.  Never
+        blocks.
+
+        :returns: True if the spans were queued, False if they were dropped.
+        """
+        if self._pending_bytes + len(body) > self.max_pending:
+            self.stats['dropped'] += num_spans
+            return False
+        self._pending_bytes += len(body)
+        self._pending.put((body, num_spans))
+        self.stats['spooled'] += num_spans
+        return True
+
+    def wake(self):
+        """
+        The collector looks healthy; replay without waiting out any backoff.
+        """
+        self._backoff = self.replay_interval
+
+    def _gt_writer(self):
+        try:
+            tpool.execute(self._recover)
+        except Exception:
+            self.logger.exception('SpanSpool: error recovering %s',
+                                  self.directory)
+        while True:
+            item = self._pending.get()
+            num_spans = 0
+            try:
+                if item is None:
+                    self._seal_active()
+                    continue
+                body, num_spans = item
+                self._pending_bytes -= len(body)
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+                self._write(body, num_spans)
+            except Exception:
+                self.stats['dropped'] += num_spans
+                self.logger.exception('SpanSpool: error writing to %s',
+                                      self.directory)
+
+    def _write(self, body, num_spans):
+        full = tpool.execute(self._append, body, num_spans)
+        self._active_spans += num_spans
+        if full:
+            self._seal_active()
+
+    def _seal_active(self):
+        self.stats['dropped'] += tpool.execute(self._seal,
+                                               self._active_spans)
+        self._active_spans = 0
+
+    def _gt_replayer(self):
+        while True:
+            eventlet.sleep(self._backoff)
+            try:
+                replayed = self._replay_next()
+            except Exception:
+                self.logger.exception('SpanSpool: error replaying from %s',
+                                      self.directory)
+                replayed = False
+            if replayed:
+                self._backoff = self.replay_interval
+            else:
+                self._backoff = min(2 * self._backoff,
+                                    self.max_replay_backoff)
+
+    def _replay_next(self):
+        """
+        :returns: False if we should back off before trying again.
+        """
+        if self._replaying is None:
+            self._replaying = tpool.execute(self._claim_oldest)
+            self._replayed_records = 0
+        if self._replaying is None:
+            if self._active_spans:
+                # Nothing sealed to replay, so seal what we've got
+                self._pending.put(None)
+            return True
+        return self._replay()
+
+    def _replay(self):
+        try:
+            records = tpool.execute(read_records, self._replaying)
+        except (IOError, OSError) as e:
+            # Most likely deleted to keep the spool under max_size
+            if e.errno != errno.ENOENT:
+                self.logger.warning('SpanSpool: error reading %s: %r',
+                                    self._replaying, e)
+            self._replaying = None
+            return True
+        for body, num_spans, encoding in records[self._replayed_records:]:
+            err = self.send(body, num_spans, encoding)
+            if err is None:
+                self.stats['replayed'] += num_spans
+            elif self.is_retryable(err):
+                return False
+            else:
+                # The collector's never going to take these
+                self.stats['dropped'] += num_spans
+            self._replayed_records += 1
+        try:
+            tpool.execute(os.unlink, self._replaying)
+        except OSError:
+            pass
+        self._replaying = None
+        return True
+
+    # The rest run in tpool threads, and only from the writer greenthread
+    # (except _claim_oldest, which doesn't touch the active segment).  They
+    # leave stats and _active_spans, which other greenthreads use, alone;
+    # what they count, they return.
+
+    def _recover(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(ACTIVE_SUFFIX):
+                pid = int(name[:-len(ACTIVE_SUFFIX)])
+                if pid == self.pid or not _pid_alive(pid):
+                    num_spans = sum(r[1] for r in read_records(path))
+                    os.rename(path, self._sealed_path(pid, num_spans))
+            elif SEALED_SUFFIX + '.' in name:
+                sealed, _, pid = name.rpartition('.')
+                if not _pid_alive(int(pid)):
+                    os.rename(path, os.path.join(self.directory, sealed))
+
+    def _sealed_path(self, pid, num_spans):
+        return os.path.join(self.directory, '%016x-%d-%d%s' % (
+            int(time.time() * 1e6), pid, num_spans, SEALED_SUFFIX))
+
+    def _append(self, body, num_spans):
+        """
+        :returns: True if the active segment is full and should be sealed.
+        """
+        if self._active is None:
+            self._active = open(self.active_path, 'ab')
+        self._active.write(RECORD_HEADER.pack(
+            len(body), num_spans, ENCODING_CODES[self.encoding]))
+        self._active.write(body)
+        self._active.flush()
+        return self._active.tell() >= self.segment_size
+
+    def _seal(self, num_spans):
+        """
+        :returns: the number of spans deleted to keep under max_size.
+        """
+        if self._active is None:
+            return 0
+        self._active.close()
+        self._active = None
+        os.rename(self.active_path, self._sealed_path(self.pid, num_spans))
+        return self._enforce_max_size()
+
+    def _enforce_max_size(self):
+        """
+        :returns: the number of spans deleted.
+        """
+        dropped = 0
+        sizes = {}
+        for name in os.listdir(self.directory):
+            try:
+                sizes[name] = os.path.getsize(
+                    os.path.join(self.directory, name))
+            except OSError:
+                pass  # claimed or deleted by someone else
+        total = sum(sizes.values())
+        for name in sorted(sizes):
+            if total <= self.max_size:
+                break
+            if not name.endswith(SEALED_SUFFIX):
+                continue
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= sizes[name]
+            dropped += int(name[:-len(SEALED_SUFFIX)].rsplit('-', 1)[1])
+        return dropped
+
+    def _claim_oldest(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SEALED_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            claimed = '%s.%d' % (path, self.pid)
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # somebody else got it first
+            return claimed
+        return None
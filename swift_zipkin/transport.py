@@ -36,103 +36,916 @@
 #  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #  THE SOFTWARE.
+import collections
+import errno
+import itertools
+import random
+import time
+import zlib
+
 import eventlet
 requests = eventlet.import_patched('requests.__init__')
 
+from eventlet import patcher, queue, semaphore, tpool
 from eventlet.green import threading
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from py_zipkin import transport
+from py_zipkin.encoding import Encoding, protobuf
+from py_zipkin.encoding._encoders import get_encoder
+
+from swift_zipkin.spool import SpanSpool
 
 # Shut up some pretty-verbose logging from requests' urllib3
 import logging
 logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
 
+_real_socket = patcher.original('socket')
 _tls = threading.local()  # thread local storage for GreenHttpTransport
-global_green_http_transport = None
+global_transport = None
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+DROP_PRIORITY = 'priority'
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, DROP_PRIORITY)
+
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSIONS = (COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_ZSTD)
+# zstd's fastest (negative) level; zstandard only tells us the slowest
+ZSTD_MIN_LEVEL = -(1 << 17)
+
+SAMPLING_PRIORITY_TAG = 'sampling.priority'
+_SAMPLING_PRIORITY_MARKER = '"%s": "' % SAMPLING_PRIORITY_TAG
+# Map entry key field tag, key length (17), key, then the value field tag
+_PROTO_SAMPLING_PRIORITY_MARKER = b'\x0a\x11sampling.priority\x12'
+
+ENCODINGS = {
+    'json': Encoding.V2_JSON,
+    'proto3': Encoding.V2_PROTO3,
+}
+CONTENT_TYPES = {
+    Encoding.V2_JSON: 'application/json',
+    Encoding.V2_PROTO3: 'application/x-protobuf',
+}
+
+# Comfortably under both the UDP limit and Linux's default limit for Unix
+# datagrams
+DEFAULT_MAX_DATAGRAM_SIZE = 65000
+
+SELECT_ROUND_ROBIN = 'round_robin'
+SELECT_LEAST_OUTSTANDING = 'least_outstanding'
+ENDPOINT_SELECTIONS = (SELECT_ROUND_ROBIN, SELECT_LEAST_OUTSTANDING)
+
+
+class FragmentEncoder(object):
+    """
+    Wraps one of py_zipkin's encoders, but instead of concatenating a batch of
+    encoded spans into a single encoded list, hands the list of individually
+    encoded span "fragments" straight to the transport.  That way each span is
+    encoded exactly once and only copied again when a whole flush is written.
+    """
+    def __init__(self, encoding):
+        self._encoder = get_encoder(encoding)
+        self.fits = self._encoder.fits
+        self.encode_span = self._encoder.encode_span
+
+    def encode_queue(self, queue):
+        # py_zipkin's ZipkinBatchSender starts a fresh list after each batch,
+        # so there's no need to copy this one.
+        return queue
+
+
+_fragment_encoders = {}
+
+
+def get_fragment_encoder(encoding):
+    if encoding not in _fragment_encoders:
+        _fragment_encoders[encoding] = FragmentEncoder(encoding)
+    return _fragment_encoders[encoding]
+
+
+def get_compressor(compression, level=None):
+    """
+    Returns a function that compresses a bytes payload for the given
+    Content-Encoding, or None for no compression.
+
+    :param level: compression level; None means the library's default.
+    :raises ValueError: for an unknown compression, or a level it doesn't
+                        have; compressing happens in the background, so this
+                        is our one chance to complain.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('compression must be one of %s, not %r' % (
+            ', '.join(COMPRESSIONS), compression))
+    if compression == COMPRESSION_GZIP:
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        elif not -1 <= level <= 9:
+            raise ValueError('gzip compression level must be between -1 '
+                             'and 9, not %r' % level)
+
+        def compress(data):
+            # wbits of 16 + MAX_WBITS gets us a gzip header and trailer
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            return compressor.compress(data) + compressor.flush()
+        return compress
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard '
+                             'package')
+        if level is None:
+            level = 3
+        elif not ZSTD_MIN_LEVEL <= level <= zstandard.MAX_COMPRESSION_LEVEL:
+            raise ValueError('zstd compression level must be between %d '
+                             'and %d, not %r' % (
+                                 ZSTD_MIN_LEVEL,
+                                 zstandard.MAX_COMPRESSION_LEVEL, level))
+        return zstandard.ZstdCompressor(level=level).compress
+    return None
+
+
+def count_spans(payload, encoding=Encoding.V2_JSON):
+    """
+    Count the spans in an encoded V2 list payload without decoding it.
+
+    py_zipkin always emits "traceId" as the first key of every JSON span
+    object, and a "traceId" appearing inside a string value would have its
+    quotes escaped, so this is exact.  A protobuf ListOfSpans is nothing but
+    length-delimited spans, so we just hop from one to the next.
+    """
+    if encoding != Encoding.V2_PROTO3:
+        return payload.count('"traceId":')
+
+    count = idx = 0
+    while idx < len(payload):
+        idx += 1  # the field tag; only field 1 (spans) is defined
+        length = shift = 0
+        while True:
+            byte = ord(payload[idx:idx + 1])
+            idx += 1
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        idx += length
+        count += 1
+    return count
+
+
+def payload_priority(payload, encoding=Encoding.V2_JSON):
+    """
+    Extract the highest "sampling.priority" tag value from an encoded V2
+    payload or span fragment.  Spans without the tag have PRIORITY_NORMAL.
+    """
+    priority = PRIORITY_NORMAL
+    if encoding == Encoding.V2_PROTO3:
+        # A tags map entry is the key (field 1) then the value (field 2)
+        marker = _PROTO_SAMPLING_PRIORITY_MARKER
+        idx = payload.find(marker)
+        while idx >= 0:
+            idx += len(marker)
+            end = idx + 1 + ord(payload[idx:idx + 1])
+            try:
+                priority = max(priority, int(payload[idx + 1:end]))
+            except ValueError:
+                pass
+            idx = payload.find(marker, end)
+        return priority
+
+    idx = payload.find(_SAMPLING_PRIORITY_MARKER)
+    while idx >= 0:
+        idx += len(_SAMPLING_PRIORITY_MARKER)
+        end = payload.find('"', idx)
+        try:
+            priority = max(priority, int(payload[idx:end]))
+        except ValueError:
+            pass
+        idx = payload.find(_SAMPLING_PRIORITY_MARKER, end)
+    return priority
+
+
+def join_fragments(fragments, encoding=Encoding.V2_JSON):
+    """
+    Serialize an iterable of encoded span fragments into one V2 list payload.
+    Protobuf ListOfSpans messages concatenate into a ListOfSpans.
+    """
+    if encoding == Encoding.V2_PROTO3:
+        return b''.join(fragments)
+    return '[%s]' % ','.join(fragments)
+
+
+def unwrap_payload(payload, encoding=Encoding.V2_JSON):
+    """
+    Turn an already-encoded V2 list payload into a fragment that can be joined
+    with others.
+    """
+    if encoding == Encoding.V2_PROTO3:
+        return payload
+    return payload[payload.index('[') + 1:payload.rindex(']')]
+
+
+def parse_forward_address(address):
+    """
+    Parse a "unix:///path/to/socket" or "udp://host:port" address into a
+    (socket family, socket address) tuple.
+    """
+    if address.startswith('unix://') and len(address) > len('unix://'):
+        return _real_socket.AF_UNIX, address[len('unix://'):]
+    if address.startswith('udp://'):
+        host, _, port = address[len('udp://'):].rpartition(':')
+        host = host.strip('[]')
+        if host and port.isdigit():
+            family = _real_socket.AF_INET6 if ':' in host else \
+                _real_socket.AF_INET
+            return family, (host, int(port))
+    raise ValueError('Expected an address like unix:///path/to/socket or '
+                     'udp://host:port, not %r' % (address,))
+
+
+def parse_collector_endpoints(value, default_port=9411):
+    """
+    Parse a comma-separated list of "host", "host:port" or "[ipv6]:port"
+    collector endpoints into a list of (host, port) tuples.
+    """
+    endpoints = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item.startswith('['):
+            host, _, port = item[1:].partition(']')
+            port = port[1:] if port.startswith(':') else port
+        elif item.count(':') == 1:
+            host, _, port = item.partition(':')
+        else:
+            host, port = item, ''
+        if not host or (port and not port.isdigit()):
+            raise ValueError('Expected a collector endpoint like host:port, '
+                             'not %r' % (item,))
+        endpoints.append((host, int(port) if port else default_port))
+    if not endpoints:
+        raise ValueError('No collector endpoints in %r' % (value,))
+    return endpoints
+
+
+class SpanQueue(object):
+    """
+    A bounded buffer of lists of encoded span fragments.
+
+    The buffer holds at most `max_bytes` bytes and `max_spans` spans.  When a
+    new payload doesn't fit, the `drop_policy` decides what gets thrown away:
+
+    * "oldest" evicts the oldest buffered payloads to make room;
+    * "newest" rejects the incoming payload;
+    * "priority" evicts the oldest of the lowest-priority payloads, but only if
+      they have a priority no higher than the incoming one; otherwise the
+      incoming payload is rejected.
+
+    If given, `on_drop` is called with each (fragments, num_bytes, num_spans,
+    priority) entry that gets thrown away, evicted or rejected.
+    """
+    def __init__(self, max_bytes, max_spans, drop_policy=DROP_OLDEST,
+                 on_drop=None):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError('drop_policy must be one of %s, not %r' % (
+                ', '.join(DROP_POLICIES), drop_policy))
+        self.max_bytes = max_bytes
+        self.max_spans = max_spans
+        self.drop_policy = drop_policy
+        self.on_drop = on_drop
+        # priority => deque of (fragments, num_bytes, num_spans, priority); the
+        # non-priority policies keep everything under PRIORITY_NORMAL.
+        self._queues = {}
+        self.total_bytes = 0
+        self.total_spans = 0
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def push(self, fragments, num_bytes, num_spans, priority=PRIORITY_NORMAL,
+             evict=True):
+        """
+        Add a list of encoded spans to the buffer.
+
+        :param evict: if False, the spans are only accepted if they fit without
+                      evicting anything else.
+        :returns: the number of spans dropped, including those in `fragments`
+                  if they were rejected.
+        """
+        if self.drop_policy != DROP_PRIORITY:
+            priority = PRIORITY_NORMAL
+        entry = (fragments, num_bytes, num_spans, priority)
+        if num_bytes > self.max_bytes or num_spans > self.max_spans:
+            return self._reject(entry, 0)
+
+        dropped = 0
+        while (self.total_bytes + num_bytes > self.max_bytes or
+               self.total_spans + num_spans > self.max_spans):
+            if not evict or self.drop_policy == DROP_NEWEST:
+                return self._reject(entry, dropped)
+            lowest = min(p for p, q in self._queues.items() if q)
+            if lowest > priority:
+                return self._reject(entry, dropped)
+            victim = self._queues[lowest].popleft()
+            self.total_bytes -= victim[1]
+            self.total_spans -= victim[2]
+            dropped += victim[2]
+            if self.on_drop:
+                self.on_drop(victim)
+
+        if priority not in self._queues:
+            self._queues[priority] = collections.deque()
+        self._queues[priority].append(entry)
+        self.total_bytes += num_bytes
+        self.total_spans += num_spans
+        return dropped
+
+    def _reject(self, entry, dropped):
+        if self.on_drop:
+            self.on_drop(entry)
+        return dropped + entry[2]
+
+    def drain(self):
+        """
+        Remove and return everything in the buffer, highest priority first.
+        """
+        entries = []
+        for priority in sorted(self._queues, reverse=True):
+            entries.extend(self._queues[priority])
+        self._queues = {}
+        self.total_bytes = 0
+        self.total_spans = 0
+        return entries
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised (well, returned) instead of POSTing while the circuit breaker is
+    open.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Stops us trying a collector that's down.
+
+    After `threshold` consecutive failures the breaker opens, and `allow`
+    refuses everything for `cooldown` seconds.  After that it lets a single
+    trial request through: if that succeeds the breaker closes again, and if
+    it fails the breaker re-opens for another cool-down.
+    """
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        # While open, the time the cool-down ends; None when closed
+        self.open_until = None
+        self._trial_in_progress = False
+
+    def is_open(self):
+        """
+        :returns: True if `allow` would refuse a request right now.
+        """
+        if self.open_until is None:
+            return False
+        return self._trial_in_progress or time.time() < self.open_until
+
+    def allow(self):
+        if self.is_open():
+            return False
+        if self.open_until is not None:
+            self._trial_in_progress = True
+        return True
 
+    def record_success(self):
+        self.failures = 0
+        self.open_until = None
+        self._trial_in_progress = False
 
-class GreenHttpTransport(transport.BaseTransportHandler):
+    def trip(self):
+        """
+        Open the breaker now, regardless of the failure count.
+        """
+        self.open_until = time.time() + self.cooldown
+        self._trial_in_progress = False
+
+    def record_failure(self):
+        """
+        :returns: True if this failure opened the breaker.
+        """
+        self.failures += 1
+        if self._trial_in_progress or (self.open_until is None and
+                                       self.failures >= self.threshold):
+            was_closed = self.open_until is None
+            self.open_until = time.time() + self.cooldown
+            self._trial_in_progress = False
+            return was_closed
+        return False
+
+
+class CollectorEndpoint(object):
     """
-    We'll keep one global instance of this class to send the v2 API JSON
-    payloads to the server with a greened `requests` module connection pool.
+    One Zipkin collector, with its own connection pool and CircuitBreaker.
+    It's ejected (skipped when picking where to POST) while the breaker is
+    open.  `latency` is a moving average of how long its POSTs take.
+    """
+    # Weight of the newest sample in the latency moving average
+    latency_alpha = 0.2
+
+    def __init__(self, host, port, headers, breaker):
+        self.host = host
+        self.port = port
+        self.url = 'http://%s:%s/api/v2/spans' % (
+            '[%s]' % host if ':' in host else host, port)
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.breaker = breaker
+        self.outstanding = 0
+        self.latency = 0.0
+
+    def record_latency(self, elapsed):
+        self.latency += self.latency_alpha * (elapsed - self.latency)
+
+
+class FragmentTransportHandler(transport.BaseTransportHandler):
+    """
+    Base class for our transports, which ezipkin_span hands lists of encoded
+    span fragments (see FragmentEncoder) rather than encoded lists of spans.
+    """
+    encoding = Encoding.V2_JSON
+
+    @classmethod
+    def init_singleton(cls, *args, **kwargs):
+        global global_transport
+        global_transport = cls(*args, **kwargs)
+
+    def unwrap(self, payload):
+        """
+        :param payload: a list of encoded span fragments from a
+                        FragmentEncoder, or an already-encoded list of spans.
+        :returns: a tuple of (list of fragments, number of spans)
+        """
+        if isinstance(payload, list):
+            return payload, len(payload)
+        # Some other encoder produced a complete list; unwrap it once here so
+        # it can be handled like any other fragment.
+        return ([unwrap_payload(payload, self.encoding)],
+                count_spans(payload, self.encoding))
+
+    def _init_stats(self, logger):
+        # The `stats` dict counts spans enqueued, dropped and sent (and the
+        # like); ezipkin_span counts spans recorded per instrumentation.
+        self.stats = {'enqueued': 0, 'dropped': 0, 'sent': 0}
+        self.span_counts = collections.Counter()
+        # swift's LogAdapter does StatsD; a plain logging.Logger doesn't
+        self.metrics = logger if hasattr(logger, 'update_stats') else None
+        self._reported = {}
+        self._last_report = time.time()
+
+    def _report_metrics(self):
+        """
+        Send StatsD the counters' increases since we last reported.
+        """
+        self._last_report = time.time()
+        current = dict(('spans.%s' % k, v) for k, v in self.stats.items())
+        current.update(('spans.recorded.%s' % k, v)
+                       for k, v in self.span_counts.items())
+        for metric, value in current.items():
+            delta = value - self._reported.get(metric, 0)
+            if delta:
+                self.metrics.update_stats(metric, delta)
+        self._reported = current
+
+
+class GreenHttpTransport(FragmentTransportHandler):
+    """
+    We'll keep one global instance of this class to send the v2 API JSON (or
+    protobuf) payloads to the server with a greened `requests` module
+    connection pool.
+
+    `send` only enqueues onto a bounded SpanQueue.  A long-lived flusher
+    greenthread drains it into batches for `max_in_flight` poster
+    greenthreads to POST, so a slow collector fills the buffer (and sheds
+    spans by the drop policy) instead of piling up greenthreads.  The `stats`
+    dict counts spans enqueued, dropped and sent (and, with a spool, spooled
+    and replayed); if the logger does StatsD, they're reported along with
+    buffer, flush and failure metrics under spans.*, buffer.depth.* and
+    flush.*.
+
+    :param flush_threshold_size: flush once this many bytes are buffered
+        (compressed bytes, estimated, with `flush_threshold_compressed`)
+    :param flush_threshold_sec: flush at least this often
+    :param max_buffer_size, max_buffer_spans: caps on the SpanQueue
+    :param drop_policy: which spans a full SpanQueue sheds
+    :param max_in_flight: the most POSTs outstanding at once
+    :param compression, compression_level: gzip or zstd the POSTs (in tpool)
+    :param encoding: the Encoding spans arrive in and are POSTed as
+    :param spool_dir: if set, spans that would be dropped go to a SpanSpool
+        there (of `spool_max_size`, in `spool_segment_size` segments) to be
+        replayed once the collector's reachable
+    :param connect_timeout, read_timeout: each POST's timeouts
+    :param max_retries, retry_backoff: retries of retryable failures, with
+        jittered exponential backoff
+    :param breaker_threshold, breaker_cooldown: after this many consecutive
+        failures, a collector gets no POSTs for this many seconds
+    :param endpoints: a list of (host, port) collectors to use instead of
+        `address`:`port`
+    :param endpoint_selection: round-robin or least-outstanding
+    :param eject_latency: take a collector out of service for the breaker
+        cooldown once its average POST latency passes this many seconds
     """
     def __init__(self, logger, address, port, flush_threshold_size=2**20,
-                 flush_threshold_sec=2.0):
+                 flush_threshold_sec=2.0, max_buffer_size=8 * 2**20,
+                 max_buffer_spans=100000, drop_policy=DROP_OLDEST,
+                 max_in_flight=1, compression=COMPRESSION_NONE,
+                 compression_level=None, flush_threshold_compressed=False,
+                 encoding=Encoding.V2_JSON, spool_dir=None,
+                 spool_max_size=2**30, spool_segment_size=4 * 2**20,
+                 connect_timeout=0.5, read_timeout=5.0, max_retries=2,
+                 retry_backoff=0.1, breaker_threshold=5,
+                 breaker_cooldown=30.0, endpoints=None,
+                 endpoint_selection=SELECT_ROUND_ROBIN, eject_latency=2.0):
+        if encoding not in CONTENT_TYPES:
+            raise ValueError('Unsupported encoding %r' % (encoding,))
+        if encoding == Encoding.V2_PROTO3 and not protobuf.installed():
+            raise ValueError('proto3 encoding requires the protobuf package')
         self.logger = logger
+        self.encoding = encoding
+        if endpoint_selection not in ENDPOINT_SELECTIONS:
+            raise ValueError('endpoint_selection must be one of %s, not %r' % (
+                ', '.join(ENDPOINT_SELECTIONS), endpoint_selection))
         self.address = address
         self.port = port
-        self.url = 'http://%s:%s/api/v2/spans' % (self.address, self.port)
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Content-Type': "application/json",
-        })
+        headers = {'Content-Type': CONTENT_TYPES[encoding]}
+        self.compression = compression
+        self._compress = get_compressor(compression, compression_level)
+        if self._compress:
+            headers['Content-Encoding'] = compression
+        self.endpoints = [
+            CollectorEndpoint(host, endpoint_port, headers, CircuitBreaker(
+                breaker_threshold, breaker_cooldown))
+            for host, endpoint_port in endpoints or [(address, port)]]
+        self.endpoint_selection = endpoint_selection
+        self.eject_latency = eject_latency
+        self._next_endpoint = 0
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
         self.flush_threshold_size = flush_threshold_size
         self.flush_threshold_sec = flush_threshold_sec
-        self.payload_buffer = []
-        self.total_buffer_size = 0
-        self._flush_timer_started = None
+        self.flush_threshold_compressed = bool(
+            self._compress and flush_threshold_compressed)
+        # The buffered (raw) byte count that triggers a flush
+        self._raw_flush_threshold = flush_threshold_size
+        self._init_stats(logger)
+        self.spool = None
+        if spool_dir:
+            self.spool = SpanSpool(
+                logger, spool_dir, self._post, self.stats, encoding=encoding,
+                max_size=spool_max_size, segment_size=spool_segment_size,
+                max_pending=max_buffer_size, is_retryable=_is_retryable)
+        self.span_queue = SpanQueue(
+            max_buffer_size, max_buffer_spans, drop_policy,
+            on_drop=self._spill if self.spool else None)
+        self.max_in_flight = max_in_flight
+        self._flushers_started = False
+        self._greenthreads = []
+        # A non-empty _flush_requests wakes the flusher early; the flusher
+        # takes an _idle_posters slot before draining the SpanQueue into
+        # _batches, and the poster that POSTs the batch gives it back.
+        self._flush_requests = queue.LightQueue(maxsize=1)
+        self._idle_posters = semaphore.Semaphore(max_in_flight)
+        self._batches = queue.LightQueue()
         # This flag will allow us to log POST errors only when we hadn't had an
         # error before
         self._in_error_state = None
 
-    @classmethod
-    def init_singleton(cls, logger, address, port, flush_threshold_size=2**20,
-                       flush_threshold_sec=2.0):
-        global global_green_http_transport
-        global_green_http_transport = cls(logger, address, port,
-                                          flush_threshold_size=flush_threshold_size,
-                                          flush_threshold_sec=flush_threshold_sec)
-
     def get_max_payload_bytes(self):
         return None
 
-    def send(self, payload):
-        if not self._flush_timer_started:
-            self.reschedule_flush_timer()
-            self._flush_timer_started = True
+    def send(self, payload, priority=None):
+        """
+        :param payload: see FragmentTransportHandler.unwrap
+        :param priority: the sampling priority of the spans; if not given
+                         and needed, it's read from their tags.
+        """
+        if not self._flushers_started:
+            self.start_flushers()
 
-        self.payload_buffer.append(payload)
-        self.total_buffer_size += len(payload)
-        if self.total_buffer_size > self.flush_threshold_size:
+        fragments, num_spans = self.unwrap(payload)
+        if not num_spans:
+            return
+        num_bytes = sum(map(len, fragments))
+        if self.encoding == Encoding.V2_JSON:
+            # Each fragment will be followed by a comma or closing bracket
+            num_bytes += len(fragments)
+        if priority is None and self.span_queue.drop_policy == DROP_PRIORITY:
+            priority = max(payload_priority(f, self.encoding)
+                           for f in fragments)
+        self.stats['enqueued'] += num_spans
+        dropped = self.span_queue.push(
+            fragments, num_bytes, num_spans, priority or PRIORITY_NORMAL)
+        if not self.spool:
+            # otherwise, _spill's already accounted for them
+            self.stats['dropped'] += dropped
+        if self.span_queue.total_bytes > self._raw_flush_threshold:
             self.do_flush()
 
-    def reschedule_flush_timer(self, gt=None):
-        eventlet.spawn_after(
-            self.flush_threshold_sec,
-            self.do_flush,
-        ).link(self.reschedule_flush_timer)
+    def start_flushers(self):
+        self._flushers_started = True
+        self._greenthreads.append(eventlet.spawn_n(self._gt_flusher))
+        for _ in range(self.max_in_flight):
+            self._greenthreads.append(eventlet.spawn_n(self._gt_poster))
+        if self.spool:
+            self.spool.start()
+
+    def stop(self):
+        """
+        Kill the flusher, posters and spool greenthreads.  Spans still
+        buffered are not flushed.
+        """
+        greenthreads, self._greenthreads = self._greenthreads, []
+        for gt in greenthreads:
+            eventlet.kill(gt)
+        if self.spool:
+            self.spool.stop()
 
     def do_flush(self):
-        if not self.payload_buffer:
-            return
+        """
+        Ask the flusher greenthread to flush as soon as a poster is idle.
+        This never blocks or switches greenthreads.
+        """
+        if self._flush_requests.empty():
+            self._flush_requests.put_nowait(None)
+
+    def _gt_flusher(self):
+        while True:
+            try:
+                self._flush_requests.get(timeout=self.flush_threshold_sec)
+            except queue.Empty:
+                pass
+            if self.metrics and time.time() >= (
+                    self._last_report + self.flush_threshold_sec):
+                self._report_metrics()
+            if not self.span_queue.total_spans:
+                continue
+            if not self.spool and all(
+                    e.breaker.is_open() for e in self.endpoints):
+                continue
+            self._idle_posters.acquire()
+            if self.metrics:
+                self.metrics.update_stats('buffer.depth.bytes',
+                                          self.span_queue.total_bytes)
+                self.metrics.update_stats('buffer.depth.spans',
+                                          self.span_queue.total_spans)
+                self.metrics.update_stats('buffer.depth.in_flight',
+                                          self.max_in_flight -
+                                          self._idle_posters.counter)
+                self.metrics.increment('buffer.depth.samples')
+            entries = self.span_queue.drain()
+            if entries:
+                self._batches.put(entries)
+            else:
+                self._idle_posters.release()
+
+    def _gt_poster(self):
+        while True:
+            entries = self._batches.get()
+            try:
+                self._gt_flush(entries)
+            except Exception:
+                self.logger.exception("GreenHttpTransport: error flushing")
+            finally:
+                self._idle_posters.release()
+
+    def _spill(self, entry):
+        fragments, _, num_spans, _ = entry
+        self.spool.put(join_fragments(fragments, self.encoding), num_spans)
 
-        buffer_switch_event = eventlet.Event()
-        eventlet.spawn_n(self._gt_flush, buffer_switch_event)
-        buffer_switch_event.wait()
-        self.payload_buffer = []
-        self.total_buffer_size = 0
-
-    def _gt_flush(self, buffer_switch_event):
-        # This was the fastest way I could think of to concatenate JSON lists
-        _tls.flush_buffer = '[' + ','.join(
-            p[p.index('[') + 1:p.rindex(']')]
-            for p in self.payload_buffer
-        ) + ']'
-        buffer_switch_event.send()
-        flush_size = len(_tls.flush_buffer)
+    def _gt_flush(self, entries):
+        _tls.flush_buffer = join_fragments(itertools.chain.from_iterable(
+            fragments for fragments, _, _, _ in entries), self.encoding)
+        flush_spans = sum(n for _, _, n, _ in entries)
         try:
-            resp = self.session.post(self.url, data=_tls.flush_buffer)
-            resp.raise_for_status()
-            if self._in_error_state is None or self._in_error_state:
-                self.logger.info("GreenHttpTransport: successfully POST'ed %d "
-                                 "byte Zipkin V2 JSON payload to %s",
-                                 flush_size, self.url)
-            self._in_error_state = False
-        except Exception as e:
-            if not self._in_error_state:
-                self.logger.warning("GreenHttpTransport: error flushing "
-                                    "%d bytes to %s: %r",
-                                    flush_size, self.url, e)
-                self._in_error_state = True
+            err = self._post(_tls.flush_buffer, flush_spans)
+            if err is None:
+                if self.spool:
+                    self.spool.wake()
+            elif not _is_retryable(err):
+                self.stats['dropped'] += flush_spans
+            elif self.spool:
+                self.spool.put(_tls.flush_buffer, flush_spans)
+            else:
+                # Put the batch back for the next flush, but never at the
+                # expense of spans that arrived while we were POSTing.
+                for fragments, num_bytes, num_spans, priority in entries:
+                    self.stats['dropped'] += self.span_queue.push(
+                        fragments, num_bytes, num_spans, priority,
+                        evict=False)
         finally:
             del _tls.flush_buffer
+
+    def _post(self, body, num_spans, encoding=None):
+        """
+        POST an encoded list of spans, compressing it first if configured.
+
+        :param encoding: the body's encoding, if not our own (e.g. for spans
+                         spooled before a config change).
+        :returns: None on success, otherwise the error.
+        """
+        headers = None
+        if encoding is not None and encoding != self.encoding:
+            headers = {'Content-Type': CONTENT_TYPES[encoding]}
+        if self._compress:
+            raw_size = len(body)
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            body = tpool.execute(self._compress, body)
+            if self.flush_threshold_compressed:
+                self._raw_flush_threshold = (
+                    self.flush_threshold_size * raw_size //
+                    max(len(body), 1))
+        for attempt in range(self.max_retries + 1):
+            endpoint = self._select_endpoint()
+            if endpoint is None or not endpoint.breaker.allow():
+                return CircuitOpenError()
+            endpoint.outstanding += 1
+            start = time.time()
+            try:
+                resp = endpoint.session.post(
+                    endpoint.url, data=body, headers=headers,
+                    timeout=self.timeout)
+                resp.raise_for_status()
+                break
+            except Exception as e:
+                if self.metrics:
+                    self.metrics.increment('flush.errors')
+                retryable = _is_retryable(e)
+                if not retryable:
+                    # The collector's up, it just didn't like the payload
+                    endpoint.breaker.record_success()
+                elif endpoint.breaker.record_failure():
+                    if self.metrics:
+                        self.metrics.increment('breaker.opened')
+                    self.logger.warning(
+                        "GreenHttpTransport: %d consecutive errors POSTing to "
+                        "%s; not trying it again for %ss",
+                        endpoint.breaker.failures, endpoint.url,
+                        endpoint.breaker.cooldown)
+                if not retryable or attempt == self.max_retries:
+                    if not self._in_error_state:
+                        self.logger.warning("GreenHttpTransport: error "
+                                            "flushing %d bytes to %s: %r",
+                                            len(body), endpoint.url, e)
+                        self._in_error_state = True
+                    return e
+            finally:
+                endpoint.outstanding -= 1
+            # Full jitter, so workers that failed together don't all retry
+            # together
+            eventlet.sleep(random.uniform(
+                0, self.retry_backoff * 2 ** attempt))
+        endpoint.breaker.record_success()
+        self._record_latency(endpoint, time.time() - start)
+        if self.metrics:
+            self.metrics.timing_since('flush.timing', start)
+            self.metrics.update_stats('flush.bytes', len(body))
+            self.metrics.update_stats('flush.spans', num_spans)
+        self.stats['sent'] += num_spans
+        if self._in_error_state is None or self._in_error_state:
+            self.logger.info("GreenHttpTransport: successfully POST'ed %d "
+                             "byte Zipkin %s payload to %s",
+                             len(body), (encoding or self.encoding).name,
+                             endpoint.url)
+        self._in_error_state = False
+        return None
+
+    def _select_endpoint(self):
+        """
+        :returns: the CollectorEndpoint to POST to next, or None if they're
+                  all ejected.
+        """
+        if len(self.endpoints) == 1:
+            return self.endpoints[0]
+        if self.endpoint_selection == SELECT_LEAST_OUTSTANDING:
+            candidates = [e for e in self.endpoints
+                          if not e.breaker.is_open()]
+            if not candidates:
+                return None
+            return min(candidates, key=lambda e: (e.outstanding, e.latency))
+        for _ in range(len(self.endpoints)):
+            endpoint = self.endpoints[
+                self._next_endpoint % len(self.endpoints)]
+            self._next_endpoint += 1
+            if not endpoint.breaker.is_open():
+                return endpoint
+        return None
+
+    def _record_latency(self, endpoint, elapsed):
+        endpoint.record_latency(elapsed)
+        if self.eject_latency and endpoint.latency > self.eject_latency and \
+                any(not e.breaker.is_open()
+                    for e in self.endpoints if e is not endpoint):
+            self.logger.warning(
+                "GreenHttpTransport: POSTs to %s are averaging %.3fs; not "
+                "using it for %ss", endpoint.url, endpoint.latency,
+                endpoint.breaker.cooldown)
+            endpoint.breaker.trip()
+            if self.metrics:
+                self.metrics.increment('endpoint.ejected')
+            # Give it a fresh start when it comes back
+            endpoint.latency = 0.0
+
+
+class GreenSocketTransport(FragmentTransportHandler):
+    """
+    Instead of POSTing to Zipkin, forwards spans as datagrams to a
+    swift-zipkin-aggregator on the same node, which batches up the spans from
+    every worker process and POSTs them for us.
+
+    Each send is a single non-blocking sendto(); if the aggregator isn't
+    running or can't keep up, spans are dropped (and counted) rather than
+    ever making a request greenthread wait.  The `stats` dict counts spans
+    enqueued, dropped and sent.
+
+    If the logger is a swift LogAdapter, those counters and the spans
+    recorded per instrumentation are reported via StatsD as GreenHttpTransport
+    does, as spans are sent at most every `report_interval` seconds.
+    """
+    def __init__(self, logger, address, encoding=Encoding.V2_JSON,
+                 max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE,
+                 report_interval=2.0):
+        self.logger = logger
+        self.address = address
+        self.family, self.sockaddr = parse_forward_address(address)
+        self.encoding = encoding
+        self.max_datagram_size = max_datagram_size
+        self.report_interval = report_interval
+        self._init_stats(logger)
+        # Created on first use, so that's after any forking
+        self._sock = None
+        self._in_error_state = None
+
+    def get_max_payload_bytes(self):
+        # py_zipkin will split up traces so each batch fits in a datagram
+        return self.max_datagram_size
+
+    def send(self, payload, priority=None):
+        """
+        :param payload: see FragmentTransportHandler.unwrap
+        :param priority: ignored; there's no buffer to prioritize.
+        """
+        if self.metrics and time.time() >= (
+                self._last_report + self.report_interval):
+            self._report_metrics()
+        fragments, num_spans = self.unwrap(payload)
+        if not num_spans:
+            return
+        self.stats['enqueued'] += num_spans
+        datagram = join_fragments(fragments, self.encoding)
+        if not isinstance(datagram, bytes):
+            datagram = datagram.encode('utf-8')
+        try:
+            if self._sock is None:
+                self._sock = _real_socket.socket(self.family,
+                                                 _real_socket.SOCK_DGRAM)
+                self._sock.setblocking(False)
+            self._sock.sendto(datagram, self.sockaddr)
+        except (IOError, OSError) as e:
+            self.stats['dropped'] += num_spans
+            # A full socket buffer is the aggregator being momentarily behind;
+            # anything else (it isn't running, say) deserves a log line.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK) and \
+                    not self._in_error_state:
+                self.logger.warning("GreenSocketTransport: error forwarding "
+                                    "%d bytes to %s: %r",
+                                    len(datagram), self.address, e)
+                self._in_error_state = True
+            return
+        self.stats['sent'] += num_spans
+        if self._in_error_state is None or self._in_error_state:
+            self.logger.info("GreenSocketTransport: successfully forwarded "
+                             "%d byte Zipkin %s payload to %s",
+                             len(datagram), self.encoding.name, self.address)
+        self._in_error_state = False
+
+
+def _is_retryable(err):
+    """
+    Connection problems and 5xx responses are worth retrying; anything else
+    (e.g. a 400 for a payload the collector can't parse) never will succeed.
+    """
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and err.response.status_code >= 500
+    return isinstance(err, (requests.ConnectionError, requests.Timeout,
+                            CircuitOpenError))
@@ -36,9 +36,8 @@
 #  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #  THE SOFTWARE.
-import inspect
-import os
 import re
+import time
 
 from eventlet import wsgi
 
@@ -46,29 +45,165 @@ from swift_zipkin import api
 
 
 __original_handle_one_response__ = wsgi.HttpProtocol.handle_one_response
+# What apps that wrote their own response (e.g. websockets) return, on
+# eventlets that check for it by identity; newer ones don't have it.
+_ALREADY_HANDLED = getattr(wsgi, 'ALREADY_HANDLED', object())
 
 
-def _extract_status_code(environ, zipkin_span):
-    # When we're called, the prior stack frame has a local var named
-    # "status_code" and we want to extract "status_code[0]" as http.status_code
-    # binary annotation.
-    frame = inspect.currentframe().f_back
-    try:
-        status_code = frame.f_locals['status_code'][0]
-        zipkin_span.update_binary_annotations({
-            'http.status_code': status_code,
-        })
-    finally:
-        del frame
+class _ResponseTracker(object):
+    """
+    Stands in for the WSGI application during one sampled request, to note
+    the response status as it's passed to start_response() and count the
+    response body bytes as eventlet sends them, without any digging around
+    in eventlet's stack frames.
+
+    The first and last response bytes, as the `writer` (a _TimedWriter) saw
+    them go out, are annotated on the span, and so is progress every
+    api.throughput_interval seconds (if set) while a response streams out.
+    Request bytes come from eventlet's own count of what was read from the
+    request input, so reading it costs nothing extra.
+    """
+    __slots__ = ('app', 'zipkin_span', 'request_input', 'writer',
+                 'start_response', 'result', 'status_code', 'bytes_sent',
+                 'bytes_received', 'interval', 'next_report', 'last_report',
+                 'last_bytes')
+
+    def __init__(self, app, zipkin_span, request_input=None, writer=None):
+        self.app = app
+        self.zipkin_span = zipkin_span
+        self.request_input = request_input
+        self.writer = writer
+        self.start_response = self.result = self.status_code = None
+        self.bytes_sent = self.last_bytes = 0
+        self.bytes_received = None
+        self.interval = api.throughput_interval
+        self.next_report = self.last_report = None
+
+    def __call__(self, environ, start_response):
+        self.start_response = start_response
+        try:
+            result = self.app(environ, self._start_response)
+        except Exception:
+            # eventlet will log it and send a 500
+            self.status_code = '500'
+            raise
+        if result is _ALREADY_HANDLED:
+            # eventlet needs to see it as it is
+            return result
+        if hasattr(result, '__len__'):
+            # A complete response; eventlet wants to see that it has a
+            # length, so it can set the Content-Length.
+            self.bytes_sent = sum(map(len, result))
+            self._note_request_size()
+            return result
+        self.result = result
+        return self
+
+    def _start_response(self, status, response_headers, exc_info=None):
+        self.status_code = status.split(' ', 1)[0]
+        return self.start_response(status, response_headers, exc_info)
+
+    def __iter__(self):
+        try:
+            for chunk in self.result:
+                if chunk and not self.bytes_sent and self.interval:
+                    self.last_report = time.time()
+                    self.next_report = self.last_report + self.interval
+                self.bytes_sent += len(chunk)
+                if self.next_report is not None:
+                    now = time.time()
+                    if now >= self.next_report:
+                        self._report_progress(now)
+                yield chunk
+        except Exception:
+            if not self.bytes_sent:
+                # Most likely nothing's been sent yet, so eventlet will send
+                # a 500 instead
+                self.status_code = '500'
+            raise
+
+    def _report_progress(self, now):
+        self.zipkin_span.add_annotation('Sent %d bytes (%d B/s)' % (
+            self.bytes_sent, (self.bytes_sent - self.last_bytes) / (
+                now - self.last_report)), now)
+        self.last_bytes = self.bytes_sent
+        self.last_report = now
+        self.next_report = now + self.interval
+
+    def _note_request_size(self):
+        # Once the response is done, before eventlet discards whatever's left
+        # of the request body
+        if self.bytes_received is None:
+            self.bytes_received = getattr(self.request_input, 'position',
+                                          None)
+
+    def close(self):
+        self._note_request_size()
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+    def annotate(self):
+        self._note_request_size()
+        writer = self.writer
+        if writer is not None and writer.first_write is not None:
+            self.zipkin_span.add_annotation('First response byte',
+                                            writer.first_write)
+            self.zipkin_span.add_annotation('Last response byte',
+                                            writer.last_flush)
+        annotations = {'http.response.size': str(self.bytes_sent)}
+        if self.bytes_received is not None:
+            annotations['http.request.size'] = str(self.bytes_received)
+        if self.status_code is not None:
+            annotations['http.status_code'] = self.status_code
+        self.zipkin_span.update_binary_annotations(annotations)
+
+
+class _TimedWriter(object):
+    """
+    Stands in for the connection's wfile while eventlet writes one sampled
+    response, noting when it started writing (the response's first byte) and
+    when it last finished flushing (its last).
+    """
+    __slots__ = ('wfile', 'first_write', 'last_flush')
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.first_write = self.last_flush = None
+
+    def write(self, data):
+        if self.first_write is None:
+            self.first_write = time.time()
+        return self.wfile.write(data)
+
+    def writelines(self, lines):
+        if self.first_write is None:
+            self.first_write = time.time()
+        return self.wfile.writelines(lines)
+
+    def flush(self):
+        self.wfile.flush()
+        if self.first_write is not None:
+            self.last_flush = time.time()
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
 
 
 def _patched_handle_one_response(self):
-    zipkin_attrs = api.extract_zipkin_attrs_from_headers(
-        self.headers, sample_rate=api.sample_rate_pct, use_128bit_trace_id=True)
+    decision, zipkin_attrs = api.should_sample(self.headers, self.command,
+                                               self.path)
+    if not decision:
+        # No spans, no socket or header digging; our http patch will just
+        # pass on "X-B3-Sampled: 0" to the backends.
+        api.set_unsampled(True)
+        try:
+            return __original_handle_one_response__(self)
+        finally:
+            api.set_unsampled(False)
 
     binary_annotations = {
         "http.uri": self.path,
-        "worker.pid": str(os.getpid()),
+        "worker.pid": api.worker_pid(),
     }
 
     local_ip, local_port = self.request.getsockname()[:2]
@@ -103,10 +238,14 @@ def _patched_handle_one_response(self):
         service_name=api.default_service_name(),
         span_name=self.command,
         zipkin_attrs=zipkin_attrs,
-        sample_rate=None if zipkin_attrs else api.sample_rate_pct,
+        # We've already decided to sample it
+        sample_rate=None if zipkin_attrs else 100.0,
+        tail_sampler=(api.tail_sampler if decision == api.TAIL_SAMPLED
+                      else None),
         host=local_ip,
         port=local_port,
         binary_annotations=binary_annotations,
+        instrumentation='wsgi',
     ) as zipkin_span:
         # For swift servers, extract a canonical service name and PID from the
         # User-Agent header.
@@ -118,12 +257,21 @@ def _patched_handle_one_response(self):
                 'client.pid': int(match.group(2)),
             })
         zipkin_span.add_remote_endpoint(client_port, user_agent, client_ip)
-        # Add in a hook to snarf out the response status
-        self.environ['eventlet.posthooks'].append(
-            (_extract_status_code, (zipkin_span,), {}),
-        )
-
-        __original_handle_one_response__(self)
+        # eventlet set self.application just before calling us, so it's ours
+        # to wrap for the length of this request
+        # ...and likewise its wfile, which it's about to write the response
+        # to
+        writer = _TimedWriter(self.wfile)
+        tracker = _ResponseTracker(self.application, zipkin_span,
+                                   self.environ.get('eventlet.input'), writer)
+        self.application = tracker
+        self.wfile = writer
+        try:
+            __original_handle_one_response__(self)
+        finally:
+            self.application = tracker.app
+            self.wfile = writer.wfile
+            tracker.annotate()
 
         # If we're a root span, see if we can extract a Swift transaction ID to
         # associate with this (one-per-trace) root span.  We don't track it on
@@ -59,9 +59,84 @@ import os
 
 from swift.common.utils import (
     get_logger, register_swift_info, config_true_value,
-    config_positive_int_value, config_float_value)
+    config_positive_int_value, config_float_value, non_negative_int)
 
+from swift_zipkin.api import (
+    B3_FORMATS, B3_MULTI, STORAGE_BACKENDS, STORAGE_CONTEXTVARS, contextvars)
 from swift_zipkin.patcher import patch_eventlet_and_swift
+from swift_zipkin.rings import RingResolver
+from swift_zipkin.sampling import (
+    SAMPLING_ADAPTIVE, SAMPLING_HEAD, SAMPLING_MODES, SAMPLING_TAIL,
+    RateLimitingSampler, RuleSampler, TailSampler, get_sampling_rules)
+from swift_zipkin.transport import (
+    DROP_OLDEST, DROP_POLICIES, COMPRESSION_NONE, ENCODINGS,
+    ENDPOINT_SELECTIONS, SELECT_ROUND_ROBIN, get_compressor,
+    parse_collector_endpoints, parse_forward_address)
+
+
+def get_transport_options(conf):
+    """
+    Parse the options shared by everything that POSTs spans to Zipkin (the
+    middleware and the aggregator) into GreenHttpTransport keyword arguments.
+    """
+    options = {}
+    options['flush_threshold_size'] = config_positive_int_value(
+        conf.get('zipkin_flush_threshold_size', 2**20))
+    options['flush_threshold_sec'] = config_float_value(
+        conf.get('zipkin_flush_threshold_sec', 2.0))
+    options['max_buffer_size'] = config_positive_int_value(
+        conf.get('zipkin_max_buffer_size', 8 * 2**20))
+    options['max_buffer_spans'] = config_positive_int_value(
+        conf.get('zipkin_max_buffer_spans', 100000))
+    options['drop_policy'] = conf.get(
+        'zipkin_drop_policy', DROP_OLDEST).strip().lower()
+    if options['drop_policy'] not in DROP_POLICIES:
+        raise ValueError('zipkin_drop_policy must be one of %s' % (
+            ', '.join(DROP_POLICIES),))
+    options['max_in_flight'] = config_positive_int_value(
+        conf.get('zipkin_max_in_flight', 1))
+    options['compression'] = conf.get(
+        'zipkin_compression', COMPRESSION_NONE).strip().lower()
+    raw_compression_level = conf.get('zipkin_compression_level')
+    options['compression_level'] = int(
+        raw_compression_level) if raw_compression_level else None
+    # Raises ValueError for unknown (or uninstalled) compressions
+    get_compressor(options['compression'], options['compression_level'])
+    options['flush_threshold_compressed'] = config_true_value(
+        conf.get('zipkin_flush_threshold_compressed', False))
+    encoding = conf.get('zipkin_encoding', 'json').strip().lower()
+    if encoding not in ENCODINGS:
+        raise ValueError('zipkin_encoding must be one of %s' % (
+            ', '.join(sorted(ENCODINGS)),))
+    options['encoding'] = ENCODINGS[encoding]
+    options['spool_dir'] = conf.get('zipkin_spool_dir') or None
+    options['spool_max_size'] = config_positive_int_value(
+        conf.get('zipkin_spool_max_size', 2**30))
+    options['spool_segment_size'] = config_positive_int_value(
+        conf.get('zipkin_spool_segment_size', 4 * 2**20))
+    options['connect_timeout'] = config_float_value(
+        conf.get('zipkin_connect_timeout', 0.5), minimum=0.0)
+    options['read_timeout'] = config_float_value(
+        conf.get('zipkin_read_timeout', 5.0), minimum=0.0)
+    options['max_retries'] = non_negative_int(
+        conf.get('zipkin_max_retries', 2))
+    options['retry_backoff'] = config_float_value(
+        conf.get('zipkin_retry_backoff', 0.1), minimum=0.0)
+    options['breaker_threshold'] = config_positive_int_value(
+        conf.get('zipkin_breaker_threshold', 5))
+    options['breaker_cooldown'] = config_float_value(
+        conf.get('zipkin_breaker_cooldown', 30.0), minimum=0.0)
+    raw_endpoints = conf.get('zipkin_v2_endpoints')
+    options['endpoints'] = parse_collector_endpoints(
+        raw_endpoints) if raw_endpoints else None
+    options['endpoint_selection'] = conf.get(
+        'zipkin_endpoint_selection', SELECT_ROUND_ROBIN).strip().lower()
+    if options['endpoint_selection'] not in ENDPOINT_SELECTIONS:
+        raise ValueError('zipkin_endpoint_selection must be one of %s' % (
+            ', '.join(ENDPOINT_SELECTIONS),))
+    options['eject_latency'] = config_float_value(
+        conf.get('zipkin_endpoint_eject_latency', 2.0), minimum=0.0)
+    return options
 
 
 class ZipkinMiddleware(object):
@@ -69,7 +144,8 @@ class ZipkinMiddleware(object):
     def __init__(self, app, conf):
         self.app = app
         self.conf = conf
-        self.logger = get_logger(conf, log_route='swift_zipkin')
+        self.logger = get_logger(conf, log_route='swift_zipkin',
+                                 statsd_tail_prefix='zipkin')
         self.enabled = config_true_value(conf.get('zipkin_enable'))
         self.zipkin_v2_host = self.conf.get('zipkin_v2_host') or '127.0.0.1'
         self.zipkin_v2_port = config_positive_int_value(
@@ -81,10 +157,66 @@ class ZipkinMiddleware(object):
                                                          maximum=1.0)
         else:
             self.zipkin_sample_rate = 1.0
-        self.zipkin_flush_threshold_size = config_positive_int_value(
-            self.conf.get('zipkin_flush_threshold_size', 2**20))
-        self.zipkin_flush_threshold_sec = config_float_value(
-            self.conf.get('zipkin_flush_threshold_sec', 2.0))
+        self.zipkin_sampling = self.conf.get(
+            'zipkin_sampling', SAMPLING_HEAD).strip().lower()
+        if self.zipkin_sampling not in SAMPLING_MODES:
+            raise ValueError('zipkin_sampling must be one of %s' % (
+                ', '.join(SAMPLING_MODES),))
+        self.head_sampler = self.tail_sampler = None
+        if self.zipkin_sampling == SAMPLING_ADAPTIVE:
+            self.head_sampler = RateLimitingSampler(
+                config_float_value(self.conf.get(
+                    'zipkin_target_traces_per_sec', 1.0), minimum=0.0),
+                burst=config_float_value(self.conf.get(
+                    'zipkin_target_traces_burst', 0), minimum=0.0))
+        elif self.zipkin_sampling == SAMPLING_TAIL:
+            self.tail_sampler = TailSampler(
+                latency_threshold=config_float_value(
+                    self.conf.get('zipkin_tail_latency_threshold', 1.0),
+                    minimum=0.0),
+                baseline_rate=config_float_value(
+                    self.conf.get('zipkin_tail_baseline_rate', 0.01),
+                    minimum=0.0, maximum=1.0),
+                max_pending_spans=config_positive_int_value(
+                    self.conf.get('zipkin_tail_max_pending_spans', 10000)))
+        # Raises ValueError for malformed rules
+        self.sampling_rules = get_sampling_rules(self.conf)
+        if self.sampling_rules:
+            self.head_sampler = RuleSampler(
+                self.sampling_rules, default_rate=self.zipkin_sample_rate,
+                fallback=self.head_sampler)
+        self.zipkin_throughput_interval = config_float_value(
+            self.conf.get('zipkin_throughput_interval', 0), minimum=0.0)
+        self.zipkin_b3_format = self.conf.get(
+            'zipkin_b3_format', B3_MULTI).strip().lower()
+        if self.zipkin_b3_format not in B3_FORMATS:
+            raise ValueError('zipkin_b3_format must be one of %s' % (
+                ', '.join(B3_FORMATS),))
+        self.zipkin_client_span_max_age = config_float_value(
+            self.conf.get('zipkin_client_span_max_age', 300.0),
+            minimum=0.0)
+        self.zipkin_tracer_storage = self.conf.get(
+            'zipkin_tracer_storage', 'auto').strip().lower()
+        if self.zipkin_tracer_storage == 'auto':
+            self.zipkin_tracer_storage = None
+        elif self.zipkin_tracer_storage not in STORAGE_BACKENDS:
+            raise ValueError(
+                'zipkin_tracer_storage must be one of auto, %s' % (
+                    ', '.join(STORAGE_BACKENDS),))
+        elif self.zipkin_tracer_storage == STORAGE_CONTEXTVARS and \
+                not contextvars:
+            raise ValueError('zipkin_tracer_storage = contextvars requires '
+                             'Python 3.7 or later')
+        self.ring_resolver = None
+        if config_true_value(self.conf.get('zipkin_ring_service_names')):
+            self.ring_resolver = RingResolver(
+                self.conf.get('swift_dir', '/etc/swift'),
+                logger=self.logger)
+        self.zipkin_forward_address = self.conf.get('zipkin_forward_address')
+        if self.zipkin_forward_address:
+            # Raises ValueError for malformed addresses
+            parse_forward_address(self.zipkin_forward_address)
+        self.transport_options = get_transport_options(self.conf)
 
         if not self.enabled:
             # It's not like we're going to get enabled between the first and
@@ -106,17 +238,25 @@ class ZipkinMiddleware(object):
 
         self.logger.debug('ZipkinMiddleware() count=%d PID=%d; '
                           'tracing %.0f%% of reqs to Zipkin at '
-                          '%s:%s',
+                          '%s',
                           self.__class__._instantiation_count, os.getpid(),
                           100.0 * self.zipkin_sample_rate,
-                          self.zipkin_v2_host, self.zipkin_v2_port)
+                          self.zipkin_forward_address or '%s:%s' % (
+                              self.zipkin_v2_host, self.zipkin_v2_port))
         patch_eventlet_and_swift(
             self.logger,
             self.zipkin_v2_host,
             self.zipkin_v2_port,
             self.zipkin_sample_rate,
-            self.zipkin_flush_threshold_size,
-            self.zipkin_flush_threshold_sec,
+            forward_address=self.zipkin_forward_address,
+            tail_sampler=self.tail_sampler,
+            head_sampler=self.head_sampler,
+            throughput_interval=self.zipkin_throughput_interval,
+            b3_format=self.zipkin_b3_format,
+            client_span_max_age=self.zipkin_client_span_max_age,
+            ring_resolver=self.ring_resolver,
+            storage=self.zipkin_tracer_storage,
+            **self.transport_options
         )
 
     def __call__(self, env, start_response):
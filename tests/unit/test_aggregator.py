@@ -0,0 +1,90 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from swift_zipkin import aggregator, transport
+from tests.unit.test_transport import FakeStatsdLogger
+
+
+class TestForwarding(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.address = 'unix://' + os.path.join(self.tempdir, 'zipkin.sock')
+        self.agg = aggregator.ZipkinAggregator({
+            'listen_address': self.address,
+            'zipkin_flush_threshold_sec': '3600',
+        })
+        self.agg.transport._flushers_started = True  # don't POST anything
+        self.forwarder = transport.GreenSocketTransport(
+            logging.getLogger('test'), self.address)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_parse_forward_address(self):
+        self.assertEqual(
+            (transport._real_socket.AF_INET, ('127.0.0.1', 9412)),
+            transport.parse_forward_address('udp://127.0.0.1:9412'))
+        self.assertEqual(
+            (transport._real_socket.AF_INET6, ('::1', 9412)),
+            transport.parse_forward_address('udp://[::1]:9412'))
+        for bad in ('unix://', 'udp://localhost', 'tcp://127.0.0.1:1'):
+            with self.assertRaises(ValueError):
+                transport.parse_forward_address(bad)
+
+    def test_parse_collector_endpoints(self):
+        self.assertEqual(
+            [('zipkin1', 9411), ('10.0.0.2', 9412), ('::1', 9413)],
+            transport.parse_collector_endpoints(
+                'zipkin1, 10.0.0.2:9412,[::1]:9413'))
+        for bad in ('', 'zipkin1:http', ':9411'):
+            with self.assertRaises(ValueError):
+                transport.parse_collector_endpoints(bad)
+
+    def test_no_aggregator(self):
+        self.forwarder.send(['{"traceId": "1"}'])
+        self.assertEqual({'enqueued': 1, 'dropped': 1, 'sent': 0},
+                         self.forwarder.stats)
+
+    def test_metrics(self):
+        now = [1000.0]
+        logger = FakeStatsdLogger()
+        with mock.patch('time.time', lambda: now[0]):
+            forwarder = transport.GreenSocketTransport(
+                logger, self.address, report_interval=2.0)
+            forwarder.send(['{"traceId": "1"}'])
+            forwarder.span_counts['wsgi'] += 1
+            self.assertEqual([], logger.metrics)
+            now[0] += 2.0
+            # reported as the next spans come in
+            forwarder.send(['{"traceId": "2"}'])
+        self.assertEqual(sorted([
+            ('update_stats', 'spans.enqueued', 1),
+            ('update_stats', 'spans.dropped', 1),
+            ('update_stats', 'spans.recorded.wsgi', 1),
+        ]), sorted(logger.metrics))
+        self.assertEqual({'enqueued': 2, 'dropped': 2, 'sent': 0},
+                         forwarder.stats)
+
+    def test_forward(self):
+        self.agg.bind()
+        self.forwarder.send(['{"traceId": "1"}', '{"traceId": "2"}'])
+        self.forwarder.send(['{"traceId": "3"}'])
+        self.assertEqual({'enqueued': 3, 'dropped': 0, 'sent': 3},
+                         self.forwarder.stats)
+        for _ in range(2):
+            self.agg.handle_datagram(self.agg.sock.recv(aggregator.RECV_SIZE))
+        self.agg.handle_datagram(b'garbage')
+        self.assertEqual({'received': 3, 'malformed': 1}, self.agg.stats)
+        entries = self.agg.transport.span_queue.drain()
+        self.assertEqual(
+            '[{"traceId": "1"},{"traceId": "2"},{"traceId": "3"}]',
+            transport.join_fragments(
+                [fragments[0] for fragments, _, _, _ in entries]))
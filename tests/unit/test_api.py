@@ -0,0 +1,281 @@
+import json
+import os
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import eventlet
+import greenlet
+from eventlet import greenthread as eventlet_greenthread
+from py_zipkin.storage import Stack
+from py_zipkin.util import ZipkinAttrs
+
+from swift_zipkin import api, greenthread
+
+
+class TestProcessCache(unittest.TestCase):
+
+    def setUp(self):
+        api._reset_process_cache()
+        self.addCleanup(api._reset_process_cache)
+
+    def test_get_endpoint(self):
+        endpoint = api.get_endpoint(6200, 'swift-object-server', '10.0.0.2')
+        self.assertEqual('10.0.0.2', endpoint.ipv4)
+        self.assertEqual(6200, endpoint.port)
+        self.assertIs(endpoint, api.get_endpoint(
+            6200, 'swift-object-server', '10.0.0.2'))
+        self.assertIsNot(endpoint, api.get_endpoint(
+            6201, 'swift-object-server', '10.0.0.2'))
+        # the local host's address is only looked up once
+        with mock.patch('socket.gethostbyname',
+                        return_value='10.0.0.1') as lookup:
+            local = api.get_endpoint(None, 'proxy-server', None)
+            self.assertIs(local, api.get_endpoint(None, 'proxy-server', None))
+        self.assertEqual('10.0.0.1', local.ipv4)
+        self.assertEqual(1, lookup.call_count)
+
+    def test_max_cached_endpoints(self):
+        with mock.patch.object(api, 'MAX_CACHED_ENDPOINTS', 2):
+            for port in range(4):
+                api.get_endpoint(port, 'svc', '10.0.0.2')
+            self.assertEqual(2, len(api._process_cache['endpoints']))
+            self.assertEqual(3, api.get_endpoint(3, 'svc', '10.0.0.2').port)
+
+    def test_reset_on_fork(self):
+        self.assertEqual(str(os.getpid()), api.worker_pid())
+        endpoint = api.get_endpoint(6200, 'svc', '10.0.0.2')
+        with mock.patch('os.getpid', return_value=12345):
+            # what happens in a forked child
+            api._reset_process_cache()
+            self.assertEqual('12345', api.worker_pid())
+            self.assertIsNot(endpoint, api.get_endpoint(6200, 'svc',
+                                                        '10.0.0.2'))
+
+    def test_generate_ids(self):
+        span_id = api.generate_random_64bit_string()
+        self.assertEqual(16, len(span_id))
+        int(span_id, 16)
+        with mock.patch('time.time', return_value=0x5f000000):
+            trace_id = api.generate_random_128bit_string()
+        self.assertEqual(32, len(trace_id))
+        self.assertTrue(trace_id.startswith('5f000000'))
+        # a forked child gets its own sequence
+        getrandbits = api._process_cache['getrandbits']
+        api._reset_process_cache()
+        self.assertIsNot(getrandbits, api._process_cache['getrandbits'])
+
+
+class TestSpanSavingTracer(unittest.TestCase):
+
+    def attrs(self, span_id):
+        return ZipkinAttrs('t', span_id, None, '0', True)
+
+    def test_stacks(self):
+        tracer = api.SpanSavingTracer()
+        self.assertIsNone(tracer.get_zipkin_attrs())
+        self.assertIsNone(tracer.pop_zipkin_attrs())
+        self.assertIsNone(tracer.pop_span_ctx())
+        tracer.push_zipkin_attrs(self.attrs('1'))
+        tracer.push_zipkin_attrs(self.attrs('2'))
+        tracer.push_span_ctx('span')
+        self.assertEqual('2', tracer.get_zipkin_attrs().span_id)
+        self.assertEqual('span', tracer.get_span_ctx())
+        # what py_zipkin's thread_local helpers look at
+        self.assertEqual(['1', '2'], [
+            a.span_id for a in tracer._context_stack._storage])
+        self.assertEqual('2', tracer.pop_zipkin_attrs().span_id)
+        self.assertEqual('1', tracer.get_zipkin_attrs().span_id)
+        tracer._context_stack = Stack([self.attrs('3')])
+        self.assertEqual('3', tracer.pop_zipkin_attrs().span_id)
+        self.assertIsNone(tracer.get_zipkin_attrs())
+
+    def test_copy_shares_until_pushed(self):
+        tracer = api.SpanSavingTracer()
+        tracer.tail_trace = object()
+        tracer.push_zipkin_attrs(self.attrs('1'))
+        tracer.push_span_ctx('root')
+        the_copy = tracer.copy()
+        self.assertIsInstance(the_copy, api.SpanSavingTracer)
+        self.assertIs(tracer._attrs_top, the_copy._attrs_top)
+        self.assertIs(tracer.get_spans(), the_copy.get_spans())
+        self.assertIs(tracer.tail_trace, the_copy.tail_trace)
+
+        the_copy.push_zipkin_attrs(self.attrs('2'))
+        the_copy.push_span_ctx('child')
+        tracer.pop_zipkin_attrs()
+        tracer.pop_span_ctx()
+        self.assertIsNone(tracer.get_zipkin_attrs())
+        self.assertIsNone(tracer.get_span_ctx())
+        self.assertEqual('2', the_copy.pop_zipkin_attrs().span_id)
+        self.assertEqual('1', the_copy.get_zipkin_attrs().span_id)
+        self.assertEqual('child', the_copy.pop_span_ctx())
+        self.assertEqual('root', the_copy.get_span_ctx())
+
+    def check_spawned_greenthreads(self, storage):
+        api.set_storage(storage)
+        self.addCleanup(api.set_storage, api.STORAGE_THREAD_LOCAL)
+        for patcher in [mock.patch('py_zipkin.zipkin.get_default_tracer',
+                                   api.get_default_tracer)] + [
+                mock.patch.object(
+                    eventlet_greenthread.GreenThread, name,
+                    getattr(eventlet_greenthread.GreenThread, name))
+                for name in ('__init__', 'main')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        greenthread.patch()
+
+        def child():
+            tracer = api.get_default_tracer()
+            return tracer, tracer.get_zipkin_attrs()
+
+        # nothing to hand on
+        self.assertIsNone(eventlet.spawn(child).wait()[1])
+        with api.ezipkin_server_span('svc', span_name='GET', sample_rate=100,
+                                     transport_handler=lambda p: None) as root:
+            tracer = api.get_default_tracer()
+            child_tracer, attrs = eventlet.spawn(child).wait()
+            self.assertIs(root.zipkin_attrs, attrs)
+            self.assertIsNot(tracer, child_tracer)
+            self.assertIs(tracer.get_spans(), child_tracer.get_spans())
+            self.assertIs(tracer, api.current_tracer())
+
+    def test_spawned_greenthreads(self):
+        self.check_spawned_greenthreads(api.STORAGE_THREAD_LOCAL)
+
+    @unittest.skipIf(api.contextvars is None, 'needs contextvars')
+    def test_spawned_greenthreads_contextvars(self):
+        self.check_spawned_greenthreads(api.STORAGE_CONTEXTVARS)
+        self.assertIs(eventlet_greenthread.GreenThread.main,
+                      greenthread.__original_main__)
+
+
+class TestStorage(unittest.TestCase):
+
+    def tearDown(self):
+        api.set_storage(api.STORAGE_THREAD_LOCAL)
+
+    def test_set_storage(self):
+        api.set_storage(api.STORAGE_THREAD_LOCAL)
+        self.assertEqual(api.STORAGE_THREAD_LOCAL, api.storage)
+        tls_get = api.get_default_tracer
+        api.set_storage()
+        if api.contextvars is None:
+            self.assertIs(tls_get, api.get_default_tracer)
+        else:
+            self.assertEqual(api.STORAGE_CONTEXTVARS, api.storage)
+            self.assertIsNot(tls_get, api.get_default_tracer)
+        self.assertRaises(ValueError, api.set_storage, 'redis')
+
+    @unittest.skipIf(api.contextvars is None, 'needs contextvars')
+    def test_contextvars(self):
+        api.set_storage(api.STORAGE_CONTEXTVARS)
+
+        def in_new_greenlet():
+            self.assertFalse(api.has_default_tracer())
+            self.assertIsNone(api.current_tracer())
+            tracer = api.get_default_tracer()
+            self.assertIsInstance(tracer, api.SpanSavingTracer)
+            self.assertIs(tracer, api.current_tracer())
+            self.assertTrue(api.has_default_tracer())
+            api.set_default_tracer(api.SpanSavingTracer())
+            self.assertIsNot(tracer, api.get_default_tracer())
+            return api.get_default_tracer()
+
+        first = greenlet.greenlet(in_new_greenlet).switch()
+        self.assertIsNot(first, greenlet.greenlet(in_new_greenlet).switch())
+
+
+class TestB3Headers(unittest.TestCase):
+
+    def setUp(self):
+        self.attrs = api.ZipkinAttrs('%032x' % 1, '%016x' % 2, '%016x' % 3,
+                                     '0', True)
+
+    def test_b3_header_value(self):
+        self.assertEqual('%032x-%016x-1-%016x' % (1, 2, 3),
+                         api.b3_header_value(self.attrs))
+        self.assertEqual('%032x-%016x-0' % (1, 2), api.b3_header_value(
+            self.attrs._replace(parent_span_id=None, is_sampled=False)))
+        self.assertEqual('%032x-%016x-d-%016x' % (1, 2, 3),
+                         api.b3_header_value(self.attrs._replace(flags='1')))
+        self.assertEqual('%032x-%016x' % (1, 2),
+                         api.b3_header_value(self.attrs, deferred=True))
+        # and it round-trips
+        self.assertEqual(self.attrs, api.extract_zipkin_attrs_from_headers(
+            {'b3': api.b3_header_value(self.attrs)}))
+
+    def test_put_http_headers(self):
+        span = api.ezipkin_client_span('svc', span_name='GET',
+                                       zipkin_attrs=self.attrs,
+                                       transport_handler=mock.Mock(),
+                                       _tracer=api.SpanSavingTracer())
+        headers = []
+        span.zipkin_attrs = self.attrs  # as if it were started
+        span.put_http_headers(lambda *h: headers.append(h))
+        self.assertEqual([
+            ('X-B3-TraceId', '%032x' % 1),
+            ('X-B3-SpanId', '%016x' % 2),
+            ('X-B3-ParentSpanId', '%016x' % 3),
+            ('X-B3-Flags', '0'),
+            ('X-B3-Sampled', '1'),
+        ], headers)
+        self.assertEqual(('X-B3-Sampled', '0'), api.unsampled_header())
+        with mock.patch.object(api, 'b3_format', api.B3_SINGLE):
+            self.assertEqual({'b3': '%032x-%016x-1-%016x' % (1, 2, 3)},
+                             span.create_http_headers_for_my_span())
+            self.assertEqual(('b3', '0'), api.unsampled_header())
+
+
+class TestLeafClientSpan(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('py_zipkin.zipkin.get_default_tracer',
+                             api.get_default_tracer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sent = []
+
+    def test_not_sampled(self):
+        with api.LeafClientSpan('svc', span_name='get') as span:
+            headers = []
+            span.put_http_headers(lambda *h: headers.append(h))
+        self.assertIsNone(span.zipkin_attrs)
+        self.assertEqual([], headers)
+        self.assertEqual([], list(api.get_default_tracer().get_spans()))
+
+    def test_recorded(self):
+        with api.ezipkin_server_span(
+                'svc', span_name='GET', sample_rate=100,
+                transport_handler=self.sent.append) as root:
+            with api.LeafClientSpan(
+                    'svc', span_name='get',
+                    binary_annotations={'memcached.key': 'k'}) as span:
+                span.set_remote_endpoint(api.get_endpoint(
+                    11211, 'memcached', '10.0.0.3'))
+                span.add_annotation('Sent', 1000.0)
+                # it's not on the context stack
+                self.assertIs(root, api.get_default_tracer().get_span_ctx())
+            try:
+                with api.LeafClientSpan('svc', span_name='put'):
+                    raise ValueError('oops')
+            except ValueError:
+                pass
+        self.assertEqual(root.zipkin_attrs.trace_id, span.trace_id)
+        self.assertEqual(root.zipkin_attrs.span_id, span.parent_id)
+        self.assertIsNone(span.tracer)
+        spans = dict((s['name'], s) for s in json.loads(self.sent[0]))
+        self.assertEqual(['GET', 'get', 'put'], sorted(spans))
+        leaf = spans['get']
+        self.assertEqual('CLIENT', leaf['kind'])
+        self.assertEqual(span.span_id, leaf['id'])
+        self.assertEqual(span.parent_id, leaf['parentId'])
+        self.assertEqual({'memcached.key': 'k'}, leaf['tags'])
+        self.assertEqual([{'timestamp': 1000000000, 'value': 'Sent'}],
+                         leaf['annotations'])
+        self.assertEqual({'serviceName': 'memcached', 'ipv4': '10.0.0.3',
+                          'port': 11211}, leaf['remoteEndpoint'])
+        self.assertEqual('svc', leaf['localEndpoint']['serviceName'])
+        self.assertEqual({'error': 'ValueError: oops'}, spans['put']['tags'])
@@ -0,0 +1,320 @@
+import collections
+import errno
+import gc
+import json
+import time
+import unittest
+import weakref
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import eventlet
+from eventlet.green import httplib
+
+from swift_zipkin import api, http, transport
+
+
+def serve(sock):
+    fp = sock.makefile('rb')
+    try:
+        while True:
+            line = fp.readline()
+            if not line:
+                return
+            while line not in (b'\r\n', b'\n', b''):
+                line = fp.readline()
+            sock.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+    except (IOError, OSError):
+        pass
+    finally:
+        fp.close()
+        sock.close()
+
+
+class TestClientSpans(unittest.TestCase):
+
+    def setUp(self):
+        for cls, name in ((httplib.HTTPConnection, 'endheaders'),
+                          (httplib.HTTPConnection, 'close'),
+                          (httplib.HTTPConnection, 'getresponse'),
+                          (httplib.HTTPResponse, '_read_status'),
+                          (httplib.HTTPResponse, 'close')):
+            patcher = mock.patch.object(cls, name, getattr(cls, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for patcher in (
+                mock.patch('py_zipkin.zipkin.get_default_tracer',
+                           api.get_default_tracer),
+                mock.patch.object(transport, 'global_transport', mock.Mock(
+                    stats={}, span_counts=collections.Counter()))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        http.patch()
+        self.addCleanup(http._open_spans.clear)
+        self.addCleanup(self.kill_reaper)
+
+        listener = eventlet.listen(('127.0.0.1', 0))
+        self.port = listener.getsockname()[1]
+        server = eventlet.spawn(self.accept, listener)
+        self.addCleanup(listener.close)
+        self.addCleanup(server.kill)
+        self.sent = []
+
+    def kill_reaper(self):
+        if http._reaper is not None:
+            eventlet.kill(http._reaper)
+
+    def accept(self, listener):
+        while True:
+            sock, _ = listener.accept()
+            eventlet.spawn_n(serve, sock)
+
+    def root_span(self):
+        return api.ezipkin_server_span(
+            'svc', span_name='GET', sample_rate=100,
+            transport_handler=self.sent.append)
+
+    def request(self, method='GET'):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        # as set by swift's http_connect
+        conn.path = '/sda1/0/a/c/o'
+        conn.request(method, conn.path)
+        return conn
+
+    def recorded(self):
+        return [s for payload in self.sent for s in json.loads(payload)
+                if s['kind'] == 'CLIENT']
+
+    def test_closed_response(self):
+        with self.root_span():
+            conn = self.request()
+            self.assertIsNotNone(conn._zipkin_span)
+            resp = conn.getresponse()
+            self.assertEqual(b'ok', resp.read())
+            self.assertFalse(hasattr(conn, '_zipkin_span'))
+            self.assertEqual(1, len(http._open_spans))
+            resp.close()
+            self.assertEqual({}, http._open_spans)
+            resp.close()
+            conn.close()
+        span, = self.recorded()
+        self.assertEqual('200', span['tags']['http.status_code'])
+        annotations = sorted(span['annotations'],
+                             key=lambda a: a['timestamp'])
+        self.assertEqual(['Connect start', 'Connected', 'Headers sent',
+                          'First response byte', 'Response headers received'],
+                         [a['value'] for a in annotations])
+        self.assertLessEqual(annotations[-1]['timestamp'],
+                             span['timestamp'] + span['duration'])
+        self.assertEqual({}, transport.global_transport.stats)
+
+    def test_body_sent(self):
+        with self.root_span():
+            conn = httplib.HTTPConnection('127.0.0.1', self.port)
+            conn.path = '/sda1/0/a/c/o'
+            conn.putrequest('PUT', conn.path)
+            conn.putheader('Content-Length', '6')
+            conn.endheaders()
+            conn.send(b'abc')
+            conn.send(b'def')
+            conn.getresponse().close()
+            conn.close()
+        span, = self.recorded()
+        annotations = dict((a['value'], a['timestamp'])
+                           for a in span['annotations'])
+        self.assertLess(annotations['Headers sent'],
+                        annotations['Body sent'])
+        self.assertLessEqual(annotations['Body sent'],
+                             annotations['First response byte'])
+
+    def test_request_with_body(self):
+        # request() hands the body (and more) on to endheaders()
+        with self.root_span():
+            conn = httplib.HTTPConnection('127.0.0.1', self.port)
+            conn.path = '/sda1/0/a/c/o'
+            conn.request('PUT', conn.path, body=b'abcdef')
+            resp = conn.getresponse()
+            self.assertEqual(b'ok', resp.read())
+            resp.close()
+            conn.close()
+        span, = self.recorded()
+        self.assertEqual('PUT', span['name'].upper())
+        self.assertEqual('200', span['tags']['http.status_code'])
+        self.assertIn('Body sent', [a['value'] for a in span['annotations']])
+
+    def test_request_with_body_not_sampled(self):
+        # ...as it must when we're not tracing, too
+        for unsampled in (False, True):
+            api.set_unsampled(unsampled)
+            conn = httplib.HTTPConnection('127.0.0.1', self.port)
+            try:
+                with mock.patch.object(http, '__org_endheaders__') as org:
+                    conn.request('PUT', '/sda1/0/a/c/o', body=b'abcdef')
+            finally:
+                api.set_unsampled(False)
+                conn.close()
+            org.assert_called_once_with(conn, b'abcdef',
+                                        encode_chunked=False)
+        self.assertEqual([], self.sent)
+
+    def test_connect_fails(self):
+        listener = eventlet.listen(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        with self.root_span():
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.path = '/sda1/0/a/c/o'
+            self.assertRaises(IOError, conn.request, 'GET', conn.path)
+            self.assertFalse(hasattr(conn, '_zipkin_span'))
+            conn.close()
+        span, = self.recorded()
+        self.assertIn('[Errno %d]' % errno.ECONNREFUSED,
+                      span['tags']['error'])
+        self.assertEqual(['Connect start'],
+                         [a['value'] for a in span['annotations']])
+
+    def test_head_closes_at_once(self):
+        with self.root_span():
+            conn = self.request('HEAD')
+            conn.getresponse()
+            self.assertEqual({}, http._open_spans)
+            conn.close()
+        self.assertEqual(1, len(self.recorded()))
+
+    def test_no_response(self):
+        with self.root_span():
+            conn = self.request()
+            conn.close()
+            self.assertEqual({}, http._open_spans)
+        span, = self.recorded()
+        self.assertNotIn('http.status_code', span['tags'])
+
+    def test_abandoned_response_reaped(self):
+        with self.root_span():
+            resp = self.request().getresponse()
+            resp.read()
+            self.assertEqual(1, len(http._open_spans))
+            later = time.time() + 61
+            with mock.patch.object(api, 'client_span_max_age', 60), \
+                    mock.patch('time.time', return_value=later):
+                self.request().close()
+            self.assertEqual({}, http._open_spans)
+            # closing it late doesn't record it twice
+            resp.close()
+        reaped = [a['value'] for span in self.recorded()
+                  for a in span['annotations']
+                  if a['value'].startswith('Force-closed')]
+        self.assertEqual(['Force-closed: older than 60s'], reaped)
+        self.assertEqual({'reaped': 1}, transport.global_transport.stats)
+
+    def test_reaped_while_idle(self):
+        with mock.patch.object(api, 'client_span_max_age', 0.05), \
+                mock.patch.object(http, 'REAP_INTERVAL', 0.01):
+            with self.root_span():
+                resp = self.request().getresponse()
+                self.assertIsNotNone(http._reaper)
+            self.assertEqual([], self.recorded())
+            # no more requests come along
+            eventlet.sleep(0.2)
+            self.assertEqual({}, http._open_spans)
+            # with nothing left open, the reaper's done too
+            self.assertIsNone(http._reaper)
+            resp.close()
+        # too late to go with its trace, so it's sent by itself
+        self.assertEqual(2, len(self.sent))
+        span, = self.recorded()
+        self.assertEqual(['Force-closed: older than 0.05s'], [
+            a['value'] for a in span['annotations']
+            if a['value'].startswith('Force-closed')])
+        self.assertEqual({'reaped': 1}, transport.global_transport.stats)
+
+    def test_closed_after_trace_sent(self):
+        with self.root_span():
+            resp = self.request().getresponse()
+        self.assertEqual(1, len(self.sent))
+        resp.close()
+        self.assertEqual(2, len(self.sent))
+        span, = json.loads(self.sent[1])
+        self.assertEqual('200', span['tags']['http.status_code'])
+        root, = json.loads(self.sent[0])
+        self.assertEqual(root['id'], span['parentId'])
+
+    def test_dropped_connection_not_pinned(self):
+        with self.root_span():
+            conn = self.request()
+            span_ref = weakref.ref(conn._zipkin_span)
+            self.assertEqual(1, len(http._open_spans))
+            # thrown away without close()
+            del conn
+            gc.collect()
+            self.assertIsNone(span_ref())
+            self.assertEqual({}, http._open_spans)
+
+    def test_max_age_zero_never_reaps(self):
+        with self.root_span():
+            responses = [self.request().getresponse()]
+            later = time.time() + 10 ** 6
+            with mock.patch.object(api, 'client_span_max_age', 0), \
+                    mock.patch('time.time', return_value=later):
+                responses.append(self.request().getresponse())
+            self.assertEqual(2, len(http._open_spans))
+        self.assertEqual({}, transport.global_transport.stats)
+
+    def test_too_many_open(self):
+        with self.root_span(), mock.patch.object(http, 'MAX_OPEN_SPANS', 2):
+            responses = [self.request().getresponse() for _ in range(4)]
+            self.assertEqual(2, len(http._open_spans))
+            self.assertEqual([False, False, True, True], [
+                http._is_open(resp._zipkin_span) for resp in responses])
+        self.assertEqual({'reaped': 2}, transport.global_transport.stats)
+
+    def test_fd_reused(self):
+        with self.root_span():
+            stale = self.request()
+            fd = stale.sock.fileno()
+            # its socket goes away without HTTPConnection.close()
+            stale.sock.close()
+            conn = self.request()
+            self.assertEqual(fd, conn.sock.fileno())
+            span_ctx = conn._zipkin_span
+            resp = conn.getresponse()
+            # the response goes with its own connection's span
+            self.assertIs(span_ctx, resp._zipkin_span)
+            self.assertTrue(http._is_open(stale._zipkin_span))
+            resp.close()
+            stale.close()
+            self.assertEqual({}, http._open_spans)
+        spans = self.recorded()
+        self.assertEqual(2, len(spans))
+        self.assertEqual(['200'], [s['tags'].get('http.status_code')
+                                   for s in spans
+                                   if 'http.status_code' in s['tags']])
+        self.assertEqual({}, transport.global_transport.stats)
+
+    def test_no_status_line(self):
+        def hang_up(sock):
+            sock.makefile('rb').readline()
+            sock.close()
+
+        self.accept = lambda listener: hang_up(listener.accept()[0])
+        listener = eventlet.listen(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        server = eventlet.spawn(self.accept, listener)
+        self.addCleanup(server.kill)
+        with self.root_span():
+            conn = httplib.HTTPConnection('127.0.0.1',
+                                          listener.getsockname()[1])
+            conn.path = '/sda1/0/a/c/o'
+            conn.request('GET', conn.path)
+            self.assertRaises(httplib.HTTPException, conn.getresponse)
+            self.assertEqual({}, http._open_spans)
+            conn.close()
+        span, = self.recorded()
+        self.assertIn('error', span['tags'])
+        self.assertNotIn('http.status_code', span['tags'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import array
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import eventlet
+from swift.common.ring import RingData
+
+from swift_zipkin import api, http, rings
+from tests.unit.test_transport import wait_for
+
+
+def make_dev(dev_id, ip, port, device, zone=1, region=1, **kwargs):
+    dev = {'id': dev_id, 'ip': ip, 'port': port, 'device': device,
+           'zone': zone, 'region': region, 'weight': 1.0}
+    dev.update(kwargs)
+    return dev
+
+
+class TestRingResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.resolver = rings.RingResolver(self.tempdir, check_interval=0)
+
+    def tearDown(self):
+        self.resolver.stop()
+        shutil.rmtree(self.tempdir)
+
+    def save_ring(self, name, devs, mtime=None):
+        path = os.path.join(self.tempdir, name)
+        RingData([array.array('H', [0])], devs, 31).save(path)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+    def test_lookup(self):
+        self.save_ring('account.ring.gz', [
+            make_dev(0, '10.0.0.1', 6202, 'sda', zone=2, region=3)])
+        self.save_ring('object.ring.gz', [
+            make_dev(0, '10.0.0.1', 6200, 'sda',
+                     replication_ip='10.1.0.1', replication_port=6300),
+            None])
+        self.save_ring('object-2.ring.gz', [
+            make_dev(0, '10.0.0.1', 6200, 'sdb')])
+        # not a ring we know
+        self.save_ring('object.builder.ring.gz', [
+            make_dev(0, '10.0.0.1', 6200, 'sdc')])
+        self.resolver.start()
+
+        self.assertEqual(('swift-account-server', {
+            'swift.device': 'sda', 'swift.region': '3', 'swift.zone': '2',
+        }), self.resolver.get('10.0.0.1', 6202, 'sda'))
+        service = ('swift-object-server', {
+            'swift.device': 'sda', 'swift.region': '1', 'swift.zone': '1',
+            'swift.storage_policy': '0'})
+        self.assertEqual(service, self.resolver.get('10.0.0.1', 6200, 'sda'))
+        self.assertEqual(service, self.resolver.get('10.1.0.1', 6300, 'sda'))
+        self.assertEqual('2', self.resolver.get(
+            '10.0.0.1', 6200, 'sdb')[1]['swift.storage_policy'])
+        self.assertIsNone(self.resolver.get('10.0.0.1', 6200, 'sdc'))
+        self.assertIsNone(self.resolver.get('10.0.0.2', 6200, 'sda'))
+
+    def test_reload_when_changed(self):
+        self.save_ring('container.ring.gz', [
+            make_dev(0, '10.0.0.1', 6201, 'sda')], mtime=1000)
+        self.resolver.check_interval = 0.01
+        self.resolver.start()
+        self.assertIsNotNone(self.resolver.get('10.0.0.1', 6201, 'sda'))
+        with mock.patch.object(rings.RingData, 'load') as load:
+            # never from the request path
+            self.resolver.get('10.0.0.1', 6201, 'sda')
+            self.resolver.reload()
+        load.assert_not_called()
+
+        self.save_ring('container.ring.gz', [
+            make_dev(0, '10.0.0.2', 6201, 'sda')], mtime=2000)
+        # the reloader picks it up
+        wait_for(lambda: self.resolver.get('10.0.0.2', 6201, 'sda'))
+        self.assertIsNone(self.resolver.get('10.0.0.1', 6201, 'sda'))
+
+        self.resolver.stop()
+        self.save_ring('container.ring.gz', [
+            make_dev(0, '10.0.0.3', 6201, 'sda')], mtime=3000)
+        eventlet.sleep(0.05)
+        self.assertIsNone(self.resolver.get('10.0.0.3', 6201, 'sda'))
+
+    def test_bad_ring(self):
+        logger = mock.Mock()
+        self.resolver.logger = logger
+        with open(os.path.join(self.tempdir, 'account.ring.gz'), 'wb') as f:
+            f.write(b'junk')
+        self.save_ring('object.ring.gz', [
+            make_dev(0, '10.0.0.1', 6200, 'sda')])
+        self.resolver.start()
+        self.assertIsNotNone(self.resolver.get('10.0.0.1', 6200, 'sda'))
+        self.assertEqual(1, logger.error.call_count)
+        self.assertIn('account.ring.gz', logger.error.call_args[0][1])
+
+
+class TestRemoteService(unittest.TestCase):
+
+    def test_guessed(self):
+        for port, service in ((6002, 'swift-account-server'),
+                              (6001, 'swift-container-server'),
+                              (6200, 'swift-object-server')):
+            self.assertEqual((service, None), http._remote_service(
+                '10.0.0.1', port, '/d12/345/a/c/o'))
+        self.assertEqual(('unknown', None), http._remote_service(
+            '10.0.0.1', 6200, '/sda/345/a/c/o'))
+        self.assertEqual(('unknown', None), http._remote_service(
+            '10.0.0.1', 80, 'odd'))
+
+    def test_resolved(self):
+        resolver = mock.Mock()
+        resolver.get.return_value = ('swift-object-server', {'a': 'b'})
+        with mock.patch.object(api, 'ring_resolver', resolver):
+            self.assertEqual(
+                ('swift-object-server', {'a': 'b'}),
+                http._remote_service('10.0.0.1', 6200, '/sda/345/a/c/o'))
+            resolver.get.assert_called_once_with('10.0.0.1', 6200, 'sda')
+            # not in the rings
+            resolver.get.return_value = None
+            self.assertEqual(
+                ('swift-object-server', None),
+                http._remote_service('10.0.0.1', 6200, '/d1/345/a/c/o'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,300 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import eventlet
+from eventlet import event, greenthread as eventlet_greenthread
+
+from swift_zipkin import (
+    api, greenthread, http, sampling, transport, wsgi)
+
+
+class FakeConnection(object):
+    _method = 'GET'
+    path = '/sda1/1/a/c/o'
+    host = '10.0.0.2'
+    port = 6200
+
+    def __init__(self):
+        self.headers = []
+
+    def putheader(self, header, value):
+        self.headers.append((header, value))
+
+
+class FakeProtocol(object):
+    command = 'GET'
+    path = '/v1/a/c/o'
+
+    def __init__(self, headers):
+        self.headers = headers
+        # any socket digging would blow up
+        self.request = None
+        self.environ = None
+
+
+class TestUnsampledFastPath(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_rate = api.sample_rate_pct
+
+    def tearDown(self):
+        api.sample_rate_pct = self.orig_rate
+        api.set_unsampled(False)
+
+    def test_should_sample(self):
+        api.sample_rate_pct = 0
+        self.assertEqual((False, None), api.should_sample({}))
+        api.sample_rate_pct = 100
+        self.assertEqual((True, None), api.should_sample({}))
+        # an upstream decision wins
+        is_sampled, attrs = api.should_sample({'X-B3-Sampled': '0'})
+        self.assertFalse(is_sampled)
+        is_sampled, attrs = api.should_sample({
+            'X-B3-TraceId': '%032x' % 1, 'X-B3-SpanId': '%016x' % 2,
+            'X-B3-Sampled': '1'})
+        self.assertTrue(is_sampled)
+        self.assertEqual('%032x' % 1, attrs.trace_id)
+        # garbage is ignored
+        self.assertEqual((True, None),
+                         api.should_sample({'X-B3-Sampled': 'maybe'}))
+
+    def test_unsampled_request(self):
+        api.sample_rate_pct = 0
+        seen = []
+
+        def fake_handle_one_response(protocol):
+            seen.append((api.is_unsampled(), api.is_sampled()))
+            conn = FakeConnection()
+            with mock.patch.object(http, '__org_endheaders__') as org:
+                http._patched_endheaders(conn)
+            org.assert_called_once_with(conn)
+            seen.append(conn.headers)
+
+        with mock.patch.object(wsgi, '__original_handle_one_response__',
+                               fake_handle_one_response):
+            wsgi._patched_handle_one_response(FakeProtocol({}))
+        self.assertEqual([(True, False), [('X-B3-Sampled', '0')]], seen)
+        self.assertFalse(api.is_unsampled())
+
+    def test_no_request(self):
+        # e.g. a background daemon's connection: nothing to propagate
+        conn = FakeConnection()
+        with mock.patch.object(http, '__org_endheaders__'):
+            http._patched_endheaders(conn)
+        self.assertEqual([], conn.headers)
+
+
+class ListTransport(transport.FragmentTransportHandler):
+
+    def __init__(self):
+        self.sent = []
+
+    def get_max_payload_bytes(self):
+        return None
+
+    def send(self, payload):
+        self.sent.append(payload)
+
+
+class TestTailSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.sampler = sampling.TailSampler(latency_threshold=0,
+                                            baseline_rate=0,
+                                            max_pending_spans=3)
+        patcher = mock.patch.object(api, 'tail_sampler', self.sampler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('py_zipkin.zipkin.get_default_tracer',
+                             api.get_default_tracer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transport = ListTransport()
+
+    def test_should_sample(self):
+        self.assertEqual((api.TAIL_SAMPLED, None), api.should_sample({}))
+        # upstream decisions still win
+        headers = {'X-B3-TraceId': '%032x' % 1, 'X-B3-SpanId': '%016x' % 2,
+                   'X-B3-Sampled': '1'}
+        self.assertEqual(api.SAMPLED, api.should_sample(headers)[0])
+        # ...unless it was deferred
+        del headers['X-B3-Sampled']
+        decision, attrs = api.should_sample(headers)
+        self.assertEqual(api.TAIL_SAMPLED, decision)
+        self.assertTrue(attrs.is_sampled)
+        self.assertEqual(api.TAIL_SAMPLED, api.should_sample(
+            {'b3': '%032x-%016x' % (1, 2)})[0])
+        self.sampler.pending_spans = 3
+        self.assertEqual((api.UNSAMPLED, None), api.should_sample({}))
+        self.assertEqual(1, self.sampler.stats['skipped'])
+
+    def trace(self, status_code=200, child_error=False):
+        with api.ezipkin_server_span(
+                'svc', span_name='GET', sample_rate=100,
+                transport_handler=self.transport,
+                tail_sampler=self.sampler) as root:
+            for _ in range(2):
+                with api.ezipkin_client_span('svc', span_name='get') as span:
+                    self.headers = span.create_http_headers_for_my_span()
+                    if child_error:
+                        span.update_binary_annotations({'error': 'oops'})
+            self.assertEqual(2, self.sampler.pending_spans)
+            root.update_binary_annotations({'http.status_code': status_code})
+        self.assertEqual(0, self.sampler.pending_spans)
+        self.assertIsNone(api.get_default_tracer().tail_trace)
+
+    def test_boring_trace_discarded(self):
+        self.trace()
+        self.assertEqual([], self.transport.sent)
+        self.assertNotIn('X-B3-Sampled', self.headers)
+        self.assertEqual({'kept': 0, 'discarded': 1, 'skipped': 0},
+                         self.sampler.stats)
+
+    def test_interesting_traces_kept(self):
+        self.trace(status_code=503)
+        self.trace(child_error=True)
+        self.assertEqual([3, 3], [len(p) for p in self.transport.sent])
+        self.assertEqual(2, self.sampler.stats['kept'])
+
+    def test_full(self):
+        self.sampler.max_pending_spans = 1
+        with api.ezipkin_server_span(
+                'svc', span_name='GET', sample_rate=100,
+                transport_handler=self.transport,
+                tail_sampler=self.sampler):
+            with api.ezipkin_client_span('svc', span_name='get'):
+                pass
+            self.assertFalse(api.is_sampled())
+
+    def test_late_span_not_counted(self):
+        for patcher in [mock.patch.object(
+                eventlet_greenthread.GreenThread, name,
+                getattr(eventlet_greenthread.GreenThread, name))
+                for name in ('__init__', 'main')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        greenthread.patch()
+        root_done = event.Event()
+
+        def child():
+            span = api.LeafClientSpan('svc', span_name='get').start()
+            root_done.wait()
+            # e.g. a backend response closed after the proxy's responded
+            span.stop()
+            # ...and nothing new gets started
+            return api.is_sampled()
+
+        with api.ezipkin_server_span(
+                'svc', span_name='GET', sample_rate=100,
+                transport_handler=self.transport,
+                tail_sampler=self.sampler):
+            child_gt = eventlet.spawn(child)
+            eventlet.sleep(0)
+        root_done.send()
+        self.assertFalse(child_gt.wait())
+        self.assertEqual(0, self.sampler.pending_spans)
+        self.assertEqual(1, self.sampler.stats['discarded'])
+        # nor left behind for the next trace
+        self.assertEqual(0, len(api.get_default_tracer().get_spans()))
+
+
+class TestRateLimitingSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_for(self, sampler, seconds, per_sec):
+        sampled = 0
+        for _ in range(seconds * per_sec):
+            self.now += 1.0 / per_sec
+            sampled += sampler.sample('GET', '/v1/a/c/o', {})
+        return sampled
+
+    def test_bounded_by_target(self):
+        sampler = sampling.RateLimitingSampler(10)
+        # quiet: everything's traced
+        self.assertEqual(50, self.run_for(sampler, 10, 5))
+        self.assertEqual(1.0, sampler.probability)
+        # busy: about the target, however busy
+        for per_sec in (100, 1000):
+            sampled = self.run_for(sampler, 10, per_sec)
+            self.assertLessEqual(sampled, 10 * 10 + sampler.burst)
+        self.assertAlmostEqual(0.01, sampler.probability, delta=0.005)
+        # and it recovers once things quiet down again
+        self.run_for(sampler, 20, 5)
+        self.assertEqual(1.0, sampler.probability)
+
+    def test_burst(self):
+        sampler = sampling.RateLimitingSampler(2, burst=5)
+        sampled = sum(sampler.sample() for _ in range(100))
+        self.assertEqual(5, sampled)
+
+    def test_should_sample(self):
+        sampler = sampling.RateLimitingSampler(1)
+        with mock.patch.object(api, 'head_sampler', sampler):
+            self.assertEqual((api.SAMPLED, None),
+                             api.should_sample({}, 'GET', '/'))
+            self.assertEqual((api.UNSAMPLED, None),
+                             api.should_sample({}, 'GET', '/'))
+            # upstream decisions still win
+            decision, attrs = api.should_sample({
+                'X-B3-TraceId': '%032x' % 1, 'X-B3-SpanId': '%016x' % 2,
+                'X-B3-Sampled': '1'})
+            self.assertEqual(api.SAMPLED, decision)
+
+
+class TestRuleSampler(unittest.TestCase):
+
+    def test_path_depth(self):
+        for path, depth in (
+                ('/v1/a', 'account'),
+                ('/v1/a/c?format=json', 'container'),
+                ('/v1/a/c/o/with/slashes', 'object'),
+                ('/sda1/123/a', 'account'),
+                ('/sda1/123/a/c', 'container'),
+                ('/sda1/123/a/c/o', 'object'),
+                ('/info', None),
+                ('/', None)):
+            self.assertEqual(depth, sampling._path_depth(path), path)
+
+    def test_parse(self):
+        rules = sampling.get_sampling_rules({
+            'zipkin_sampling_rule_b': 'header=X-Static-Large-Object rate=0',
+            'zipkin_sampling_rule_a': 'method=get,HEAD depth=container '
+                                      'user_agent=^curl rate=0.5',
+            'zipkin_sample_rate': '0.1',
+        })
+        self.assertEqual([0.5, 0.0], [r.rate for r in rules])
+        self.assertEqual(frozenset(('GET', 'HEAD')), rules[0].methods)
+        self.assertEqual('container', rules[0].depth)
+        self.assertEqual('X-Static-Large-Object', rules[1].header)
+        for bad in ('method=GET', 'rate=2', 'rate=1 depth=cluster',
+                    'rate=1 color=blue', 'rate=1 method'):
+            self.assertRaises(ValueError, sampling.parse_sampling_rule, bad)
+
+    def test_sample(self):
+        sampler = sampling.RuleSampler([
+            sampling.parse_sampling_rule('method=HEAD path=/v1/AUTH_test '
+                                         'rate=1'),
+            sampling.parse_sampling_rule('depth=object rate=0'),
+            sampling.parse_sampling_rule('user_agent=swift rate=0'),
+        ], default_rate=1.0)
+        self.assertTrue(sampler.sample('HEAD', '/v1/AUTH_test/c/o', {}))
+        self.assertFalse(sampler.sample('GET', '/v1/AUTH_test/c/o', {}))
+        self.assertFalse(sampler.sample('GET', '/v1/AUTH_test', {
+            'User-Agent': 'python-swiftclient'}))
+        self.assertTrue(sampler.sample('GET', '/v1/AUTH_test', {}))
+        sampler.default_rate = 0.0
+        self.assertFalse(sampler.sample('GET', '/v1/AUTH_test', {}))
+        # the fallback gets anything unmatched
+        sampler.fallback = mock.Mock()
+        sampler.fallback.sample.return_value = True
+        self.assertTrue(sampler.sample('GET', '/v1/AUTH_test', {}))
+        sampler.fallback.sample.assert_called_once_with(
+            'GET', '/v1/AUTH_test', {})
@@ -0,0 +1,170 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import eventlet
+from py_zipkin.encoding import Encoding
+
+from swift_zipkin import spool, transport
+from tests.unit.test_transport import FakeSession, make_payload, wait_for
+
+
+class TestSpanSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.sent = []
+        self.fail = None
+        self.stats = {}
+        self.spools = []
+
+    def tearDown(self):
+        for s in self.spools:
+            s.stop()
+        shutil.rmtree(self.tempdir)
+
+    def send(self, body, num_spans, encoding):
+        if self.fail:
+            return self.fail
+        self.sent.append((body, num_spans, encoding))
+
+    def make_spool(self, **kwargs):
+        kwargs.setdefault('is_retryable', transport._is_retryable)
+        s = spool.SpanSpool(logging.getLogger('test'), self.tempdir,
+                            self.send, self.stats, **kwargs)
+        s.replay_interval = 0.01
+        s.max_replay_backoff = 0.05
+        self.spools.append(s)
+        return s
+
+    def test_spool_and_replay(self):
+        s = self.make_spool()
+        self.assertTrue(s.put(make_payload(2), 2))
+        self.assertTrue(s.put(make_payload(1).encode('ascii'), 1))
+        s.start()
+        wait_for(lambda: len(self.sent) == 2)
+        self.assertEqual(
+            [(make_payload(2).encode('ascii'), 2, Encoding.V2_JSON),
+             (make_payload(1).encode('ascii'), 1, Encoding.V2_JSON)],
+            self.sent)
+        self.assertEqual(3, self.stats['spooled'])
+        wait_for(lambda: not os.listdir(self.tempdir))
+        self.assertEqual(3, self.stats['replayed'])
+
+    def test_replay_resumes_after_failure(self):
+        s = self.make_spool()
+        s.put(make_payload(1), 1)
+        s.put(make_payload(2), 2)
+        self.fail = transport.requests.ConnectionError('nope')
+        s.start()
+        wait_for(lambda: s._backoff == s.max_replay_backoff)
+        self.assertEqual(0, self.stats['replayed'])
+        self.fail = None
+        wait_for(lambda: self.stats['replayed'] == 3)
+        self.assertEqual([1, 2], [n for _, n, _ in self.sent])
+
+    def test_rejected_record_dropped(self):
+        rejected = make_payload(2).encode('ascii')
+
+        def send(body, num_spans, encoding):
+            if body == rejected:
+                return transport.requests.HTTPError(
+                    response=mock.Mock(status_code=400))
+            self.sent.append((body, num_spans, encoding))
+
+        self.send = send
+        s = self.make_spool()
+        s.put(rejected, 2)
+        s.put(make_payload(1), 1)
+        s.start()
+        wait_for(lambda: self.stats['replayed'] == 1)
+        self.assertEqual([1], [n for _, n, _ in self.sent])
+        self.assertEqual({'spooled': 3, 'replayed': 1, 'dropped': 2},
+                         self.stats)
+        wait_for(lambda: not os.listdir(self.tempdir))
+
+    def test_pending_bounded(self):
+        s = self.make_spool(max_pending=len(make_payload(2)))
+        self.assertTrue(s.put(make_payload(2), 2))
+        self.assertFalse(s.put(make_payload(1), 1))
+        self.assertEqual(2, self.stats['spooled'])
+        self.assertEqual(1, self.stats['dropped'])
+
+    def test_max_size(self):
+        body = make_payload(1)
+        s = self.make_spool(
+            segment_size=1,
+            max_size=2 * (len(body) + spool.RECORD_HEADER.size))
+        for _ in range(3):
+            s._write(body.encode('ascii'), 1)
+        self.assertEqual(2, len(os.listdir(self.tempdir)))
+        self.assertEqual(1, self.stats['dropped'])
+
+    def test_recover_dead_worker(self):
+        # some pid that certainly isn't running
+        dead_pid = 2**22 + 1
+        s = self.make_spool()
+        s.active_path = os.path.join(self.tempdir, '%d.active' % dead_pid)
+        s._append(make_payload(3).encode('ascii'), 3)
+        claimed = os.path.join(self.tempdir, 'x-%d-1.spool.%d' % (
+            dead_pid, dead_pid))
+        with open(claimed, 'wb'):
+            pass
+        self.make_spool()._recover()
+        names = sorted(os.listdir(self.tempdir))
+        self.assertTrue(names[0].endswith('-%d-3.spool' % dead_pid), names)
+        self.assertEqual('x-%d-1.spool' % dead_pid, names[1])
+
+
+class TestTransportSpooling(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.transports = []
+
+    def tearDown(self):
+        for t in self.transports:
+            t.stop()
+        shutil.rmtree(self.tempdir)
+
+    def make_transport(self, **kwargs):
+        t = transport.GreenHttpTransport(
+            logging.getLogger('test'), '127.0.0.1', 9411,
+            flush_threshold_sec=3600, spool_dir=self.tempdir, **kwargs)
+        t.spool.replay_interval = 0.01
+        t.endpoints[0].session = self.session = FakeSession()
+        self.transports.append(t)
+        return t
+
+    def test_failed_flush_spooled(self):
+        t = self.make_transport()
+        self.session.fail = transport.requests.ConnectionError('nope')
+        t.send(make_payload(2))
+        t.do_flush()
+        wait_for(lambda: t.stats['spooled'] == 2)
+        self.assertEqual(0, t.span_queue.total_spans)
+        self.assertEqual(0, t.stats['dropped'])
+        self.session.fail = None
+        wait_for(lambda: t.stats['replayed'] == 2)
+        self.assertEqual([make_payload(2).encode('ascii')], self.session.posts)
+        self.assertEqual(2, t.stats['sent'])
+
+        t.stop()
+        self.assertFalse(t.spool._greenthreads)
+        t.spool.put(make_payload(1), 1)
+        eventlet.sleep(0.05)
+        self.assertEqual([], os.listdir(self.tempdir))
+
+    def test_overflow_spooled(self):
+        t = self.make_transport(max_buffer_spans=2)
+        t._flushers_started = True  # don't flush or replay anything
+        t.send(make_payload(2))
+        t.send(make_payload(1))
+        self.assertEqual({'enqueued': 3, 'dropped': 0, 'sent': 0,
+                          'spooled': 2, 'replayed': 0}, t.stats)
@@ -0,0 +1,399 @@
+import logging
+import unittest
+import zlib
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from py_zipkin.encoding import Encoding, protobuf
+
+from swift_zipkin import api, transport, zipkin
+
+
+def make_payload(num_spans, tags=''):
+    return '[' + ','.join(
+        '{"traceId": "%032x", "id": "%016x"%s}' % (i, i, tags)
+        for i in range(num_spans)) + ']'
+
+
+class TestSpanQueue(unittest.TestCase):
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            transport.SpanQueue(10, 10, 'bogus')
+
+    def test_drop_oldest(self):
+        q = transport.SpanQueue(100, 3, transport.DROP_OLDEST)
+        self.assertEqual(0, q.push('a', 1, 2))
+        self.assertEqual(0, q.push('b', 1, 1))
+        self.assertEqual(2, q.push('c', 1, 1))
+        self.assertEqual(['b', 'c'], [e[0] for e in q.drain()])
+        self.assertEqual((0, 0), (q.total_bytes, q.total_spans))
+
+    def test_drop_newest(self):
+        q = transport.SpanQueue(2, 100, transport.DROP_NEWEST)
+        self.assertEqual(0, q.push('a', 1, 1))
+        self.assertEqual(0, q.push('b', 1, 1))
+        self.assertEqual(3, q.push('c', 1, 3))
+        self.assertEqual(['a', 'b'], [e[0] for e in q.drain()])
+
+    def test_drop_priority(self):
+        q = transport.SpanQueue(100, 2, transport.DROP_PRIORITY)
+        q.push('hi', 1, 1, transport.PRIORITY_HIGH)
+        q.push('lo', 1, 1)
+        # incoming normal-priority span evicts the older normal one
+        self.assertEqual(1, q.push('lo2', 1, 1))
+        # incoming high-priority span evicts the normal one
+        self.assertEqual(1, q.push('hi2', 1, 1, transport.PRIORITY_HIGH))
+        # nothing lower to evict, so incoming is rejected
+        self.assertEqual(1, q.push('lo3', 1, 1))
+        self.assertEqual(['hi', 'hi2'], [e[0] for e in q.drain()])
+
+    def test_no_evict(self):
+        q = transport.SpanQueue(100, 1, transport.DROP_OLDEST)
+        q.push('a', 1, 1)
+        self.assertEqual(1, q.push('b', 1, 1, evict=False))
+        self.assertEqual(['a'], [e[0] for e in q.drain()])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_and_close(self):
+        b = transport.CircuitBreaker(threshold=2, cooldown=10)
+        self.assertFalse(b.record_failure())
+        self.assertTrue(b.allow())
+        self.assertTrue(b.record_failure())
+        self.assertFalse(b.allow())
+        with mock.patch('time.time', return_value=transport.time.time() + 11):
+            # one trial request
+            self.assertTrue(b.allow())
+            self.assertFalse(b.allow())
+            self.assertFalse(b.record_failure())  # already open
+            self.assertFalse(b.allow())
+        with mock.patch('time.time', return_value=transport.time.time() + 22):
+            self.assertTrue(b.allow())
+            b.record_success()
+            self.assertTrue(b.allow())
+            self.assertTrue(b.allow())
+
+
+class TestPayloadHelpers(unittest.TestCase):
+
+    def test_count_spans(self):
+        self.assertEqual(3, transport.count_spans(make_payload(3)))
+
+    def test_payload_priority(self):
+        self.assertEqual(transport.PRIORITY_NORMAL,
+                         transport.payload_priority(make_payload(2)))
+        payload = make_payload(
+            2, tags=', "tags": {"sampling.priority": "1"}')
+        self.assertEqual(1, transport.payload_priority(payload))
+
+
+def settle():
+    for _ in range(10):
+        transport.eventlet.sleep(0)
+
+
+def wait_for(condition, timeout=5):
+    with transport.eventlet.Timeout(timeout):
+        while not condition():
+            transport.eventlet.sleep(0.01)
+
+
+class FakeSession(object):
+
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.posts = []
+        self.blocker = None
+        self.in_flight = self.max_in_flight = 0
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        if self.fail:
+            raise self.fail
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.blocker:
+                self.blocker.wait()
+        finally:
+            self.in_flight -= 1
+        self.posts.append(data)
+        return self
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeStatsdLogger(object):
+
+    def __init__(self):
+        self.metrics = []
+        self.logger = logging.getLogger('test')
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+    def update_stats(self, metric, amount):
+        self.metrics.append(('update_stats', metric, amount))
+
+    def increment(self, metric):
+        self.metrics.append(('increment', metric))
+
+    def timing_since(self, metric, start):
+        self.metrics.append(('timing_since', metric))
+
+
+class TestGreenHttpTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.transports = []
+
+    def tearDown(self):
+        for t in self.transports:
+            t.stop()
+
+    def make_transport(self, **kwargs):
+        kwargs.setdefault('flush_threshold_sec', 3600)
+        t = transport.GreenHttpTransport(
+            logging.getLogger('test'), '127.0.0.1', 9411, **kwargs)
+        for endpoint in t.endpoints:
+            fake_session = FakeSession()
+            fake_session.headers = endpoint.session.headers
+            endpoint.session = fake_session
+        self.session = t.endpoints[0].session
+        self.transports.append(t)
+        return t
+
+    def test_flush_counts(self):
+        t = self.make_transport(flush_threshold_size=2**20)
+        t.send(make_payload(2))
+        t.send(make_payload(3))
+        self.assertEqual(5, t.span_queue.total_spans)
+        t.do_flush()
+        settle()
+        self.assertEqual(1, len(self.session.posts))
+        self.assertEqual(5, transport.count_spans(self.session.posts[0]))
+        self.assertEqual({'enqueued': 5, 'dropped': 0, 'sent': 5}, t.stats)
+
+    def test_buffer_bounded(self):
+        t = self.make_transport(max_buffer_spans=4)
+        for _ in range(3):
+            t.send(make_payload(2))
+        self.assertEqual(4, t.span_queue.total_spans)
+        self.assertEqual({'enqueued': 6, 'dropped': 2, 'sent': 0}, t.stats)
+
+    def test_failed_flush_requeued(self):
+        t = self.make_transport()
+        self.session.fail = transport.requests.ConnectionError('nope')
+        t.send(make_payload(2))
+        t.do_flush()
+        settle()
+        # retried, then put back
+        wait_for(lambda: t.span_queue.total_spans)
+        self.assertEqual(2, t.span_queue.total_spans)
+        self.assertEqual(0, t.stats['dropped'])
+
+    def test_retries_and_breaker(self):
+        t = self.make_transport(max_retries=2, retry_backoff=0,
+                                breaker_threshold=4)
+        attempts = []
+
+        def post(url, **kwargs):
+            attempts.append(kwargs['timeout'])
+            raise transport.requests.ConnectionError('nope')
+        self.session.post = post
+        for _ in range(2):
+            t.send(make_payload(1))
+            t.do_flush()
+            settle()
+        # 3 attempts, then 1 more to open the breaker
+        self.assertEqual([(0.5, 5.0)] * 4, attempts)
+        self.assertTrue(t.endpoints[0].breaker.is_open())
+        # Without a spool, nothing is even drained while the breaker's open
+        t.do_flush()
+        settle()
+        self.assertEqual(4, len(attempts))
+        self.assertEqual(2, t.span_queue.total_spans)
+
+    def test_multiple_endpoints(self):
+        t = self.make_transport(
+            endpoints=[('10.0.0.1', 9411), ('10.0.0.2', 9411)],
+            retry_backoff=0, breaker_threshold=1)
+        self.assertEqual(['http://10.0.0.1:9411/api/v2/spans',
+                          'http://10.0.0.2:9411/api/v2/spans'],
+                         [e.url for e in t.endpoints])
+        bad, good = [e.session for e in t.endpoints]
+        for _ in range(2):
+            t.send(make_payload(1))
+            t.do_flush()
+            settle()
+        # round-robin
+        self.assertEqual((1, 1), (len(bad.posts), len(good.posts)))
+        # one fails, gets ejected, and the retry fails over to the other
+        bad.fail = transport.requests.ConnectionError('nope')
+        for _ in range(3):
+            t.send(make_payload(1))
+            t.do_flush()
+            settle()
+        self.assertEqual((1, 4), (len(bad.posts), len(good.posts)))
+        self.assertTrue(t.endpoints[0].breaker.is_open())
+        self.assertEqual(5, t.stats['sent'])
+
+    def test_least_outstanding_and_slow_endpoint(self):
+        t = self.make_transport(
+            endpoints=[('10.0.0.1', 9411), ('10.0.0.2', 9411)],
+            endpoint_selection=transport.SELECT_LEAST_OUTSTANDING,
+            eject_latency=1.0)
+        first, second = t.endpoints
+        first.outstanding = 1
+        self.assertIs(second, t._select_endpoint())
+        first.outstanding = 0
+        second.latency = 0.5
+        self.assertIs(first, t._select_endpoint())
+        t._record_latency(second, 10.0)
+        self.assertTrue(second.breaker.is_open())
+        # the last one standing is never ejected for being slow
+        t._record_latency(first, 10.0)
+        self.assertFalse(first.breaker.is_open())
+
+    def test_metrics(self):
+        t = self.make_transport()
+        logger = t.metrics = FakeStatsdLogger()
+        with mock.patch('py_zipkin.zipkin.get_default_tracer',
+                        api.get_default_tracer), \
+                mock.patch.object(transport, 'global_transport', t):
+            with api.ezipkin_server_span('svc', span_name='GET',
+                                         sample_rate=100,
+                                         instrumentation='wsgi'):
+                with api.ezipkin_client_span('svc', span_name='get',
+                                             instrumentation='memcached'):
+                    pass
+        t.do_flush()
+        settle()
+        self.assertEqual([
+            ('update_stats', 'buffer.depth.bytes', mock.ANY),
+            ('update_stats', 'buffer.depth.spans', 2),
+            ('update_stats', 'buffer.depth.in_flight', 1),
+            ('increment', 'buffer.depth.samples'),
+            ('timing_since', 'flush.timing'),
+            ('update_stats', 'flush.bytes', len(self.session.posts[0])),
+            ('update_stats', 'flush.spans', 2),
+        ], logger.metrics)
+        del logger.metrics[:]
+        t._report_metrics()
+        self.assertEqual(sorted([
+            ('update_stats', 'spans.enqueued', 2),
+            ('update_stats', 'spans.sent', 2),
+            ('update_stats', 'spans.recorded.wsgi', 1),
+            ('update_stats', 'spans.recorded.memcached', 1),
+        ]), sorted(logger.metrics))
+        # only the changes get reported
+        del logger.metrics[:]
+        t.stats['dropped'] += 3
+        t._report_metrics()
+        self.assertEqual([('update_stats', 'spans.dropped', 3)],
+                         logger.metrics)
+
+    def test_in_flight_limit(self):
+        t = self.make_transport(max_in_flight=2)
+        self.session.blocker = transport.eventlet.Event()
+        for _ in range(4):
+            t.send(make_payload(1))
+            t.do_flush()
+            settle()
+        self.assertEqual(2, self.session.in_flight)
+        # the rest is still waiting in the (bounded) buffer
+        self.assertEqual(2, t.span_queue.total_spans)
+        self.session.blocker.send()
+        t.do_flush()
+        settle()
+        self.assertEqual(2, self.session.max_in_flight)
+        self.assertEqual(4, t.stats['sent'])
+
+    def test_fragments(self):
+        t = self.make_transport()
+        t.send(['{"traceId": "1"}', '{"traceId": "2"}'])
+        t.send('[{"traceId": "3"}]')
+        self.assertEqual(3, t.span_queue.total_spans)
+        t.do_flush()
+        settle()
+        self.assertEqual(
+            '[{"traceId": "1"},{"traceId": "2"},{"traceId": "3"}]',
+            self.session.posts[0])
+
+    def test_span_sends_fragments(self):
+        t = self.make_transport()
+        sent = []
+        t.send = sent.append
+        with mock.patch('py_zipkin.zipkin.get_default_tracer',
+                        api.get_default_tracer):
+            with api.ezipkin_server_span('svc', span_name='GET',
+                                         sample_rate=100,
+                                         transport_handler=t):
+                with api.ezipkin_client_span('svc', span_name='get'):
+                    pass
+        self.assertEqual(1, len(sent))
+        self.assertIsInstance(sent[0], list)
+        self.assertEqual(2, len(sent[0]))
+
+    def test_gzip(self):
+        t = self.make_transport(compression='gzip', flush_threshold_size=100,
+                                flush_threshold_compressed=True)
+        self.assertEqual('gzip', self.session.headers['Content-Encoding'])
+        payload = [make_payload(1)[1:-1]] * 50
+        t.send(payload)
+        wait_for(lambda: self.session.posts)
+        body = self.session.posts[0]
+        self.assertEqual(
+            '[%s]' % ','.join(payload),
+            zlib.decompress(body, 16 + zlib.MAX_WBITS).decode('ascii'))
+        # the next flush is triggered by the estimated compressed size
+        self.assertGreater(t._raw_flush_threshold, 100)
+
+    def test_bad_compression(self):
+        with self.assertRaises(ValueError):
+            self.make_transport(compression='lzma')
+
+    def test_bad_compression_level(self):
+        for level in (-2, 10, 42):
+            self.assertRaises(ValueError, transport.get_compressor,
+                              'gzip', level)
+        self.assertIsNotNone(transport.get_compressor('gzip', 9))
+        with mock.patch.object(transport, 'zstandard',
+                               mock.Mock(MAX_COMPRESSION_LEVEL=22)):
+            self.assertRaises(ValueError, transport.get_compressor,
+                              'zstd', 23)
+            self.assertIsNotNone(transport.get_compressor('zstd', -5))
+        # caught when the middleware's configured, not on every flush
+        for level in ('42', 'fast'):
+            self.assertRaises(ValueError, zipkin.ZipkinMiddleware, None, {
+                'zipkin_compression': 'gzip',
+                'zipkin_compression_level': level})
+
+    @unittest.skipUnless(protobuf.installed(), 'protobuf not installed')
+    def test_proto3(self):
+        t = self.make_transport(encoding=Encoding.V2_PROTO3)
+        self.assertEqual('application/x-protobuf',
+                         self.session.headers['Content-Type'])
+        with mock.patch('py_zipkin.zipkin.get_default_tracer',
+                        api.get_default_tracer):
+            for _ in range(2):
+                with api.ezipkin_server_span(
+                        'svc', span_name='GET', sample_rate=100,
+                        transport_handler=t, encoding=Encoding.V2_PROTO3,
+                        binary_annotations={'sampling.priority': '1'}):
+                    with api.ezipkin_client_span('svc', span_name='get'):
+                        pass
+        self.assertEqual(4, t.span_queue.total_spans)
+        t.do_flush()
+        settle()
+        body = self.session.posts[0]
+        self.assertEqual(4, transport.count_spans(body, Encoding.V2_PROTO3))
+        self.assertEqual(1, transport.payload_priority(
+            body, Encoding.V2_PROTO3))
+        spans = protobuf.zipkin_pb2.ListOfSpans.FromString(body).spans
+        self.assertEqual(['get', 'GET', 'get', 'GET'],
+                         [span.name for span in spans])
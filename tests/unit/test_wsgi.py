@@ -0,0 +1,160 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from swift_zipkin import api, wsgi
+
+
+class TestResponseTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.span = mock.Mock()
+        self.start_response = mock.Mock()
+
+    def annotations(self, tracker):
+        tracker.annotate()
+        self.span.update_binary_annotations.assert_called_once()
+        return self.span.update_binary_annotations.call_args[0][0]
+
+    def test_streamed(self):
+        closed = []
+
+        def body():
+            try:
+                yield b''
+                yield b'abc'
+                yield b'defg'
+            finally:
+                closed.append(True)
+
+        def app(environ, start_response):
+            start_response('206 Partial Content', [('X-Foo', 'bar')])
+            return body()
+
+        tracker = wsgi._ResponseTracker(app, self.span)
+        result = tracker({}, self.start_response)
+        self.start_response.assert_called_once_with(
+            '206 Partial Content', [('X-Foo', 'bar')], None)
+        self.assertFalse(hasattr(result, '__len__'))
+        self.span.add_annotation.assert_not_called()
+        self.assertEqual(b'abcdefg', b''.join(result))
+        result.close()
+        self.assertEqual([True], closed)
+        self.span.add_annotation.assert_not_called()
+        self.assertEqual({'http.status_code': '206',
+                          'http.response.size': '7'},
+                         self.annotations(tracker))
+
+    def test_complete(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'hello']
+
+        request_input = mock.Mock(position=3)
+        tracker = wsgi._ResponseTracker(app, self.span, request_input)
+        # eventlet can still work out the Content-Length
+        self.assertEqual([b'hello'], tracker({}, self.start_response))
+        # ...and then discard the rest of the request body
+        request_input.position = 10
+        self.assertEqual({'http.status_code': '200',
+                          'http.request.size': '3',
+                          'http.response.size': '5'},
+                         self.annotations(tracker))
+
+    def test_already_handled(self):
+        already_handled = object()
+
+        def app(environ, start_response):
+            return already_handled
+
+        with mock.patch.object(wsgi, '_ALREADY_HANDLED', already_handled):
+            tracker = wsgi._ResponseTracker(app, self.span)
+            self.assertIs(already_handled,
+                          tracker({}, self.start_response))
+        self.span.add_annotation.assert_not_called()
+        self.assertEqual({'http.response.size': '0'},
+                         self.annotations(tracker))
+
+    def test_app_raises(self):
+        def app(environ, start_response):
+            raise ValueError('boom')
+
+        tracker = wsgi._ResponseTracker(app, self.span)
+        self.assertRaises(ValueError, tracker, {}, self.start_response)
+        self.assertEqual({'http.status_code': '500',
+                          'http.response.size': '0'},
+                         self.annotations(tracker))
+
+    def test_body_raises(self):
+        def body():
+            raise ValueError('boom')
+            yield b''
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return body()
+
+        tracker = wsgi._ResponseTracker(app, self.span)
+        result = tracker({}, self.start_response)
+        self.assertRaises(ValueError, list, result)
+        self.assertEqual('500', self.annotations(tracker)['http.status_code'])
+
+    def test_throughput(self):
+        now = [1000.0]
+
+        def body():
+            for _ in range(10):
+                now[0] += 0.5
+                yield b'x' * 100
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return body()
+
+        with mock.patch.object(api, 'throughput_interval', 1.0), \
+                mock.patch('time.time', lambda: now[0]):
+            tracker = wsgi._ResponseTracker(app, self.span)
+            self.assertEqual(1000, len(b''.join(tracker({},
+                             self.start_response))))
+        self.assertEqual([
+            mock.call('Sent 300 bytes (300 B/s)', 1001.5),
+            mock.call('Sent 500 bytes (200 B/s)', 1002.5),
+            mock.call('Sent 700 bytes (200 B/s)', 1003.5),
+            mock.call('Sent 900 bytes (200 B/s)', 1004.5),
+        ], self.span.add_annotation.mock_calls)
+
+    def test_slow_writer(self):
+        now = [1000.0]
+
+        def slow_flush():
+            now[0] += 2.5
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'hello']
+
+        wfile = mock.Mock()
+        wfile.flush.side_effect = slow_flush
+        writer = wsgi._TimedWriter(wfile)
+        with mock.patch('time.time', lambda: now[0]):
+            tracker = wsgi._ResponseTracker(app, self.span, writer=writer)
+            result = tracker({}, self.start_response)
+            # Nothing's gone out yet
+            now[0] += 0.5
+            writer.writelines([b'HTTP/1.1 200 OK\r\n\r\n', result[0]])
+            writer.flush()
+            tracker.annotate()
+        wfile.writelines.assert_called_once()
+        self.assertEqual([
+            mock.call('First response byte', 1000.5),
+            mock.call('Last response byte', 1003.0),
+        ], self.span.add_annotation.mock_calls)
+
+    def test_nothing_written(self):
+        writer = wsgi._TimedWriter(mock.Mock())
+        writer.flush()
+        tracker = wsgi._ResponseTracker(mock.Mock(), self.span, writer=writer)
+        tracker.annotate()
+        self.span.add_annotation.assert_not_called()